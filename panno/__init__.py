@@ -5,3 +5,5 @@ from __future__ import absolute_import
 __author__ = """Yaqing Liu"""
 __email__ = 'yaqing.liu@outlook.com'
 __version__ = '0.3.1'
+
+from panno.api import run, load_kb, Result, KnowledgeBase
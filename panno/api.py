@@ -0,0 +1,52 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+"""In-process interface of PAnno: results are returned as objects and nothing is written to disk."""
+
+from panno import genotype_resolution, clinical_annotation, predict_diplotype
+from collections import namedtuple
+
+pop_dic = {'AAC': 'African American/Afro-Caribbean', 'AME': 'American', 'SAS': 'Central/South Asian', 'EAS': 'East Asian', 'EUR': 'European', 'LAT': 'Latino', 'NEA': 'Near Eastern', 'OCE': 'Oceanian', 'SSA': 'Sub-Saharan African'}
+
+# Everything read from the assets: the PGx loci, the haplotype definitions and the annotation tables of the database
+KnowledgeBase = namedtuple('KnowledgeBase', ['pgx_loci', 'definitions', 'tables'])
+
+# The six tables of the report, plus the genotype resolution they were derived from
+Result = namedtuple('Result', ['summary', 'prescribing_info', 'multi_var', 'single_var', 'phenotype_predict', 'clinical_anno',
+                               'diplotype', 'rs2gt', 'hla_subtypes'])
+
+
+def load_kb(pgx_kb_fp=None):
+  ## Load the knowledge base once, to reuse it across calls of run
+  return(KnowledgeBase(genotype_resolution.load_pgx_loci(), predict_diplotype.load_definitions(), clinical_annotation.load_tables(pgx_kb_fp)))
+
+
+def restrict(tables, drugs=None, genes=None):
+  ## The tables restricted to some drugs and genes (see clinical_annotation.restrict_tables), and the genes of
+  ## genotype_resolution.GENE_LIST to predict for them: those in genes and referred to by the tables of the drugs
+  tables = clinical_annotation.restrict_tables(tables, drugs, genes)
+  related = clinical_annotation.table_genes(tables)
+  if genes is not None:
+    genes = [gene.strip().upper() for gene in genes]
+  gene_list = [gene for gene in genotype_resolution.GENE_LIST if (drugs is None or gene in related) and (genes is None or gene in genes)]
+  return(tables, gene_list)
+
+
+def run(vcf_path_or_records, population, kb=None, threads=None, mode='serial', drugs=None, genes=None, assume_sorted=False):
+  ## vcf_path_or_records is a VCF/BCF file or the records returned by genotype_resolution.parse_vcf;
+  ## population is a three-letter abbreviation of pop_dic. Raises ValueError for an unknown population.
+  ## mode ('serial', 'thread' or 'process') chooses how the genes are dispatched during diplotype prediction.
+  ## With drugs, a list of drug names, only the guidelines and annotations of these drugs are matched and only the
+  ## diplotypes of the genes they refer to are predicted. genes, a list of genes such as the ones of a targeted panel,
+  ## likewise limits the prediction, annotation and report to these genes. Raises ValueError for an unknown drug or gene.
+  ## assume_sorted lets a coordinate-sorted plain VCF be read at the PGx loci only (see genotype_resolution.parse_vcf).
+  if population.upper() not in pop_dic.keys():
+    raise ValueError('The population %s is not included in PAnno, use one of %s.' % (population, ', '.join(pop_dic.keys())))
+  if kb is None:
+    kb = load_kb()
+  tables = kb.tables; gene_list = None
+  if drugs is not None or genes is not None:
+    tables, gene_list = restrict(kb.tables, drugs, genes)
+  dic_diplotype, dic_rs2gt, hla_subtypes = genotype_resolution.resolution(pop_dic[population.upper()], vcf_path_or_records, threads, kb.pgx_loci, kb.definitions, mode, gene_list, assume_sorted)
+  summary, prescribing_info, multi_var, single_var, phenotype_predict, clinical_anno = clinical_annotation.annotation(dic_diplotype, dic_rs2gt, hla_subtypes, tables)
+  return(Result(summary, prescribing_info, multi_var, single_var, phenotype_predict, clinical_anno, dic_diplotype, dic_rs2gt, hla_subtypes))
@@ -5,20 +5,80 @@ import pandas as pd
 import io
 import json
 import sqlite3
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
 
 url = "https://api.pharmgkb.org/v1/download/file/data/clinicalAnnotations.zip"
 url_api = "https://api.pharmgkb.org/v1"
 
-temp_dir = "./panno/data/temp/"
-os.makedirs(temp_dir, exist_ok=True)
-
 output_dir = "./panno/data/output_review/"
 os.makedirs(output_dir, exist_ok=True)
 
+# GuidelineMerge anterior y hashes de los JSON con los que se generó (para procesar solo los cambios)
+guideline_review = f"{output_dir}GuidelineMerge_Review.csv"
+guideline_manifest = f"{output_dir}GuidelineMerge_Manifest.json"
+
 HEADERS = {
     'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
 }
 
+# Filas de clinical_ann_alleles.tsv que se procesan por bloque
+CLINANN_CHUNKSIZE = 20000
+
+# Columnas de los TSV de PharmGKB que se usan para construir ClinAnn
+COLS_META = ['Clinical Annotation ID', 'Variant/Haplotypes', 'Gene', 'Level of Evidence', 'Level Override',
+             'Level Modifiers', 'Score', 'Phenotype Category', 'PMID Count', 'Evidence Count', 'Drug(s)',
+             'Phenotype(s)', 'Specialty Population']
+COLS_ALLELES = ['Clinical Annotation ID', 'Genotype/Allele', 'Annotation Text', 'Allele Function']
+
+def dividir_alelos(genotipos):
+    """
+    Separa la columna 'Genotype/Allele' en (Allele1, Allele2) con operaciones vectorizadas:
+      - 'X/Y' (diplotipos '*1/*2', indels 'del/TA', repeticiones) -> X, Y
+      - genotipo de SNV de dos bases ('CT') -> C, T
+      - cualquier otro valor (un solo alelo: '*1', '*57:01', 'A') -> valor, None
+    """
+    texto = genotipos.fillna("").astype(str)
+    con_barra = texto.str.contains("/", regex=False)
+    snv = texto.str.match(r"^[ACGT]{2}$")
+    partes = texto.str.split("/", n=1, expand=True).reindex(columns=[0, 1])
+
+    allele1 = genotipos.astype(object)
+    allele1 = allele1.mask(con_barra, partes[0].str.strip())
+    allele1 = allele1.mask(snv, texto.str[0])
+    allele2 = pd.Series(None, index=genotipos.index, dtype=object)
+    allele2 = allele2.mask(con_barra, partes[1].str.strip())
+    allele2 = allele2.mask(snv, texto.str[1])
+    return allele1, allele2
+
+def construir_clinann(merged):
+    allele1, allele2 = dividir_alelos(merged['Genotype/Allele'])
+    
+    df_final = pd.DataFrame()
+    df_final['CAID'] = merged['Clinical Annotation ID']
+    df_final['Gene'] = merged['Gene']
+    df_final['Variant'] = merged['Variant/Haplotypes']
+    df_final['Allele1'] = allele1
+    df_final['Allele2'] = allele2
+    df_final['Annotation1'] = merged['Annotation Text']
+    df_final['Function1'] = merged['Allele Function']
+    df_final['Function2'] = ""
+    df_final['Score1'] = merged['Score']
+    df_final['Score2'] = ""
+    df_final['CPICPhenotype'] = merged['Phenotype Category']
+    df_final['PAnnoPhenotype'] = merged['Allele Function']
+    df_final['Drug'] = merged['Drug(s)']
+    df_final['Phenotypes'] = merged['Phenotype(s)']
+    df_final['EvidenceLevel'] = merged['Level of Evidence']
+    df_final['LevelOverride'] = merged['Level Override']
+    df_final['LevelModifier'] = merged["Level Modifiers"]
+    df_final['Score'] = merged['Score']
+    df_final['PMIDCount'] = merged["PMID Count"]
+    df_final['EvidenceCount'] = merged["Evidence Count"]
+    df_final['Specialty'] = merged["Specialty Population"]
+    df_final['PhenotypeCategory'] = merged['Phenotype Category']
+    return df_final
+
 #Generar ClinAnn
 def actualizar_clinaan():
     try:
@@ -27,61 +87,124 @@ def actualizar_clinaan():
         response.raise_for_status()  # Raise an error for bad status codes
         print("✅ Descarga completada.")
 
-        print("📦 Descomprimiendo archivos...")
+        # Los TSV se leen directamente del ZIP. clinical_annotations.tsv (una fila por anotación)
+        # se carga completo; clinical_ann_alleles.tsv se procesa por bloques para acotar la memoria.
         with zipfile.ZipFile(io.BytesIO(response.content)) as z:
-            z.extract("clinical_annotations.tsv", temp_dir)
-            z.extract("clinical_ann_alleles.tsv", temp_dir)
-            #z.extract("clinical_ann_evidence.tsv", temp_dir)
-        
-        print("📊 Leyendo archivos CSV...")
-        df_meta = pd.read_csv(f"{temp_dir}clinical_annotations.tsv", sep="\t")
-        df_alleles = pd.read_csv(f"{temp_dir}clinical_ann_alleles.tsv", sep="\t")
-        #df_evidence = pd.read_csv(f"{temp_dir}clinical_ann_evidence.tsv", sep="\t")
-
-        print("🔄 Procesando y uniendo datos (esto puede tardar un poco)...")
-        merged = pd.merge(df_alleles, df_meta, on="Clinical Annotation ID", how="inner")
-
-        def split_alleles(g):
-            if pd.isna(g) or len(g) != 2: return g, None # Fallback simple
-            return g[0], g[1]
-
-        print("🧬 Dividiendo alelos...")
-        merged[['Allele1', 'Allele2']] = merged['Genotype/Allele'].apply(
-            lambda x: pd.Series(split_alleles(x))
-        )
-
-        print("📝 Construyendo DataFrame final...")
-        df_final = pd.DataFrame()
-        df_final['CAID'] = merged['Clinical Annotation ID']
-        df_final['Gene'] = merged['Gene']
-        df_final['Variant'] = merged['Variant/Haplotypes']
-        df_final['Allele1'] = merged['Allele1']
-        df_final['Allele2'] = merged['Allele2']
-        df_final['Annotation1'] = merged['Annotation Text']
-        df_final['Function1'] = merged['Allele Function']
-        df_final['Function2'] = ""
-        df_final['Score1'] = merged['Score']
-        df_final['Score2'] = ""
-        df_final['CPICPhenotype'] = merged['Phenotype Category']
-        df_final['PAnnoPhenotype'] = merged['Allele Function']
-        df_final['Drug'] = merged['Drug(s)']
-        df_final['Phenotypes'] = merged['Phenotype(s)']
-        df_final['EvidenceLevel'] = merged['Level of Evidence']
-        df_final['LevelOverride'] = merged['Level Override']
-        df_final['LevelModifier'] = merged["Level Modifiers"]
-        df_final['Score'] = merged['Score']
-        df_final['PMIDCount'] = merged["PMID Count"]
-        df_final['EvidenceCount'] = merged["Evidence Count"]
-        df_final['Specialty'] = merged["Specialty Population"]
-        df_final['PhenotypeCategory'] = merged['Phenotype Category']
+            print("📊 Leyendo clinical_annotations.tsv...")
+            with z.open("clinical_annotations.tsv") as f:
+                df_meta = pd.read_csv(f, sep="\t", usecols=COLS_META)
+
+            print("🔄 Procesando y uniendo alelos por bloques...")
+            bloques = []
+            with z.open("clinical_ann_alleles.tsv") as f:
+                for df_alleles in pd.read_csv(f, sep="\t", usecols=COLS_ALLELES, chunksize=CLINANN_CHUNKSIZE):
+                    merged = pd.merge(df_alleles, df_meta, on="Clinical Annotation ID", how="inner")
+                    bloques.append(construir_clinann(merged))
+
+        df_final = pd.concat(bloques, ignore_index=True)
         df_final.fillna("", inplace=True)
 
         return df_final
 
     except requests.exceptions.RequestException as e:
         print(f"An error occurred while downloading PharmGKB guidelines: {e}")
+        return pd.DataFrame()
+
+# Fuentes de guidelines que se incorporan a GuidelineMerge
+target_sources = ['CPIC', 'DPWG', 'RNPGx']
+
+# Número de JSON que recibe cada proceso por envío
+GUIDELINE_CHUNKSIZE = 16
+
+def procesar_guideline(miembro):
+    """
+    Convierte un miembro del ZIP de guidelines (nombre, bytes) en una fila de GuidelineMerge.
+    Devuelve None si la guideline no es de una fuente objetivo o no se pudo leer.
+    Vive a nivel de módulo para que ProcessPoolExecutor pueda enviarla a los procesos hijos.
+    """
+    json_file, contenido = miembro
+    try:
+        d = json.loads(contenido.decode('utf-8'))
+
+        # Estructura típica: d['guideline'] contiene la info
+        g = d.get('guideline', {})
+        source = g.get('source', '')
+
+        if source not in target_sources:
+            return None
+
+        # Extraer campos clave
+        guideline_id = g.get('id', '')
+
+        # Summary y Recommendation vienen a veces en summaryMarkdown (objeto o string)
+        summary_obj = g.get('summaryMarkdown', {})
+        summary_text = ""
+        if isinstance(summary_obj, dict):
+            summary_text = summary_obj.get('html', '')
+        else:
+            summary_text = str(summary_obj)
+
+        summary_text = summary_text.replace('\n', ' ').strip()
+
+        # Genes (puede haber varios, tomamos los símbolos unidos)
+        genes = [x.get('symbol', '') for x in g.get('relatedGenes', [])]
+        gene_str = "; ".join(filter(None, genes))
+
+        # Drugs
+        drugs = [x.get('name', '') for x in g.get('relatedChemicals', [])]
+        drug_str = "; ".join(filter(None, drugs))
+
+        # Mapeo a columnas de GuidelineMerge (Schema Match)
+        return {
+            # 'ID': ser asignado después numéricamente
+            'Source': source,
+            'PAID': guideline_id, # ID original de PharmGKB va aquí
+            'Summary': g.get('name', ''), # Título como summary
+            'Phenotype': "",
+            'Genotype': "", # Schema expects this
+            'Recommendation': summary_text,
+            'Avoid': 0, # Default
+            'Alternate': 1 if g.get('alternateDrugAvailable') else 0,
+            'Dosing': 1 if g.get('dosingInformation') else 0,
+            'Gene': gene_str,
+            'Drug': drug_str,
+            'GeneID': 0, # Filler
+            'DrugID': 0  # Filler
+        }
+
+    except Exception as e:
+        print(f"⚠️ Error leyendo {json_file}: {e}")
+        return None
+
+def cargar_manifest():
+    """
+    Lee el manifest de guidelines ({PAID: {'hash': sha256 del JSON, 'ID': ID en GuidelineMerge o None}})
+    junto con el GuidelineMerge_Review.csv anterior, e indica si la ejecución es la inicial (sin manifest).
+    Si falta el CSV, se devuelven vacíos y todas las guidelines se procesan de nuevo con IDs desde 1.
+    """
+    inicial = not os.path.exists(guideline_manifest)
+    if not os.path.exists(guideline_review):
+        return {}, pd.DataFrame(), inicial
+    df_prev = pd.read_csv(guideline_review, keep_default_na=False)
+    if not inicial:
+        with open(guideline_manifest, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    else:
+        # Sin manifest (primera ejecución) se conservan los IDs del CSV, pero todo se vuelve a parsear
+        manifest = {row['PAID']: {'hash': None, 'ID': int(row['ID'])} for row in df_prev.to_dict('records')}
+    return manifest, df_prev, inicial
+
+def guardar_manifest(manifest):
+    with open(guideline_manifest, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
 
 def actualizar_guidelines():
+    """
+    Devuelve (GuidelineMerge, manifest nuevo, resumen de cambios). Solo se parsean las guidelines
+    nuevas o cuyo JSON cambió respecto al manifest; las demás reutilizan su fila y su ID anteriores.
+    Sin manifest previo no hay con qué comparar: la ejecución es la línea base y el resumen tiene
+    una sola fila 'initial' en lugar de listar todas las guidelines como cambiadas.
+    """
     # URL para descargar annotations en formato JSON (el ZIP contiene muchos JSONs)
     # Nota: La API devuelve 303 Redirect a S3, requests lo maneja automticamente.
     url_guidelines_zip = "https://api.pharmgkb.org/v1/download/file/data/guidelineAnnotations.json.zip"
@@ -91,101 +214,97 @@ def actualizar_guidelines():
         response = requests.get(url_guidelines_zip, headers=HEADERS, timeout=60)
         response.raise_for_status()
 
-        print("📦 Descomprimiendo archivos JSON...")
-        # Limpiamos temp_dir de JSONs previos para evitar mezclas
-        for f in os.listdir(temp_dir):
-            if f.endswith(".json"):
-                os.remove(os.path.join(temp_dir, f))
-
+        print("📦 Leyendo archivos JSON desde el ZIP...")
+        # Los JSON se leen directamente del ZIP (sin extraerlos a disco), así los restos
+        # de descargas anteriores no se mezclan. Se ordenan por nombre para que el
+        # resultado sea determinista.
         with zipfile.ZipFile(io.BytesIO(response.content)) as z:
-            z.extractall(temp_dir)
+            miembros = [(nombre, z.read(nombre)) for nombre in sorted(z.namelist()) if nombre.endswith(".json")]
         
-        print("📊 Procesando archivos JSON de Guidelines...")
+        # Cada JSON se llama <PAID>.json, así que el hash se puede comparar sin parsearlo
+        manifest_prev, df_prev, inicial = cargar_manifest()
+        filas_prev = {row['PAID']: row for row in df_prev.to_dict('records')}
+        manifest = {}
+        pendientes = []
+        for nombre, contenido in miembros:
+            paid = os.path.splitext(os.path.basename(nombre))[0]
+            digest = hashlib.sha256(contenido).hexdigest()
+            anterior = manifest_prev.get(paid)
+            manifest[paid] = {'hash': digest, 'ID': None}
+            # Se reutiliza la fila anterior solo si el hash coincide y la fila sigue en el CSV
+            if anterior and anterior['hash'] == digest and (anterior['ID'] is None or paid in filas_prev):
+                manifest[paid]['ID'] = anterior['ID']
+            else:
+                pendientes.append((nombre, contenido))
         
+        print(f"📊 Procesando {len(pendientes)} de {len(miembros)} archivos JSON de Guidelines (nuevos o modificados) en paralelo...")
+        # pool.map conserva el orden de entrada, así que las filas quedan en el orden de los nombres
+        with ProcessPoolExecutor() as pool:
+            resultados = list(pool.map(procesar_guideline, pendientes, chunksize=GUIDELINE_CHUNKSIZE))
+        nuevas = {}
+        for (nombre, contenido), row in zip(pendientes, resultados):
+            nuevas[os.path.splitext(os.path.basename(nombre))[0]] = row
+
+        # Los IDs existentes se conservan; las guidelines nuevas reciben IDs a continuación del mayor conocido
+        ids_conocidos = [v['ID'] for v in manifest_prev.values() if v['ID'] is not None]
+        siguiente_id = max(ids_conocidos, default=0) + 1
         data_rows = []
-        # Iteramos sobre todos los archivos JSON extraídos
-        json_files = [f for f in os.listdir(temp_dir) if f.endswith(".json")]
-        
-        target_sources = ['CPIC', 'DPWG', 'RNPGx']
-        
-        for json_file in json_files:
-            try:
-                with open(os.path.join(temp_dir, json_file), 'r', encoding='utf-8') as f:
-                    d = json.load(f)
-                    
-                    # Estructura típica: d['guideline'] contiene la info
-                    g = d.get('guideline', {})
-                    source = g.get('source', '')
-                    
-                    if source not in target_sources:
-                        continue
-                        
-                    # Extraer campos clave
-                    guideline_id = g.get('id', '')
-                    
-                    # Summary y Recommendation vienen a veces en summaryMarkdown (objeto o string)
-                    summary_obj = g.get('summaryMarkdown', {})
-                    summary_text = ""
-                    if isinstance(summary_obj, dict):
-                        summary_text = summary_obj.get('html', '')
-                    else:
-                        summary_text = str(summary_obj)
-                    
-                    summary_text = summary_text.replace('\n', ' ').strip()
-                    
-                    # Genes (puede haber varios, tomamos los símbolos unidos)
-                    genes = [x.get('symbol', '') for x in g.get('relatedGenes', [])]
-                    gene_str = "; ".join(filter(None, genes))
-                    
-                    # Drugs
-                    drugs = [x.get('name', '') for x in g.get('relatedChemicals', [])]
-                    drug_str = "; ".join(filter(None, drugs))
-
-                    # Mapeo a columnas de GuidelineMerge (Schema Match)
-                    row = {
-                        # 'ID': ser asignado después numéricamente
-                        'Source': source,
-                        'PAID': guideline_id, # ID original de PharmGKB va aquí
-                        'Summary': g.get('name', ''), # Título como summary
-                        'Phenotype': "", 
-                        'Genotype': "", # Schema expects this
-                        'Recommendation': summary_text, 
-                        'Avoid': 0, # Default
-                        'Alternate': 1 if g.get('alternateDrugAvailable') else 0,
-                        'Dosing': 1 if g.get('dosingInformation') else 0,
-                        'Gene': gene_str,
-                        'Drug': drug_str,
-                        'GeneID': 0, # Filler
-                        'DrugID': 0  # Filler
-                    }
-                    data_rows.append(row)
-                    
-            except Exception as e:
-                print(f"⚠️ Error leyendo {json_file}: {e}")
+        cambios = []
+        for paid in manifest:
+            anterior = manifest_prev.get(paid)
+            id_anterior = anterior['ID'] if anterior else None
+            if paid not in nuevas:
+                if id_anterior is not None:
+                    data_rows.append(filas_prev[paid])
                 continue
-
-        df_final = pd.DataFrame(data_rows)
+            row = nuevas[paid]
+            if row is None:
+                if id_anterior is not None:
+                    cambios.append({'Change': 'removed', 'PAID': paid, 'ID': id_anterior, 'Summary': filas_prev.get(paid, {}).get('Summary', '')})
+                continue
+            if id_anterior is not None:
+                row = dict(row, ID=id_anterior)
+                cambios.append({'Change': 'changed', 'PAID': paid, 'ID': id_anterior, 'Summary': row['Summary']})
+            else:
+                row = dict(row, ID=siguiente_id)
+                siguiente_id += 1
+                cambios.append({'Change': 'added', 'PAID': paid, 'ID': row['ID'], 'Summary': row['Summary']})
+            manifest[paid]['ID'] = row['ID']
+            data_rows.append(row)
         
-        # Generar ID numérico secuencial como espera la DB
-        if not df_final.empty:
-            df_final.insert(0, 'ID', range(1, len(df_final) + 1))
+        # Guidelines que ya no vienen en el ZIP
+        for paid, anterior in manifest_prev.items():
+            if paid not in manifest and anterior['ID'] is not None:
+                cambios.append({'Change': 'removed', 'PAID': paid, 'ID': anterior['ID'], 'Summary': filas_prev.get(paid, {}).get('Summary', '')})
+
+        if inicial:
+            # Sin manifest previo todas las guidelines aparecerían como cambiadas: se registra solo la línea base
+            df_diff = pd.DataFrame([{'Change': 'initial', 'PAID': '', 'ID': '', 'Summary': f"{len(data_rows)} guidelines"}], columns=['Change', 'PAID', 'ID', 'Summary'])
+            print(f"🔍 Ejecución inicial: el manifest se crea como línea base con {len(data_rows)} guidelines, sin diff.")
+        else:
+            df_diff = pd.DataFrame(cambios, columns=['Change', 'PAID', 'ID', 'Summary'])
+            resumen = df_diff['Change'].value_counts()
+            print(f"🔍 Cambios: {resumen.get('added', 0)} añadidas, {resumen.get('changed', 0)} modificadas, {resumen.get('removed', 0)} eliminadas.")
+
+        columnas = ['ID', 'Source', 'PAID', 'Summary', 'Phenotype', 'Genotype', 'Recommendation', 'Avoid', 'Alternate', 'Dosing', 'Gene', 'Drug', 'GeneID', 'DrugID']
+        df_final = pd.DataFrame(data_rows, columns=columnas)
 
         print(f"✅ Procesados {len(df_final)} registros de {', '.join(target_sources)}.")
         
         if df_final.empty:
-            return pd.DataFrame()
+            return pd.DataFrame(), None, df_diff
 
         # Rellenar vacíos
         df_final.fillna("", inplace=True)
         
-        return df_final
+        return df_final, manifest, df_diff
 
     except requests.exceptions.RequestException as e:
         print(f"❌ Error de conexión descargando Guidelines ZIP: {e}")
-        return pd.DataFrame()
+        return pd.DataFrame(), None, pd.DataFrame()
     except Exception as e:
         print(f"❌ Error procesando Guidelines: {e}")
-        return pd.DataFrame()
+        return pd.DataFrame(), None, pd.DataFrame()
 
 def regenerar_guidelinerules(df_new_guidelines):
     """
@@ -267,12 +386,19 @@ def main():
     print("\n------------------------------------------------\n")
 
     # 2. Procesar Guidelines
-    df_guide = actualizar_guidelines()
+    df_guide, manifest, df_diff = actualizar_guidelines()
     
     if not df_guide.empty:
-        archivo_guide = f"{output_dir}GuidelineMerge_Review.csv"
-        df_guide.to_csv(archivo_guide, index=False)
-        print(f"✅ GuidelineMerge generado exitosamente: {archivo_guide} ({len(df_guide)} registros)")
+        df_guide.to_csv(guideline_review, index=False)
+        # El manifest se guarda después del CSV para que nunca describa un CSV que no se escribió
+        guardar_manifest(manifest)
+        print(f"✅ GuidelineMerge generado exitosamente: {guideline_review} ({len(df_guide)} registros)")
+        archivo_diff = f"{output_dir}GuidelineMerge_Diff.csv"
+        df_diff.to_csv(archivo_diff, index=False)
+        if 'initial' in df_diff['Change'].values:
+            print(f"✅ Resumen de cambios para revisión: {archivo_diff} (ejecución inicial)")
+        else:
+            print(f"✅ Resumen de cambios para revisión: {archivo_diff} ({len(df_diff)} cambios)")
 
         # 3. Regenerar GuidelineRule (Solo si tenemos Guidelines nuevos)
         print("\n------------------------------------------------\n")
@@ -2,19 +2,86 @@
 # -*- coding: UTF-8 -*-
 
 
-import sqlite3, os, re
+from panno.genotype_resolution import GENE_LIST, MULTI_VAR_GENES, HLA_GENES
+from contextlib import contextmanager
+import sqlite3, os, re, queue, threading, urllib.parse
 import pandas as pd
 import numpy as np
 
 
-def annotation(dic_diplotype, dic_rs2gt, hla_subtypes):
+class ConnectionPool(object):
+  ## Read-only connections to the knowledge base, shared by threads; each connection is used by one thread at a time.
+  ## The database is opened immutable: update_database publishes a new file with a rename instead of writing the
+  ## live one, so an open connection keeps reading the version it was opened on. Call close() to pick up a new one.
+  def __init__(self, pgx_kb_fp, size=4):
+    self.uri = 'file:%s?mode=ro&immutable=1' % urllib.parse.quote(os.path.abspath(pgx_kb_fp))
+    self.size = size
+    self.idle = queue.LifoQueue()
+    self.opened = 0
+    self.lock = threading.Lock()
   
-  ## Connected database
-  pgx_kb_fp = os.path.join(os.path.dirname(__file__), 'assets/pgx_kb.sqlite3')
-  # pgx_kb_fp = "./panno/assets/pgx_kb.sqlite3"
-  conn = sqlite3.connect(pgx_kb_fp)
-  cursor = conn.cursor()
+  @contextmanager
+  def connection(self):
+    try:
+      conn = self.idle.get_nowait()
+    except queue.Empty:
+      with self.lock:
+        create = self.opened < self.size
+        if create:
+          self.opened += 1
+      if create:
+        try:
+          conn = sqlite3.connect(self.uri, uri=True, check_same_thread=False)
+        except Exception:
+          with self.lock:
+            self.opened -= 1
+          raise
+      else:
+        # All connections are in use: wait for one to be returned
+        conn = self.idle.get()
+    try:
+      yield conn
+    finally:
+      self.idle.put(conn)
   
+  def close(self):
+    ## Close the idle connections; the ones in use return to the pool when released and stay open
+    while True:
+      try:
+        conn = self.idle.get_nowait()
+      except queue.Empty:
+        break
+      conn.close()
+      with self.lock:
+        self.opened -= 1
+
+
+pools = {}
+pools_lock = threading.Lock()
+
+
+def get_pool(pgx_kb_fp=None):
+  ## One pool per database file, created on first use
+  if pgx_kb_fp is None:
+    pgx_kb_fp = os.path.join(os.path.dirname(__file__), 'assets/pgx_kb.sqlite3')
+  # pgx_kb_fp = "./panno/assets/pgx_kb.sqlite3"
+  key = os.path.abspath(pgx_kb_fp)
+  with pools_lock:
+    if key not in pools:
+      pools[key] = ConnectionPool(key)
+    return(pools[key])
+
+
+def load_tables(pgx_kb_fp=None):
+  ## Read the knowledge base tables used by annotation once, so that they can be reused across samples
+  with get_pool(pgx_kb_fp).connection() as conn:
+    cursor = conn.cursor()
+    tables = read_tables(cursor)
+    cursor.close()
+  return(tables)
+
+
+def read_tables(cursor):
   # DiplotypePhenotype
   dip_phe = cursor.execute("SELECT Gene, Allele1, Allele2, ActivityScore, Phenotype FROM DiplotypePhenotype;")
   dip_phe = cursor.fetchall()
@@ -26,6 +93,60 @@ def annotation(dic_diplotype, dic_rs2gt, hla_subtypes):
   rule = cursor.execute("SELECT Gene, Variant, Allele1, Allele2, Phenotype, GuidelineID FROM GuidelineRule;")
   rule = cursor.fetchall()
   rule_df = pd.DataFrame(rule, columns=['Gene', 'Variant', 'Allele1', 'Allele2', 'Phenotype', 'GuidelineID'])
+  # HLA alleles and rsIDs with clinical annotations
+  hla_list = cursor.execute("SELECT DISTINCT Gene, Allele1 FROM ClinAnn WHERE Gene LIKE 'HLA%' AND EvidenceLevel != 3;")
+  hla_list = cursor.fetchall()
+  rsid_anno = cursor.execute('SELECT DISTINCT Gene, Variant FROM ClinAnn WHERE EvidenceLevel != 3 AND Variant LIKE "rs%" AND (Gene != "IFNL3" OR Variant != "rs12979860");')
+  rsid_anno = cursor.fetchall()
+  rsid_anno_df = pd.DataFrame(rsid_anno, columns = ['Gene', 'Variant'])
+  # ClinAnn
+  ann = cursor.execute("SELECT * FROM ClinAnn WHERE EvidenceLevel != '3';")# OR (Gene IN (SELECT Gene FROM GuidelineMerge) AND Drug IN (SELECT Drug FROM GuidelineMerge));")
+  ann = cursor.fetchall()
+  ann_df = pd.DataFrame(ann, columns=['ID', 'CAID', 'Gene', 'Variant', 'Allele1', 'Allele2', 'Annotation1', 'Annotation2', 'Function1', 'Function2', 'Score1', 'Score2', 'CPICPhenotype', 'PAnnoPhenotype', 'Drug', 'Phenotypes', 'EvidenceLevel', 'LevelOverride', 'LevelModifier', 'Score', 'PMIDCount', 'EvidenceCount', 'Specialty', 'PhenotypeCategory'])
+  ann_df.PhenotypeCategory = ann_df.PhenotypeCategory.replace('Metabolism/PK', 'Metabolism')
+  
+  return({'dip_phe': dip_phe_df, 'guide': guide_df, 'rule': rule_df, 'hla_list': hla_list, 'rsid_anno': rsid_anno_df, 'ann': ann_df})
+
+
+def restrict_tables(tables, drugs=None, genes=None):
+  ## Keep the guidelines, rules and clinical annotations of the given drugs and genes only, and the variants they refer to.
+  ## Names are matched case-insensitively. Raises ValueError for a drug or gene unknown to the knowledge base.
+  guide_df = tables['guide']; rule_df = tables['rule']; ann_df = tables['ann']
+  if drugs is not None:
+    names = {drug.lower(): drug for drug in set(guide_df.Drug) | set(ann_df.Drug)}
+    unknown = [drug.strip() for drug in drugs if drug.strip().lower() not in names]
+    if unknown:
+      raise ValueError('No guideline or clinical annotation of %s in the knowledge base.' % ', '.join(unknown))
+    drugs = [names[drug.strip().lower()] for drug in drugs]
+    guide_df = guide_df[guide_df.Drug.isin(drugs)]
+    ann_df = ann_df[ann_df.Drug.isin(drugs)]
+  if genes is not None:
+    genes = [gene.strip().upper() for gene in genes]
+    known = set(GENE_LIST) | set(HLA_GENES) | set(tables['guide'].Gene) | set(tables['ann'].Gene)
+    unknown = [gene for gene in genes if gene not in known]
+    if unknown:
+      raise ValueError('No diplotype definition, guideline or clinical annotation of %s in the knowledge base.' % ', '.join(unknown))
+    guide_df = guide_df[guide_df.Gene.isin(genes)]
+    rule_df = rule_df[rule_df.Gene.isin(genes)]
+    ann_df = ann_df[ann_df.Gene.isin(genes)]
+  rule_df = rule_df[rule_df.GuidelineID.isin(guide_df.ID)]
+  rsid_anno_df = tables['rsid_anno'].merge(ann_df[['Gene', 'Variant']].drop_duplicates(), on=['Gene', 'Variant'])
+  hla_alleles = set(zip(ann_df.Gene, ann_df.Allele1))
+  hla_list = [item for item in tables['hla_list'] if item in hla_alleles]
+  return({'dip_phe': tables['dip_phe'], 'guide': guide_df, 'rule': rule_df, 'hla_list': hla_list, 'rsid_anno': rsid_anno_df, 'ann': ann_df})
+
+
+def table_genes(tables):
+  ## Genes referred to by the guideline rules and clinical annotations of the tables
+  return(set(tables['rule'].Gene) | set(tables['ann'].Gene))
+
+
+def annotation(dic_diplotype, dic_rs2gt, hla_subtypes, tables=None):
+  
+  ## Knowledge base tables, read from the database unless loaded beforehand with load_tables
+  if tables is None:
+    tables = load_tables()
+  dip_phe_df = tables['dip_phe']; guide_df = tables['guide']; rule_df = tables['rule']
   rule_df1 = rule_df[rule_df.Allele2 != '']
   rule_df2 = rule_df[rule_df.Allele2 == '']
   
@@ -63,10 +184,12 @@ def annotation(dic_diplotype, dic_rs2gt, hla_subtypes):
   for rsid in rsids:
     if rsid in dic_rs2gt.keys():
       allele1 = dic_rs2gt[rsid][0]; allele2 = dic_rs2gt[rsid][1]
-      res = pd.concat([rule_df1[(rule_df1.Gene == gene) & (rule_df1.Allele1 == allele1) & (rule_df1.Allele2 == allele2)], rule_df1[(rule_df1.Gene == gene) & (rule_df1.Allele1 == allele2) & (rule_df1.Allele2 == allele1)]], axis = 0)
+      # The rules of this rsID, rather than of the gene last matched above
+      rsid_rule = rule_df1[rule_df1.Variant == rsid]
+      res = pd.concat([rsid_rule[(rsid_rule.Allele1 == allele1) & (rsid_rule.Allele2 == allele2)], rsid_rule[(rsid_rule.Allele1 == allele2) & (rsid_rule.Allele2 == allele1)]], axis = 0)
       matched_ids.extend(res.GuidelineID.to_list())
       if res.empty is False:
-        detected_allele.append([gene, res.Variant.to_list()[0], '%s%s' % (allele1, allele2), res.Phenotype.to_list()[0]])
+        detected_allele.append([res.Gene.to_list()[0], res.Variant.to_list()[0], '%s%s' % (allele1, allele2), res.Phenotype.to_list()[0]])
   
   # 3. HLA
   detected_hla = []
@@ -115,9 +238,11 @@ def annotation(dic_diplotype, dic_rs2gt, hla_subtypes):
   
   ###--------- Section 3: Diplotype Detail ---------###
   ## MultiVar
-  multi = ["CACNA1S", "CFTR", "CYP2B6", "CYP2C8", "CYP2C9", "CYP2C19", "CYP2D6", "CYP3A4", "CYP3A5", "CYP4F2", "DPYD", "NUDT15", "RYR1", "SLCO1B1", "TPMT", "UGT1A1"]
   multi_df = []
-  for gene in multi:
+  for gene in MULTI_VAR_GENES:
+    # Genes left out of the prediction, e.g. when the tables are restricted to some drugs or genes
+    if gene not in dic_diplotype:
+      continue
     gene_detail = dic_diplotype[gene]['detail']
     for pos_res in gene_detail:
       # chrom, pos, nc, ng, rs, pc, identified_allele, detected_allele
@@ -128,9 +253,7 @@ def annotation(dic_diplotype, dic_rs2gt, hla_subtypes):
   
   ## SingleVar
   # 1. HLA
-  hla_list = cursor.execute("SELECT DISTINCT Gene, Allele1 FROM ClinAnn WHERE Gene LIKE 'HLA%' AND EvidenceLevel != 3;")
-  hla_list = cursor.fetchall()
-  for item in hla_list:
+  for item in tables['hla_list']:
     gene = item[0]; var = item[1]
     if var in hla_subtypes[gene].keys():
       if hla_subtypes[gene][var] == 0:
@@ -149,9 +272,7 @@ def annotation(dic_diplotype, dic_rs2gt, hla_subtypes):
   detected_hla_df = pd.DataFrame(detected_hla, columns=['Gene', 'Variant', 'Variant Call', 'Phenotype']).drop(columns=['Phenotype'])
   
   # 1. SNP/Indel
-  rsid_anno = cursor.execute('SELECT DISTINCT Gene, Variant FROM ClinAnn WHERE EvidenceLevel != 3 AND Variant LIKE "rs%" AND (Gene != "IFNL3" OR Variant != "rs12979860");')
-  rsid_anno = cursor.fetchall()
-  rsid_anno_df = pd.DataFrame(rsid_anno, columns = ['Gene', 'Variant'])
+  rsid_anno_df = tables['rsid_anno']
   rsid_guide_df = rule_df[rule_df.Variant.str.startswith('rs')][['Gene', 'Variant']]
   rsid_df = pd.concat([rsid_anno_df, rsid_guide_df], axis = 0).drop_duplicates().reset_index(drop = True)
   rsid_df.insert(2, 'Variant Call', 'Missing')
@@ -166,17 +287,17 @@ def annotation(dic_diplotype, dic_rs2gt, hla_subtypes):
   
   
   ######## Find ClinAnn and extract the table
-  ann = cursor.execute("SELECT * FROM ClinAnn WHERE EvidenceLevel != '3';")# OR (Gene IN (SELECT Gene FROM GuidelineMerge) AND Drug IN (SELECT Drug FROM GuidelineMerge));")
-  ann = cursor.fetchall()
-  ann_df = pd.DataFrame(ann, columns=['ID', 'CAID', 'Gene', 'Variant', 'Allele1', 'Allele2', 'Annotation1', 'Annotation2', 'Function1', 'Function2', 'Score1', 'Score2', 'CPICPhenotype', 'PAnnoPhenotype', 'Drug', 'Phenotypes', 'EvidenceLevel', 'LevelOverride', 'LevelModifier', 'Score', 'PMIDCount', 'EvidenceCount', 'Specialty', 'PhenotypeCategory'])
-  ann_df.PhenotypeCategory = ann_df.PhenotypeCategory.replace('Metabolism/PK', 'Metabolism')
+  ann_df = tables['ann']
   
   # 0. Filter rs12979860 (IFNL3 and IFNL4)
   rm_index = ann_df[(ann_df.Variant == 'rs12979860') & (ann_df.Gene == 'IFNL3')].ID.to_list()
   ann_df = ann_df[ann_df.ID.isin(rm_index) == False]
   
   # 1. Filter by variant
-  ann_df_retain = pd.DataFrame()
+  # Starts with the columns of the matches, which it keeps when nothing matches
+  ann_df_retain = ann_df.iloc[:0].copy()
+  ann_df_retain.insert(0, 'VariantNew', '')
+  ann_df_retain.insert(1, 'Diplotype', '')
   for index, row in single_var.iterrows():
     if row['Variant Call'] != 'Missing':
       if row['Variant'].startswith('rs'):
@@ -189,6 +310,8 @@ def annotation(dic_diplotype, dic_rs2gt, hla_subtypes):
         res = ann_df[(ann_df.Gene == row.Gene) & ((ann_df.Allele1 == row.Variant) | (ann_df.Allele2 == row.Variant))]
         res.insert(0, 'VariantNew', row['Variant'])
         res.insert(1, 'Diplotype', row['Variant Call'])
+      else:
+        continue
       ann_df_retain = pd.concat([ann_df_retain, res])
   
   for index, row in multi_var[['Gene', 'Diplotype']].drop_duplicates().iterrows():
@@ -241,7 +364,4 @@ def annotation(dic_diplotype, dic_rs2gt, hla_subtypes):
   ###--------- Section 5: Clinical Annotation ---------###
   clinical_anno = ann_df_retain[['Drug', 'Gene', 'VariantNew', 'Diplotype', 'PhenotypeCategory', 'EvidenceLevel', 'PAnnoPhenotype', 'CAID']].rename(columns={'VariantNew': 'Variant'}).drop_duplicates().sort_values(by=['Drug'])
   
-  cursor.close()
-  conn.close()
-  
   return(summary, prescribing_info, multi_var, single_var, phenotype_predict, clinical_anno)
@@ -0,0 +1,190 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+
+import json, gzip, glob, os, time
+
+# State of an aggregate, kept next to its tables so that later batches are added to it
+STATE_FILE = 'aggregate.state.json'
+CATEGORIES = ['Avoid', 'Caution', 'Routine']
+
+
+def sample_record(sample_id, population, dic_diplotype, summary, prescribing_info, multi_var, single_var):
+  ## Compact per-sample result consumed by `panno aggregate`: one JSON object per line
+  phenotype = {}
+  for gene, phe in zip(prescribing_info.Gene, prescribing_info.Phenotype):
+    phenotype.setdefault(gene, phe)
+  loci = []
+  for gene, position, call in zip(multi_var.Gene, multi_var.Position, multi_var['Variant Call']):
+    loci.append([gene, position, int(call == 'Missing')])
+  for gene, variant, call in zip(single_var.Gene, single_var.Variant, single_var['Variant Call']):
+    loci.append([gene, variant, int(call == 'Missing')])
+  record = {'sample_id': sample_id, 'population': population,
+            'diplotype': {gene: res['step2_res'] for gene, res in dic_diplotype.items()},
+            'phenotype': phenotype,
+            'drug': {cat: summary[cat] for cat in CATEGORIES},
+            'loci': loci}
+  return(record)
+
+
+def write_record(record, fp, append=False):
+  with open(fp, 'a' if append else 'w', encoding="utf-8") as f:
+    print(json.dumps(record, separators=(',', ':')), file=f)
+
+
+def read_records(paths):
+  ## Records of the given files, or of the *.PAnno.json(.gz) files in the given directories, one line at a time
+  for path in paths:
+    if os.path.isdir(path):
+      fps = sorted(glob.glob(os.path.join(path, '*.PAnno.json')) + glob.glob(os.path.join(path, '*.PAnno.json.gz')))
+    else:
+      fps = [path]
+    for fp in fps:
+      opener = gzip.open if fp.endswith('.gz') else open
+      with opener(fp, 'rt', encoding="utf-8") as f:
+        for line in f:
+          if line.strip():
+            yield(json.loads(line))
+
+
+def new_state():
+  return({'samples': [], 'population': {}, 'diplotype': {}, 'phenotype': {}, 'drug': {}, 'loci': {}})
+
+
+def load_state(outdir):
+  fp = os.path.join(outdir, STATE_FILE)
+  if not os.path.exists(fp):
+    return(new_state())
+  with open(fp, encoding="utf-8") as f:
+    return(json.load(f))
+
+
+def save_state(state, outdir):
+  ## Replace the state in one rename, so that an interrupted run leaves the previous aggregate intact
+  fp = os.path.join(outdir, STATE_FILE)
+  tmp_fp = '%s.%d.tmp' % (fp, os.getpid())
+  with open(tmp_fp, 'w', encoding="utf-8") as f:
+    json.dump(state, f, separators=(',', ':'))
+  os.replace(tmp_fp, fp)
+
+
+def update_state(state, records):
+  ## Add each record to the counters and drop it; only the sample IDs are kept, to skip samples counted before
+  seen = set(state['samples'])
+  added = []; skipped = []
+  for record in records:
+    sample_id = record['sample_id']
+    if sample_id in seen:
+      skipped.append(sample_id)
+      continue
+    seen.add(sample_id)
+    state['samples'].append(sample_id)
+    added.append(sample_id)
+    state['population'][record['population']] = state['population'].get(record['population'], 0) + 1
+    for gene, dip in record['diplotype'].items():
+      counts = state['diplotype'].setdefault(gene, {})
+      counts[dip] = counts.get(dip, 0) + 1
+      phe = record['phenotype'].get(gene, '-')
+      counts = state['phenotype'].setdefault(gene, {})
+      counts[phe] = counts.get(phe, 0) + 1
+    for cat in CATEGORIES:
+      for drug in record['drug'][cat]:
+        counts = state['drug'].setdefault(drug, dict.fromkeys(CATEGORIES, 0))
+        counts[cat] += 1
+    for gene, locus, missing in record['loci']:
+      counts = state['loci'].setdefault('%s\t%s' % (gene, locus), [0, 0])
+      counts[0] += 1; counts[1] += missing
+  return(added, skipped)
+
+
+def frequency_rows(counts, n):
+  rows = []
+  for gene in sorted(counts.keys()):
+    for key, count in sorted(counts[gene].items(), key=lambda x: (-x[1], x[0])):
+      rows.append([gene, key, count, count/n])
+  return(rows)
+
+
+def tables(state):
+  ## Rows of the four aggregate tables, with their header
+  n = max(len(state['samples']), 1)
+  diplotype = [['Gene', 'Diplotype', 'Count', 'Frequency']] + frequency_rows(state['diplotype'], n)
+  phenotype = [['Gene', 'Phenotype', 'Count', 'Frequency']] + frequency_rows(state['phenotype'], n)
+  drug = [['Drug'] + CATEGORIES]
+  for name in sorted(state['drug'].keys()):
+    drug.append([name] + [state['drug'][name][cat] for cat in CATEGORIES])
+  loci = [['Gene', 'Locus', 'Samples', 'Missing', 'MissingRate']]
+  for key, (total, missing) in sorted(state['loci'].items(), key=lambda x: (-x[1][1]/x[1][0], x[0])):
+    gene, locus = key.split('\t')
+    loci.append([gene, locus, total, missing, missing/total])
+  return({'diplotype': diplotype, 'phenotype': phenotype, 'drug': drug, 'missing': loci})
+
+
+def format_cell(value):
+  if isinstance(value, float):
+    return('%.4f' % value)
+  return(str(value))
+
+
+def write_tables(state, outdir):
+  fps = []
+  for name, rows in tables(state).items():
+    fp = os.path.join(outdir, 'aggregate.%s.tsv' % name)
+    with open(fp, 'w', encoding="utf-8") as f:
+      for row in rows:
+        print('\t'.join(format_cell(x) for x in row), file=f)
+    fps.append(fp)
+  return(fps)
+
+
+def write_html(state, outdir):
+  fp = os.path.join(outdir, 'aggregate.PAnno.html')
+  css_fp = os.path.join(os.path.dirname(__file__), 'assets/custom.css')
+  sections = [('diplotype', 'Diplotype Frequency', 'Frequency of the diplotype predicted for each gene. Ambiguous calls are counted as the listed set of diplotypes.'),
+              ('phenotype', 'Phenotype Frequency', 'Frequency of the phenotype of each gene, as shown in the Prescribing Info of the sample reports.'),
+              ('drug', 'Prescribing Classification', 'Number of samples for which each drug is classified as Avoid use, Use with caution or Routine use.'),
+              ('missing', 'Missing Positions', 'Positions and variants absent from the VCF files of the samples. Only the ones missing in at least one sample are listed; all are in aggregate.missing.tsv.')]
+  populations = ', '.join('%s: %d' % (pop, count) for pop, count in sorted(state['population'].items()))
+  rows = tables(state)
+  with open(fp, 'w', encoding="utf-8") as f:
+    head = """
+    <!doctype html>
+    <html lang="en">
+    <head>
+      <meta charset="UTF-8">
+      <meta name="viewport" content="width=device-width, initial-scale=1">
+      <title>PAnno Aggregate Report</title>
+      <style type="text/css">%s</style>
+    </head>
+
+    <body>
+    <div class="main_page" style="margin-left:0;">
+    <h1><b>PAnno Aggregate Report</b></h1>
+    <blockquote>
+      <p style="font-size:0.95rem;">Samples: %d<br>Biogeographic Groups: %s<br>Report Time: %s</p>
+    </blockquote>
+    """
+    print(head % (open(css_fp).read(), len(state['samples']), populations, time.asctime(time.localtime(time.time()))), file=f)
+    for name, title, lead in sections:
+      print('<h2 id="%s"><b>%s</b></h2>' % (name, title), file=f)
+      print('<p class="main_lead">%s</p>' % lead, file=f)
+      body = rows[name][1:]
+      if name == 'missing':
+        body = [row for row in body if row[3] > 0]
+      header = '<table id="customer_table" border="1" cellspacing="0">\n<tr>%s</tr>' % ''.join('<th>%s</th>' % x for x in rows[name][0])
+      for row in body:
+        header = header + '\n<tr>%s</tr>' % ''.join('<td>%s</td>' % format_cell(x) for x in row)
+      header = header + '\n</table>'
+      print(header, file=f)
+    print('</div>\n</body>\n</html>', file=f)
+  return(fp)
+
+
+def aggregate(paths, outdir):
+  ## Add the records under paths to the aggregate in outdir (created when absent) and rewrite its tables
+  state = load_state(outdir)
+  added, skipped = update_state(state, read_records(paths))
+  save_state(state, outdir)
+  fps = write_tables(state, outdir)
+  fps.append(write_html(state, outdir))
+  return(added, skipped, fps)
@@ -0,0 +1,124 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+
+from panno import genotype_resolution, predict_diplotype, vcf_reader
+from contextlib import closing
+import re, os, sys
+import numpy as np
+import pandas as pd
+
+# Allele code of a no-call; like in the single-sample path, the record is then treated as absent for that sample
+NOCALL = -2
+
+
+def parse_cohort_vcf(cohort_vcf, loci, threads=None):
+  ## Records at PGx loci plus a sparse samples x records genotype matrix in coordinate form.
+  ## Only calls other than 0/0 are stored, since most samples are reference at most PGx loci.
+  samples = []
+  chroms = []; positions = []; ends = []; ids = []; refs = []; alts = []
+  rec_idx = []; sample_idx = []; gt1 = []; gt2 = []
+  chrom_names = {}
+  with closing(vcf_reader.open_vcf(cohort_vcf, threads, loci)) as file:
+    for line in file:
+      if line[0] == '#':
+        if line.startswith('#CHROM'):
+          samples = line.rstrip('\r\n').split('\t')[9:]
+        continue
+      raw_chrom, pos, rest = line.split('\t', 2)
+      chrom = chrom_names.get(raw_chrom)
+      if chrom is None:
+        chrom = chrom_names[raw_chrom] = re.sub('chr|Chr|CHR', '', raw_chrom)
+      pos = int(pos)
+      if not genotype_resolution.in_pgx_loci(loci, chrom, pos):
+        continue
+      info = line.rstrip('\r\n').split('\t')
+      gt_index = info[8].split(':').index('GT')
+      record = len(positions)
+      chroms.append(chrom); positions.append(pos); ends.append(genotype_resolution.record_end(pos, info[3], info[4], info[7]))
+      ids.append(sys.intern(info[2])); refs.append(sys.intern(info[3])); alts.append(sys.intern(info[4]))
+      for i, sample in enumerate(info[9:]):
+        gt = sample.split(':')[gt_index]
+        if gt == '0/0' or gt == '0|0':
+          continue
+        gts = re.split('/|\|', gt)
+        if '.' in gts:
+          a1 = a2 = NOCALL
+        elif len(gts) == 1:
+          a1 = int(gts[0]); a2 = genotype_resolution.HAPLOID
+        else:
+          a1 = int(gts[0]); a2 = int(gts[1])
+        rec_idx.append(record); sample_idx.append(i); gt1.append(a1); gt2.append(a2)
+
+  records = pd.DataFrame({'#CHROM': pd.Categorical(chroms), 'POS': np.array(positions, dtype='int32'),
+                          'END': np.array(ends, dtype='int32'), 'ID': ids, 'REF': refs, 'ALT': alts})
+  matrix = {'record': np.array(rec_idx, dtype='int32'), 'sample': np.array(sample_idx, dtype='int32'),
+            'GT1': np.array(gt1, dtype='int8'), 'GT2': np.array(gt2, dtype='int8')}
+  return(samples, records, matrix)
+
+
+def gene_records(records, info):
+  ## Indexes of the records that parse_input_allele would look at for this gene: defined positions or rsIDs
+  positions = set(); rsids = set()
+  for source_pos in info['haplotype_definition'][info['reference_haplotype']].keys():
+    pos_rs = source_pos.split(':')
+    tmp = pos_rs[0].split('-')
+    positions.update(range(int(tmp[0]), int(tmp[-1])+1))
+    rsids.add(pos_rs[1])
+  on_chrom = records['#CHROM'] == info['chrom']
+  selected = on_chrom & (records.POS.isin(positions) | records.ID.isin(rsids))
+  return(np.flatnonzero(selected.to_numpy()))
+
+
+def call_gene(samples, records, matrix, info, race):
+  ## Dense samples x (GT1, GT2 of each gene record) block, grouped into distinct genotype patterns
+  idx = gene_records(records, info)
+  block = np.zeros((len(samples), 2 * len(idx)), dtype='int8')
+  stored = np.isin(matrix['record'], idx)
+  cols = np.searchsorted(idx, matrix['record'][stored])
+  block[matrix['sample'][stored], 2 * cols] = matrix['GT1'][stored]
+  block[matrix['sample'][stored], 2 * cols + 1] = matrix['GT2'][stored]
+  if len(idx) > 0:
+    patterns, inverse = np.unique(block, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+  else:
+    patterns, inverse = block[:1], np.zeros(len(samples), dtype='int64')
+
+  ## Score each distinct (pattern, population) once with the single-sample model
+  sub = records.iloc[idx]
+  races = [race[sample] for sample in samples] if isinstance(race, dict) else [race] * len(samples)
+  scored = {}
+  rows = []
+  for sample, pattern_id, sample_race in zip(samples, inverse, races):
+    key = (pattern_id, sample_race)
+    if key not in scored:
+      gts = patterns[pattern_id].reshape(-1, 2)
+      called = gts[:, 0] != NOCALL
+      frame = sub[called].assign(GT1 = gts[called, 0], GT2 = gts[called, 1])
+      scored[key] = predict_diplotype.predict_gene(frame, sample_race, info)
+    res = scored[key]
+    rows.append([sample, res['step2_res'], res['step1_res'], res['exact_res'], pattern_id])
+
+  return(pd.DataFrame(rows, columns=['Sample', 'Diplotype', 'Step1', 'Exact', 'Pattern']))
+
+
+def call_cohort(cohort_vcf, race, gene_list=None, threads=None):
+  ## race is one biogeographic group for the whole cohort, or a dict of sample -> group
+  if gene_list is None:
+    gene_list = genotype_resolution.GENE_LIST
+  panno_bed, loci = genotype_resolution.load_pgx_loci()
+  samples, records, matrix = parse_cohort_vcf(cohort_vcf, loci, threads)
+  panno_dip_base = predict_diplotype.load_definitions()
+  cohort_diplotype = {}
+  for gene in gene_list:
+    cohort_diplotype[gene] = call_gene(samples, records, matrix, panno_dip_base[gene], race)
+  return(cohort_diplotype)
+
+
+def write_tables(cohort_diplotype, outdir):
+  fps = []
+  for gene, table in cohort_diplotype.items():
+    fp = os.path.join(outdir, "%s.diplotype.tsv" % gene)
+    table.to_csv(fp, sep='\t', index=False)
+    fps.append(fp)
+  return(fps)
@@ -2,96 +2,259 @@
 # -*- coding: UTF-8 -*-
 
 
-from panno import predict_diplotype
-import re, os, pyranges
+from panno import predict_diplotype, vcf_reader
+from panno.log import logger
+from contextlib import closing
+import re, os, sys, bisect
+import numpy as np
 import pandas as pd
 
-def resolution(race, germline_vcf):
-  
-  panno_bed_fp = os.path.join(os.path.dirname(__file__), 'assets/pgx_loci.bed')
-  # panno_bed_fp='./panno/assets/pgx_loci.bed'
-  ## Filter loci based on PharmGKB's bed file: delete all loci in the user's vcf that are not in the panno.bed file
-  ## Extract the user's bed file: skip the lines starting with '##'
-  vcf = []
-  vcf_bed = []
-  with open(germline_vcf, "r", encoding = "utf-8") as file:
-    for line in file:
-      if 'CHROM' in line:
-        colnames = line.strip().split('\t')
-      if line[0] != '#':
-        info = line.strip().split('\t')
-        vcf.append(info)
-        vcf_bed.append([info[0], info[1], info[1]])
-  
-  vcf_bed_df = pd.DataFrame(vcf_bed, columns=['Chromosome', 'Start', 'End'])
-  panno_bed = pd.read_csv(panno_bed_fp, sep="\t", names=['Chromosome', 'Start', 'End', 'rsid'])
-  vcf_bed_df['Chromosome'] = vcf_bed_df['Chromosome'].map(lambda x: re.sub('chr|Chr|CHR', '', x)).astype('str')
-  panno_bed['Chromosome'] = panno_bed['Chromosome'].map(lambda x: re.sub('chr|Chr|CHR', '', x)).astype('str')
-  
-  ## Filter the BED of the input VCF based on the overlap with PAnno BED
-  gr1, gr2 = pyranges.PyRanges(vcf_bed_df), pyranges.PyRanges(panno_bed.iloc[:,:3])
-  # pyranges will not process the item with equal start and end, which is different from pybedtools
-  gr1.End, gr2.End = gr1.End + 1, gr2.End + 1
-  filter_bed = gr1.overlap(gr2).df
-  filter_bed.End = filter_bed.End - 1
-  
-  ## Convert the input VCF into a data frame and filter it
-  vcf_df = pd.DataFrame(vcf, columns=colnames)
-  vcf_df.loc[:,'#CHROM'] = vcf_df['#CHROM'].map(lambda x: re.sub('chr|Chr|CHR', '', x)).astype('str')
-  vcf_df.loc[:,colnames[1]] = vcf_df[colnames[1]].astype('int32')
-  filter_bed = filter_bed.iloc[:, 0:2].rename(columns={'Chromosome': colnames[0], 'Start': colnames[1]})
-  filtered_vcf = pd.merge(vcf_df, filter_bed, how='inner', on=colnames[:2])
-  
-  ## Class 1: Diplotype
-  gene_list = ["G6PD", "MT-RNR1", "ABCG2", "CACNA1S", "CFTR", "IFNL3", "VKORC1", "RYR1",
-              "CYP2B6", "CYP2C8", "CYP2C9", "CYP2C19", "CYP2D6",
-              "CYP3A4", "CYP3A5", "CYP4F2", "DPYD", "NUDT15",
-              "SLCO1B1", "TPMT", "UGT1A1"]
-  dic_diplotype = predict_diplotype.predict(filtered_vcf, race, gene_list)
-  ## Class 2: HLA genes
-  hla_subtypes = {"HLA-A": {}, "HLA-B": {}, "HLA-C": {}, "HLA-DRB1": {}, "HLA-DPB1": {}}
-  ## Class 3: Genotypes of detected positions
+# Allele code stored in GT2 when the call is haploid (chrX, chrY, chrM)
+HAPLOID = -1
+
+# ALT of a gVCF reference block (GATK and bcftools notation)
+REF_BLOCK_ALTS = ('<NON_REF>', '<*>')
+
+# Genes whose diplotypes are predicted
+GENE_LIST = ["G6PD", "MT-RNR1", "ABCG2", "CACNA1S", "CFTR", "IFNL3", "VKORC1", "RYR1",
+             "CYP2B6", "CYP2C8", "CYP2C9", "CYP2C19", "CYP2D6",
+             "CYP3A4", "CYP3A5", "CYP4F2", "DPYD", "NUDT15",
+             "SLCO1B1", "TPMT", "UGT1A1"]
+# Genes whose diplotypes are detailed position by position (multi-variant alleles)
+MULTI_VAR_GENES = ["CACNA1S", "CFTR", "CYP2B6", "CYP2C8", "CYP2C9", "CYP2C19", "CYP2D6", "CYP3A4", "CYP3A5", "CYP4F2",
+                   "DPYD", "NUDT15", "RYR1", "SLCO1B1", "TPMT", "UGT1A1"]
+# Genes with a section in the Diplotype Detail of the report
+REPORT_GENES = ["CYP2B6", "CYP2C8", "CYP2C9", "CYP2C19", "CYP2D6", "CYP3A4", "CYP3A5", "CYP4F2", "DPYD", "NUDT15",
+                "SLCO1B1", "TPMT", "UGT1A1"]
+# HLA genes whose alleles are read from the VCF (e.g. HLA-B*57:01:01 as CHROM)
+HLA_GENES = ["HLA-A", "HLA-B", "HLA-C", "HLA-DRB1", "HLA-DPB1"]
+
+
+def read_genes(genes):
+  ## Genes of a targeted panel: a panel file, with one gene per line in the first column (text after '#' is ignored),
+  ## or genes separated by commas
+  if os.path.isfile(genes):
+    with open(genes) as f:
+      genes = [line.split('#')[0].split('\t')[0] for line in f]
+  else:
+    genes = genes.split(',')
+  return([gene.strip().upper() for gene in genes if gene.strip()])
+
+
+def reference_alleles(definitions):
+  ## GRCh38 base at the SNV positions of every gene, read from the genomic HGVS of its reference haplotype (e.g. g.94761900C>T)
+  expected = {}
+  for gene, info in definitions.items():
+    for source_pos, display in info['haplotype_definition_display'][info['reference_haplotype']].items():
+      matchobj = re.match(r'g\.(\d+)([ACGT])>', display.split(':')[2])
+      if matchobj and matchobj.group(1) == source_pos.split(':')[0]:
+        expected[(info['chrom'], int(matchobj.group(1)))] = matchobj.group(2)
+  return(expected)
+
+
+def reference_index(filtered_vcf):
+  ## Interval index of the positions confidently called as reference (0/0 records, mostly gVCF reference blocks) by chromosome,
+  ## as in predict_diplotype.parse_input_allele: the starts, the furthest END among the calls starting at or before each start,
+  ## and whether the call reaching that END is haploid
+  ref_calls = filtered_vcf[(filtered_vcf.GT1 == 0) & (filtered_vcf.GT2 <= 0)].sort_values('POS')
+  index = {}
+  for chrom, sub in ref_calls.groupby('#CHROM', observed=True):
+    ends = sub.END.to_numpy()
+    max_ends = np.maximum.accumulate(ends)
+    reaching = np.maximum.accumulate(np.where(ends == max_ends, np.arange(len(ends)), 0))
+    index[chrom] = (sub.POS.to_numpy(), max_ends, sub.GT2.to_numpy()[reaching] == HAPLOID)
+  return(index)
+
+
+def reference_call(index, chrom, pos):
+  ## None when no reference call of reference_index covers pos, otherwise whether the call is haploid
+  if chrom not in index:
+    return(None)
+  starts, ends, haploid = index[chrom]
+  i = np.searchsorted(starts, pos, side='right') - 1
+  if i < 0 or ends[i] < pos:
+    return(None)
+  return(bool(haploid[i]))
+
+
+def rs_genotypes(filtered_vcf, panno_bed, expected):
+  ## Genotype of the rsIDs of the PGx loci, as a (allele1, allele2) tuple ('' for the second allele of a haploid call).
+  ## An rsID is called by a record starting at its position or carrying its ID; without one, an SNV covered by a
+  ## reference call (a gVCF reference block) is called as reference, with the GRCh38 base of expected (from reference_alleles).
   dic_rs2gt = {}
-  format_index = colnames.index("FORMAT")
-  # Reload panno_bed
+  # rsIDs of the PGx loci, by position and as a whole
   panno_bed_rsid = panno_bed.dropna()
-  for index, row in filtered_vcf.iterrows():
-    info = row.to_list()
-    format = info[format_index].split(":")
-    gt_index = format.index("GT")
-    gt = info[-1].split(":")[gt_index]
-    if re.findall('0', gt) == ['0', '0']:
-      genotype = 0
-    elif re.findall('0', gt) == ['0']:
-      genotype = 1
-    else:
-      genotype = 2
-    # HLA genes
-    if row[0].startswith('HLA'):
-      gene = row[0].split('*')[0]
-      if gene in hla_subtypes.keys():
-        hla_subtypes[gene].update({'*%s' % row[0].split('*')[1]: genotype})
-      # hla_subtypes[row[0]] = genotype
+  pos_rsids = {}
+  for chrom, start, rsid in zip(panno_bed_rsid.Chromosome, panno_bed_rsid.Start, panno_bed_rsid.rsid):
+    pos_rsids.setdefault((chrom, start), []).append(rsid)
+  all_rsids = set(panno_bed_rsid.rsid)
+  for chrom, pos, id, ref, alt, a1, a2 in zip(filtered_vcf['#CHROM'], filtered_vcf.POS, filtered_vcf.ID, filtered_vcf.REF, filtered_vcf.ALT, filtered_vcf.GT1, filtered_vcf.GT2):
     # If the variant was within the clinical relevant list, add it into dis_rs2gt
-    tmp = panno_bed_rsid[(panno_bed_rsid.Chromosome == info[0]) & (panno_bed_rsid.Start == info[1])].rsid.to_list()
-    if tmp != []:
-      rsids = tmp
-    elif info[2] in panno_bed_rsid.rsid.to_list(): # The genome coordinates of a rsID may not complete.
-      rsids = [info[2]]
+    if (chrom, pos) in pos_rsids:
+      rsids = pos_rsids[(chrom, pos)]
+    elif id in all_rsids: # The genome coordinates of a rsID may not complete.
+      rsids = [id]
     else:
       rsids = None
-    
+
     if rsids:
-      ref = info[3]
-      alts = info[4].split(',')
-      alleles = [ref] + alts
-      var = []
-      for g in re.split('\||/', gt):
-        var.append(alleles[int(g)])
+      alleles = [ref] + alt.split(',')
+      var = [alleles[a1]]
+      # Variants in chrX, chrY
+      if a2 == HAPLOID:
+        var.append('')
+      else:
+        var.append(alleles[a2])
       for rsid in rsids:
-        # Variants in chrX, chrY
-        if len(var) == 1:
-          var.append('')
         dic_rs2gt[rsid] = tuple(var)
-  
-  return(dic_diplotype, dic_rs2gt, hla_subtypes)
\ No newline at end of file
+
+  # The REF of a reference block is the base at its start only, the base of a covered position comes from expected
+  ref_index = reference_index(filtered_vcf)
+  for chrom, start, end, rsid in zip(panno_bed_rsid.Chromosome, panno_bed_rsid.Start, panno_bed_rsid.End, panno_bed_rsid.rsid):
+    if rsid in dic_rs2gt or start != end or (chrom, start) not in expected:
+      continue
+    haploid = reference_call(ref_index, chrom, start)
+    if haploid is not None:
+      base = expected[(chrom, start)]
+      dic_rs2gt[rsid] = (base, '' if haploid else base)
+  return(dic_rs2gt)
+
+
+def load_pgx_loci():
+  panno_bed_fp = os.path.join(os.path.dirname(__file__), 'assets/pgx_loci.bed')
+  # panno_bed_fp='./panno/assets/pgx_loci.bed'
+  panno_bed = pd.read_csv(panno_bed_fp, sep="\t", names=['Chromosome', 'Start', 'End', 'rsid'])
+  panno_bed['Chromosome'] = panno_bed['Chromosome'].map(lambda x: re.sub('chr|Chr|CHR', '', x)).astype('str')
+  ## Merge the loci of each chromosome into sorted, non-overlapping intervals, so that a VCF record can be tested with one bisect
+  loci = {}
+  for chrom, sub in panno_bed.sort_values(by=['Chromosome', 'Start']).groupby('Chromosome'):
+    starts = []; ends = []
+    for start, end in zip(sub.Start.to_list(), sub.End.to_list()):
+      if ends and start <= ends[-1] + 1:
+        ends[-1] = max(ends[-1], end)
+      else:
+        starts.append(start); ends.append(end)
+    loci[chrom] = (starts, ends)
+  return(panno_bed, loci)
+
+
+def in_pgx_loci(loci, chrom, pos):
+  # A record is within a locus when start <= pos <= end
+  intervals = loci.get(chrom)
+  if intervals is None:
+    return(False)
+  i = bisect.bisect_right(intervals[0], pos) - 1
+  return(i >= 0 and pos <= intervals[1][i])
+
+
+def overlaps_pgx_loci(loci, chrom, start, end):
+  # Some locus has start <= end and end >= start
+  intervals = loci.get(chrom)
+  if intervals is None:
+    return(False)
+  i = bisect.bisect_right(intervals[0], end) - 1
+  return(i >= 0 and start <= intervals[1][i])
+
+
+def record_end(pos, ref, alt, info):
+  ## Last position covered by a record: END of a gVCF reference block, otherwise the end of REF
+  if alt in REF_BLOCK_ALTS:
+    matchobj = re.search(r'(?:^|;)END=(\d+)', info)
+    if matchobj:
+      return(int(matchobj.group(1)))
+  return(pos + len(ref) - 1)
+
+
+def pgx_fields(loci, chrom, pos, line, rest):
+  ## Fields and END of a record read by resolution: one at a PGx locus, or a gVCF reference block that covers one.
+  ## None for any other record, which is then skipped without splitting the rest of its line.
+  if in_pgx_loci(loci, chrom, pos):
+    info = line.rstrip('\r\n').split('\t')
+    return(info, record_end(pos, info[3], info[4], info[7]))
+  if 'END=' in rest:
+    info = line.rstrip('\r\n').split('\t')
+    end = record_end(pos, info[3], info[4], info[7])
+    if info[4] in REF_BLOCK_ALTS and overlaps_pgx_loci(loci, chrom, pos, end):
+      return(info, end)
+  return(None)
+
+
+def parse_gt(format, sample):
+  ## Allele indexes of the GT field; None for a no-call, which is then treated like an absent record
+  gt = sample.split(':')[format.split(':').index('GT')]
+  gts = re.split('/|\|', gt)
+  if '.' in gts:
+    return(None)
+  if len(gts) == 1:
+    return(int(gts[0]), HAPLOID)
+  return(int(gts[0]), int(gts[1]))
+
+
+def parse_vcf(germline_vcf, loci, threads=None, assume_sorted=False):
+  ## Keep only the records at PGx loci, and of those only CHROM, POS, END, ID, REF, ALT and the GT of the (last) sample column.
+  ## QUAL, FILTER, INFO and the other FORMAT fields are dropped while reading.
+  ## gVCF reference blocks that start before a locus but cover it are kept as well, so the locus reads as reference, not missing.
+  ## With assume_sorted, a plain VCF is taken as coordinate-sorted and only its records at the loci are read (see vcf_reader.open_vcf).
+  chroms = []; positions = []; ends = []; ids = []; refs = []; alts = []; gt1 = []; gt2 = []
+  chrom_names = {}
+  with closing(vcf_reader.open_vcf(germline_vcf, threads, loci, assume_sorted)) as file:
+    for line in file:
+      if line[0] == '#':
+        continue
+      raw_chrom, pos, rest = line.split('\t', 2)
+      chrom = chrom_names.get(raw_chrom)
+      if chrom is None:
+        chrom = chrom_names[raw_chrom] = re.sub('chr|Chr|CHR', '', raw_chrom)
+      pos = int(pos)
+      selected = pgx_fields(loci, chrom, pos, line, rest)
+      if selected is None:
+        continue
+      info, end = selected
+      gt = parse_gt(info[8], info[-1])
+      if gt is None:
+        continue
+      chroms.append(chrom); positions.append(pos); ends.append(end)
+      ids.append(sys.intern(info[2])); refs.append(sys.intern(info[3])); alts.append(sys.intern(info[4]))
+      gt1.append(gt[0]); gt2.append(gt[1])
+
+  filtered_vcf = pd.DataFrame({'#CHROM': pd.Categorical(chroms), 'POS': np.array(positions, dtype='int32'),
+                               'END': np.array(ends, dtype='int32'), 'ID': ids, 'REF': refs, 'ALT': alts,
+                               'GT1': np.array(gt1, dtype='int8'), 'GT2': np.array(gt2, dtype='int8')})
+  return(filtered_vcf)
+
+
+def resolution(race, germline_vcf, threads=None, pgx_loci=None, definitions=None, mode='serial', gene_list=None, assume_sorted=False):
+  ## germline_vcf is a VCF/BCF file, or records already parsed by parse_vcf (with assume_sorted, see parse_vcf).
+  ## gene_list limits the diplotype prediction to some genes of GENE_LIST.
+  ## pgx_loci (from load_pgx_loci) and definitions (from predict_diplotype.load_definitions) are loaded here unless given.
+  ## mode dispatches the genes of predict_diplotype.predict serially or on a thread or process pool of `threads` workers.
+
+  ## Filter loci based on PharmGKB's bed file: delete all loci in the user's vcf that are not in the panno.bed file
+  if pgx_loci is None:
+    pgx_loci = load_pgx_loci()
+  panno_bed, loci = pgx_loci
+  if isinstance(germline_vcf, pd.DataFrame):
+    filtered_vcf = germline_vcf
+  else:
+    filtered_vcf = parse_vcf(germline_vcf, loci, threads, assume_sorted)
+    logger.debug('%d records of %s are at PGx loci.', len(filtered_vcf), germline_vcf)
+
+  ## Class 1: Diplotype
+  if gene_list is None:
+    gene_list = GENE_LIST
+  if definitions is None:
+    definitions = predict_diplotype.load_definitions()
+  dic_diplotype = predict_diplotype.predict(filtered_vcf, race, gene_list, definitions, mode, threads)
+  ## Class 2: HLA genes
+  hla_subtypes = {gene: {} for gene in HLA_GENES}
+  for chrom, a1, a2 in zip(filtered_vcf['#CHROM'], filtered_vcf.GT1, filtered_vcf.GT2):
+    # HLA genes
+    if chrom.startswith('HLA'):
+      gene = chrom.split('*')[0]
+      if gene in hla_subtypes.keys():
+        hla_subtypes[gene].update({'*%s' % chrom.split('*')[1]: 2 - int(a1 == 0) - int(a2 == 0)})
+      # hla_subtypes[chrom] = genotype
+  ## Class 3: Genotypes of detected positions
+  dic_rs2gt = rs_genotypes(filtered_vcf, panno_bed, reference_alleles(definitions))
+
+  return(dic_diplotype, dic_rs2gt, hla_subtypes)
@@ -0,0 +1,63 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+"""Diagnostics of PAnno: the 'panno' logger, the sample being processed and the optional JSON-lines sink."""
+
+from contextlib import contextmanager
+import logging, contextvars, json, sys
+
+LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR')
+
+logger = logging.getLogger('panno')
+# Silent when PAnno is used as a library and the caller configures no logging
+logger.addHandler(logging.NullHandler())
+
+# Sample of the current thread or task; each thread of a pool starts without one
+current_sample = contextvars.ContextVar('panno_sample', default='-')
+
+
+@contextmanager
+def sample_context(sample_id):
+  ## Tag the records logged inside the block with sample_id
+  token = current_sample.set(sample_id)
+  try:
+    yield
+  finally:
+    current_sample.reset(token)
+
+
+class SampleFilter(logging.Filter):
+  def filter(self, record):
+    record.sample = current_sample.get()
+    return(True)
+
+
+class JsonLinesFormatter(logging.Formatter):
+  ## One JSON object per record; the fields passed as extra={'data': {...}} are kept structured
+  def format(self, record):
+    entry = {'time': record.created, 'level': record.levelname, 'logger': record.name,
+             'sample': getattr(record, 'sample', '-'), 'message': record.getMessage()}
+    if hasattr(record, 'data'):
+      entry['data'] = record.data
+    if record.exc_info:
+      entry['exception'] = self.formatException(record.exc_info)
+    return(json.dumps(entry, default=str))
+
+
+def setup(level='INFO', json_fp=None, stream=sys.stderr):
+  ## Console output at the given level, plus every record of the same level appended to json_fp as JSON lines
+  logger.setLevel(level)
+  for handler in list(logger.handlers):
+    if not isinstance(handler, logging.NullHandler):
+      logger.removeHandler(handler)
+      handler.close()
+  console = logging.StreamHandler(stream)
+  console.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(sample)s] %(message)s', '%Y-%m-%d %H:%M:%S'))
+  console.addFilter(SampleFilter())
+  logger.addHandler(console)
+  if json_fp is not None:
+    sink = logging.FileHandler(json_fp, encoding='utf-8')
+    sink.setFormatter(JsonLinesFormatter())
+    sink.addFilter(SampleFilter())
+    logger.addHandler(sink)
+  return(logger)
@@ -3,15 +3,503 @@
 
 """Console script for panno."""
 
-from panno import genotype_resolution, clinical_annotation, pgx_report, predict_diplotype
-import getopt, sys, os, re, pyranges
+from panno import genotype_resolution, clinical_annotation, pgx_report, predict_diplotype, cohort_diplotype, cohort_aggregate, pgx_extract, pgx_check, pgx_batch
+from panno.api import pop_dic, restrict
+from panno.log import logger
+from panno import log
+import getopt, sys, os, re, sqlite3
 import pandas as pd
 
+version = 'v0.3.1'
+
+
+def cohort(argv):
+
+  help = '''
+  Usage: panno cohort -i cohort_vcf -p population -o outdir
+  
+  Calls the PGx diplotypes of every sample of a multi-sample VCF file in one pass
+  and writes one tab-separated table per gene (<gene>.diplotype.tsv) to the output path.
+  
+  Options:
+    
+    -i, --cohort_vcf TEXT           Unannotated multi-sample VCF or BCF file.
+    
+    -p, --population [AAC|AME|EAS|EUR|LAT|NEA|OCE|SAS|SSA]
+                                    The three-letter abbreviation of the biogeographic group of the cohort.
+    
+    -o, --outdir TEXT               Write the diplotype tables in the specified output path.
+    
+    -t, --threads INTEGER           Threads used to decompress a bgzipped VCF or BCF file.
+                                    Defaults to the number of cores, at most 32.
+    
+    -g, --genes TEXT                Genes separated by commas, or a panel file with one gene per
+                                    line. Only these genes are called.
+    
+    -h, --help                      Show this message and exit.
+  '''
+
+  try:
+    opts, args = getopt.getopt(argv, "hi:p:o:t:g:", ["help", "cohort_vcf=", "population=", "outdir=", "threads=", "genes="])
+    if not opts:
+      print(help)
+      sys.exit()
+  except getopt.GetoptError:
+    print(help)
+    sys.exit(1)
+
+  for opt, arg in opts:
+    if opt in ("-h", "--help"):
+      print(help)
+      sys.exit()
+    elif opt in ("-i", "--cohort_vcf"):
+      cohort_vcf = arg
+    elif opt in ("-p", "--population"):
+      population = arg
+    elif opt in ("-o", "--outdir"):
+      outdir = arg
+    elif opt in ("-t", "--threads"):
+      threads = arg
+    elif opt in ("-g", "--genes"):
+      genes = arg
+
+  ## Check input arguments
+  if 'cohort_vcf' not in locals().keys():
+    print('\nThe cohort VCF (-i or --cohort_vcf) is a required parameter, please enter it.')
+    sys.exit(1)
+  elif not os.path.exists(cohort_vcf):
+    print('\n[ERROR] The input cohort VCF file does not exist, please check your file path.')
+    sys.exit(1)
+
+  if 'population' not in locals().keys():
+    print('\nThe population (-p or --population) is a required parameter, please enter it.')
+    sys.exit(1)
+  elif population.upper() not in pop_dic.keys():
+    print('\n[ERROR] The input population is not included in PAnno. Please check if the abbreviation is used correctly.')
+    sys.exit(1)
+
+  if 'outdir' not in locals().keys():
+    print('\nThe directory for output (-o or --outdir) is a required parameter, please enter it.')
+    sys.exit(1)
+  elif not os.path.exists(outdir):
+    print('\n[WARNING] The directory %s does not exist.' % outdir)
+    try:
+      print('  - PAnno is trying to create it.')
+      os.mkdir(outdir)
+    except:
+      print('  - [ERROR] Directory creation failed. Please enter a directory that already exists to re-run PAnno.')
+      sys.exit(1)
+
+  if 'threads' not in locals().keys():
+    threads = None
+  elif not threads.isdigit() or int(threads) < 1:
+    print('\n[ERROR] The number of threads (-t or --threads) must be a positive integer.')
+    sys.exit(1)
+  else:
+    threads = int(threads)
+
+  if 'genes' not in locals().keys():
+    gene_list = None
+  else:
+    genes = genotype_resolution.read_genes(genes)
+    unknown = [gene for gene in genes if gene not in genotype_resolution.GENE_LIST]
+    if unknown:
+      print('\n[ERROR] No diplotype definition of %s in PAnno. Please check the genes (-g or --genes).' % ', '.join(unknown))
+      sys.exit(1)
+    gene_list = [gene for gene in genotype_resolution.GENE_LIST if gene in genes]
+
+  log.setup()
+  logger.info('Parsing PGx related diplotypes of the cohort ...')
+  diplotypes = cohort_diplotype.call_cohort(cohort_vcf, pop_dic[population.upper()], gene_list, threads)
+  fps = cohort_diplotype.write_tables(diplotypes, outdir)
+  print('\nThe diplotype tables of %d genes have been written to %s.' % (len(fps), outdir))
+  print('\n     ^ _ ^\n\n')
+
+
+def aggregate(argv):
+
+  help = '''
+  Usage: panno aggregate -i results -o outdir
+  
+  Summarizes the per-sample results written with `panno -j` into cohort statistics:
+  diplotype and phenotype frequencies per gene, Avoid/Caution/Routine counts per drug
+  and the missing rate per position. The tables (aggregate.*.tsv) and an HTML summary
+  (aggregate.PAnno.html) are written to the output path. When the output path already
+  holds an aggregate, the new samples are added to it.
+  
+  Options:
+    
+    -i, --results TEXT              Per-sample result file (*.PAnno.json) or a directory of them.
+                                    Can be given several times.
+    
+    -o, --outdir TEXT               Write the aggregate in the specified output path.
+    
+    -h, --help                      Show this message and exit.
+  '''
+
+  try:
+    opts, args = getopt.getopt(argv, "hi:o:", ["help", "results=", "outdir="])
+    if not opts:
+      print(help)
+      sys.exit()
+  except getopt.GetoptError:
+    print(help)
+    sys.exit(1)
+
+  results = []
+  for opt, arg in opts:
+    if opt in ("-h", "--help"):
+      print(help)
+      sys.exit()
+    elif opt in ("-i", "--results"):
+      results.append(arg)
+    elif opt in ("-o", "--outdir"):
+      outdir = arg
+
+  ## Check input arguments
+  if not results:
+    print('\nThe per-sample results (-i or --results) are a required parameter, please enter them.')
+    sys.exit(1)
+  for fp in results:
+    if not os.path.exists(fp):
+      print('\n[ERROR] The results %s do not exist, please check your file path.' % fp)
+      sys.exit(1)
+
+  if 'outdir' not in locals().keys():
+    print('\nThe directory for output (-o or --outdir) is a required parameter, please enter it.')
+    sys.exit(1)
+  elif not os.path.exists(outdir):
+    print('\n[WARNING] The directory %s does not exist.' % outdir)
+    try:
+      print('  - PAnno is trying to create it.')
+      os.mkdir(outdir)
+    except:
+      print('  - [ERROR] Directory creation failed. Please enter a directory that already exists to re-run PAnno.')
+      sys.exit(1)
+
+  log.setup()
+  logger.info('Aggregating PAnno results ...')
+  added, skipped, fps = cohort_aggregate.aggregate(results, outdir)
+  if skipped:
+    logger.warning('%d samples were already in the aggregate and have been skipped.', len(skipped))
+  print('\n%d samples have been added to the aggregate at %s.' % (len(added), outdir))
+  print('\n     ^ _ ^\n\n')
+
+
+def extract(argv):
+
+  help = '''
+  Usage: panno extract -i germline_vcf -o pgx_vcf [-z] [-x]
+  
+  Writes the PGx slice of a VCF or BCF file: its header and the records at the loci of
+  pgx_loci.bed, the gVCF reference blocks covering them and the records with a PGx rsID.
+  PAnno reads the same diplotypes and genotypes from the slice as from the whole file.
+  VCF records are copied unchanged; BCF records are written with their GT field only.
+  
+  Options:
+    
+    -i, --germline_vcf TEXT         VCF or BCF file to slice.
+    
+    -o, --output TEXT               Path of the PGx VCF file to write.
+    
+    -z, --bgzip                     Compress the PGx VCF file with bgzip.
+    
+    -x, --index                     Also write a tabix index (<output>.tbi); requires -z.
+    
+    -t, --threads INTEGER           Threads used to decompress a bgzipped VCF or BCF file.
+                                    Defaults to the number of cores, at most 32.
+    
+    -h, --help                      Show this message and exit.
+  '''
+
+  try:
+    opts, args = getopt.getopt(argv, "hzxi:o:t:", ["help", "bgzip", "index", "germline_vcf=", "output=", "threads="])
+    if not opts:
+      print(help)
+      sys.exit()
+  except getopt.GetoptError:
+    print(help)
+    sys.exit(1)
+
+  compress = False; index = False
+  for opt, arg in opts:
+    if opt in ("-h", "--help"):
+      print(help)
+      sys.exit()
+    elif opt in ("-i", "--germline_vcf"):
+      germline_vcf = arg
+    elif opt in ("-o", "--output"):
+      output = arg
+    elif opt in ("-z", "--bgzip"):
+      compress = True
+    elif opt in ("-x", "--index"):
+      index = True
+    elif opt in ("-t", "--threads"):
+      threads = arg
+
+  ## Check input arguments
+  if 'germline_vcf' not in locals().keys():
+    print('\nThe germline VCF (-i or --germline_vcf) is a required parameter, please enter it.')
+    sys.exit(1)
+  elif not os.path.exists(germline_vcf):
+    print('\n[ERROR] The input germline VCF file does not exist, please check your file path.')
+    sys.exit(1)
+
+  if 'output' not in locals().keys():
+    print('\nThe output file (-o or --output) is a required parameter, please enter it.')
+    sys.exit(1)
+  elif os.path.abspath(output) == os.path.abspath(germline_vcf):
+    print('\n[ERROR] The output file must differ from the input germline VCF file.')
+    sys.exit(1)
+
+  if index and not compress:
+    print('\n[ERROR] Only a bgzipped file can be indexed, please add -z or --bgzip.')
+    sys.exit(1)
+
+  if 'threads' not in locals().keys():
+    threads = None
+  elif not threads.isdigit() or int(threads) < 1:
+    print('\n[ERROR] The number of threads (-t or --threads) must be a positive integer.')
+    sys.exit(1)
+  else:
+    threads = int(threads)
+
+  log.setup()
+  logger.info('Extracting PGx records ...')
+  n_read, n_written = pgx_extract.extract(germline_vcf, output, threads, compress, index)
+  print('\n%d of %d records have been written to %s.' % (n_written, n_read, output))
+  print('\n     ^ _ ^\n\n')
+
+
+def check(argv):
+
+  help = '''
+  Usage: panno check -i germline_vcf [-o coverage_tsv]
+  
+  Checks an input VCF or BCF file before running PAnno, reading its PGx records once:
+  the coverage of the positions defined for each gene and of the rsIDs of pgx_loci.bed, the genome
+  build (REF alleles at PGx SNV positions against GRCh38), the sample columns, the GT
+  fields and the variants split over several records. The exit status is 1 when an
+  error is found, so that a batch can be gated on it.
+  
+  Options:
+    
+    -i, --germline_vcf TEXT         VCF or BCF file to check.
+    
+    -o, --output TEXT               Also write the coverage table to this TSV file.
+    
+    -t, --threads INTEGER           Threads used to decompress a bgzipped VCF or BCF file.
+                                    Defaults to the number of cores, at most 32.
+    
+    --sorted                        The plain VCF file is coordinate-sorted: read only its records
+                                    at the PGx loci instead of the whole file.
+    
+    -h, --help                      Show this message and exit.
+  '''
+
+  try:
+    opts, args = getopt.getopt(argv, "hi:o:t:", ["help", "germline_vcf=", "output=", "threads=", "sorted"])
+    if not opts:
+      print(help)
+      sys.exit()
+  except getopt.GetoptError:
+    print(help)
+    sys.exit(1)
+
+  for opt, arg in opts:
+    if opt in ("-h", "--help"):
+      print(help)
+      sys.exit()
+    elif opt in ("-i", "--germline_vcf"):
+      germline_vcf = arg
+    elif opt in ("-o", "--output"):
+      output = arg
+    elif opt in ("-t", "--threads"):
+      threads = arg
+    elif opt == "--sorted":
+      assume_sorted = True
+
+  ## Check input arguments
+  if 'germline_vcf' not in locals().keys():
+    print('\nThe germline VCF (-i or --germline_vcf) is a required parameter, please enter it.')
+    sys.exit(1)
+  elif not os.path.exists(germline_vcf):
+    print('\n[ERROR] The input germline VCF file does not exist, please check your file path.')
+    sys.exit(1)
+
+  if 'threads' not in locals().keys():
+    threads = None
+  elif not threads.isdigit() or int(threads) < 1:
+    print('\n[ERROR] The number of threads (-t or --threads) must be a positive integer.')
+    sys.exit(1)
+  else:
+    threads = int(threads)
+
+  if 'assume_sorted' not in locals().keys():
+    assume_sorted = False
+
+  log.setup()
+  logger.info('Checking %s ...', germline_vcf)
+  coverage, issues = pgx_check.check(germline_vcf, threads, assume_sorted = assume_sorted)
+  print('\n' + coverage.to_string(index=False))
+  if 'output' in locals().keys():
+    coverage.to_csv(output, sep='\t', index=False)
+  print('')
+  for level, item, message in issues:
+    print('[%s] %s: %s' % (level, item, message))
+  if any(level == 'ERROR' for level, item, message in issues):
+    print('\n%s did not pass the check.\n' % germline_vcf)
+    sys.exit(1)
+  print('%s passed the check.' % germline_vcf)
+  print('\n     ^ _ ^\n\n')
+
+
+def batch(argv):
+
+  help = '''
+  Usage: panno batch -i manifest -o outdir [-w workers] [--parquet] [--sqlite results.db]
+  
+  Runs PAnno on every sample of a manifest on a pool of worker processes, writing the report of
+  each sample to the output path as it completes.
+  
+  Options:
+    
+    -i, --manifest TEXT             Tab-separated file with one sample per line: sample_id, germline_vcf
+                                    and population (three-letter abbreviation). A header line starting
+                                    with sample_id is skipped.
+    
+    -o, --outdir TEXT               Write the reports in the specified output path.
+    
+    -w, --workers INTEGER           Number of samples run in parallel, one process each. Defaults to 1.
+    
+    -j, --json                      Also write the compact result of each sample (<sample_id>.PAnno.json) for `panno aggregate`.
+    
+    -n, --no_report                 Do not write the HTML reports.
+    
+    --parquet                       Append the results to Parquet datasets in <outdir>/parquet, one per table
+                                    (samples, diplotypes, drugs, guidelines, phenotypes, annotations, variants),
+                                    keyed by sample_id. Requires pyarrow.
+    
+    --sqlite TEXT                   Also write the results to this SQLite database (created if needed), with
+                                    the same tables indexed on gene, drug and phenotype. A sample run again
+                                    replaces its previous rows.
+    
+    -h, --help                      Show this message and exit.
+  '''
+
+  try:
+    opts, args = getopt.getopt(argv, "hjni:o:w:", ["help", "json", "no_report", "parquet", "sqlite=", "manifest=", "outdir=", "workers="])
+    if not opts:
+      print(help)
+      sys.exit()
+  except getopt.GetoptError:
+    print(help)
+    sys.exit(1)
+
+  results = False; report = True; parquet = False
+  for opt, arg in opts:
+    if opt in ("-h", "--help"):
+      print(help)
+      sys.exit()
+    elif opt in ("-i", "--manifest"):
+      manifest = arg
+    elif opt in ("-o", "--outdir"):
+      outdir = arg
+    elif opt in ("-w", "--workers"):
+      workers = arg
+    elif opt in ("-j", "--json"):
+      results = True
+    elif opt in ("-n", "--no_report"):
+      report = False
+    elif opt == "--parquet":
+      parquet = True
+    elif opt == "--sqlite":
+      sqlite_db = arg
+
+  ## Check input arguments
+  if 'manifest' not in locals().keys():
+    print('\nThe manifest (-i or --manifest) is a required parameter, please enter it.')
+    sys.exit(1)
+  elif not os.path.exists(manifest):
+    print('\n[ERROR] The manifest file does not exist, please check your file path.')
+    sys.exit(1)
+  try:
+    samples = pgx_batch.read_manifest(manifest)
+  except ValueError as e:
+    print('\n[ERROR] %s' % e)
+    sys.exit(1)
+
+  if 'outdir' not in locals().keys():
+    print('\nThe directory for output (-o or --outdir) is a required parameter, please enter it.')
+    sys.exit(1)
+  elif not os.path.exists(outdir):
+    print('\n[WARNING] The directory %s does not exist.' % outdir)
+    try:
+      print('  - PAnno is trying to create it.')
+      os.mkdir(outdir)
+    except:
+      print('  - [ERROR] Directory creation failed. Please enter a directory that already exists to re-run PAnno.')
+      sys.exit(1)
+
+  if 'workers' not in locals().keys():
+    workers = 1
+  elif not workers.isdigit() or int(workers) < 1:
+    print('\n[ERROR] The number of workers (-w or --workers) must be a positive integer.')
+    sys.exit(1)
+  else:
+    workers = int(workers)
+
+  sinks = []
+  if parquet:
+    try:
+      from panno.parquet_sink import ParquetSink
+      sinks.append(ParquetSink(os.path.join(outdir, 'parquet')))
+    except ImportError as e:
+      print('\n[ERROR] %s' % e)
+      sys.exit(1)
+  if 'sqlite_db' in locals().keys():
+    from panno.sqlite_sink import SqliteSink
+    try:
+      sinks.append(SqliteSink(sqlite_db))
+    except sqlite3.Error as e:
+      print('\n[ERROR] The SQLite database %s cannot be opened: %s' % (sqlite_db, e))
+      sys.exit(1)
+
+  log.setup()
+  logger.info('Running %d samples on %d workers ...', len(samples), workers)
+  failed = pgx_batch.run_batch(samples, outdir, workers, sinks, report, results)
+  print('\n%d of %d samples have been completed, the results are located at %s.' % (len(samples) - len(failed), len(samples), outdir))
+  if failed:
+    print('[ERROR] These samples failed, see the log above: %s' % ', '.join(failed))
+    sys.exit(1)
+  print('\n     ^ _ ^\n\n')
+
+
 def main():
   
-  version = 'v0.3.1'
+  if len(sys.argv) > 1 and sys.argv[1] == 'cohort':
+    cohort(sys.argv[2:])
+    return
+  if len(sys.argv) > 1 and sys.argv[1] == 'aggregate':
+    aggregate(sys.argv[2:])
+    return
+  if len(sys.argv) > 1 and sys.argv[1] == 'extract':
+    extract(sys.argv[2:])
+    return
+  if len(sys.argv) > 1 and sys.argv[1] == 'check':
+    check(sys.argv[2:])
+    return
+  if len(sys.argv) > 1 and sys.argv[1] == 'batch':
+    batch(sys.argv[2:])
+    return
+  
   help = '''
   Usage: panno -s sample_id -i germline_vcf -p population -o outdir
+         panno cohort -i cohort_vcf -p population -o outdir
+         panno aggregate -i results -o outdir
+         panno extract -i germline_vcf -o pgx_vcf
+         panno check -i germline_vcf
+         panno batch -i manifest -o outdir
   
   PAnno takes the variant calling format (VCF) file and population information as input
   and outputs an HTML report of drug responses with prescription recommendations.
@@ -20,7 +508,7 @@ def main():
     
     -s, --sample_id TEXT            Sample ID that will be displayed in the PAnno report.
     
-    -i, --germline_vcf TEXT         Unannotated VCF file, preferably germline variant.
+    -i, --germline_vcf TEXT         Unannotated VCF or BCF file, preferably germline variant.
     
     -p, --population [AAC|AME|EAS|EUR|LAT|NEA|OCE|SAS|SSA]
                                     The three-letter abbreviation for biogeographic groups:
@@ -31,13 +519,48 @@ def main():
     
     -o, --outdir TEXT               Create report in the specified output path.
     
+    -t, --threads INTEGER           Threads used to decompress a bgzipped VCF or BCF file.
+                                    Defaults to the number of cores, at most 32.
+    
+    --sorted                        The plain VCF file is coordinate-sorted: read only its records
+                                    at the PGx loci instead of the whole file. A record out of
+                                    order may then be missed.
+    
+    -m, --mode [serial|thread|process]
+                                    Predict the diplotypes of the genes one after another (serial,
+                                    default) or on a pool of -t thread or process workers.
+    
+    -a, --assets [embed|light|bundle]
+                                    How the report carries its logo, icon and stylesheet:
+                                    embed (inline full-size images, default), light (inline
+                                    downscaled images once), bundle (link a shared versioned
+                                    asset directory next to the report).
+    
+    -z, --gzip                      Write the report gzip-compressed (*.PAnno.html.gz).
+    
+    -j, --json                      Also write the results as one JSON line (*.PAnno.json),
+                                    the input of `panno aggregate`.
+    
+    -d, --drugs TEXT                Drugs separated by commas without spaces, e.g. clopidogrel or
+                                    codeine,tramadol. Only their guidelines and annotations are
+                                    reported, and only the genes they refer to are predicted.
+    
+    -g, --genes TEXT                Genes separated by commas, or a panel file with one gene per
+                                    line, e.g. the genes of a targeted panel. Only these genes are
+                                    predicted, annotated and reported.
+    
+    -l, --log_level [DEBUG|INFO|WARNING|ERROR]
+                                    Level of the diagnostics written to stderr. Defaults to INFO.
+    
+    --log_json TEXT                 Also append the diagnostics to this file as JSON lines.
+    
     -v, --version                   Show the version and exit.
     
     -h, --help                      Show this message and exit.
   '''
   
   try:
-    opts, args = getopt.getopt(sys.argv[1:], "hvs:i:p:o:", ["help", "version", "sample_id=", "germline_vcf=", "population=", "outdir="])
+    opts, args = getopt.getopt(sys.argv[1:], "hvzjs:i:p:o:t:m:a:d:g:l:", ["help", "version", "gzip", "json", "sample_id=", "germline_vcf=", "population=", "outdir=", "threads=", "mode=", "assets=", "drugs=", "genes=", "sorted", "log_level=", "log_json="])
     if not opts:
       print(help)
       sys.exit()
@@ -59,6 +582,26 @@ def main():
       population = arg
     elif opt in ("-o", "--output"):
       outdir = arg
+    elif opt in ("-t", "--threads"):
+      threads = arg
+    elif opt in ("-m", "--mode"):
+      mode = arg
+    elif opt in ("-a", "--assets"):
+      assets = arg
+    elif opt in ("-z", "--gzip"):
+      compress = True
+    elif opt in ("-j", "--json"):
+      results = True
+    elif opt in ("-d", "--drugs"):
+      drugs = arg
+    elif opt in ("-g", "--genes"):
+      genes = arg
+    elif opt == "--sorted":
+      assume_sorted = True
+    elif opt in ("-l", "--log_level"):
+      log_level = arg
+    elif opt == "--log_json":
+      log_json = arg
   
   ## Check input arguments
   if 'sample_id' not in locals().keys():
@@ -77,7 +620,6 @@ def main():
     sys.exit(1)
   else:
     population = population.upper()
-    pop_dic = {'AAC': 'African American/Afro-Caribbean', 'AME': 'American', 'SAS': 'Central/South Asian', 'EAS': 'East Asian', 'EUR': 'European', 'LAT': 'Latino', 'NEA': 'Near Eastern', 'OCE': 'Oceanian', 'SSA': 'Sub-Saharan African'}
     if population not in pop_dic.keys():
       print('\n[ERROR] The input population is not included in PAnno. Please check if the abbreviation is used correctly.')
       sys.exit(1)
@@ -94,18 +636,79 @@ def main():
       print('  - [ERROR] Directory creation failed. Please enter a directory that already exists to re-run PAnno.')
       sys.exit(1)
   fp = os.path.join(outdir, "%s.PAnno.html" % sample_id)
+
+  if 'threads' not in locals().keys():
+    threads = None
+  elif not threads.isdigit() or int(threads) < 1:
+    print('\n[ERROR] The number of threads (-t or --threads) must be a positive integer.')
+    sys.exit(1)
+  else:
+    threads = int(threads)
+  
+  if 'mode' not in locals().keys():
+    mode = 'serial'
+  elif mode not in predict_diplotype.PREDICT_MODES:
+    print('\n[ERROR] The prediction mode (-m or --mode) must be one of serial, thread or process.')
+    sys.exit(1)
+  
+  if 'assets' not in locals().keys():
+    assets = 'embed'
+  elif assets not in pgx_report.ASSET_MODES:
+    print('\n[ERROR] The report assets (-a or --assets) must be one of embed, light or bundle.')
+    sys.exit(1)
+  
+  if 'compress' not in locals().keys():
+    compress = False
+  
+  if 'results' not in locals().keys():
+    results = False
+  
+  if 'assume_sorted' not in locals().keys():
+    assume_sorted = False
+  
+  ## With drugs or genes, the tables are restricted to their guidelines and annotations, and the genes to those predicted for them
+  tables = None; gene_list = None
+  if 'drugs' not in locals().keys():
+    drugs = None
+  else:
+    drugs = [drug for drug in re.split(r',(?!\s)', drugs) if drug.strip()]
+  if 'genes' not in locals().keys():
+    genes = None
+  else:
+    genes = genotype_resolution.read_genes(genes)
+  if drugs is not None or genes is not None:
+    try:
+      tables, gene_list = restrict(clinical_annotation.load_tables(), drugs, genes)
+    except ValueError as e:
+      print('\n[ERROR] %s Please check the drugs (-d or --drugs) and genes (-g or --genes).' % e)
+      sys.exit(1)
+  
+  if 'log_level' not in locals().keys():
+    log_level = 'INFO'
+  elif log_level.upper() not in log.LEVELS:
+    print('\n[ERROR] The log level (-l or --log_level) must be one of DEBUG, INFO, WARNING or ERROR.')
+    sys.exit(1)
+  if 'log_json' not in locals().keys():
+    log_json = None
+  log.setup(log_level.upper(), log_json)
   
 
   ## Start running PAnno
-  print('\nParsing PGx related diplotypes ...')
-  dic_diplotype, dic_rs2gt, hla_subtypes = genotype_resolution.resolution(pop_dic[population], germline_vcf)
-  print('Annotating clinical information ...')
-  summary, prescribing_info, multi_var, single_var, phenotype_predict, clinical_anno = clinical_annotation.annotation(dic_diplotype, dic_rs2gt, hla_subtypes)
-  print('Generating PAnno report ...')
-  race = "%s (%s)" % (pop_dic[population], population)
-  pgx_report.report(race, summary, prescribing_info, multi_var, single_var, phenotype_predict, clinical_anno, fp, sample_id)
+  with log.sample_context(sample_id):
+    logger.info('Parsing PGx related diplotypes ...')
+    dic_diplotype, dic_rs2gt, hla_subtypes = genotype_resolution.resolution(pop_dic[population], germline_vcf, threads, mode = mode, gene_list = gene_list, assume_sorted = assume_sorted)
+    logger.info('Annotating clinical information ...')
+    summary, prescribing_info, multi_var, single_var, phenotype_predict, clinical_anno = clinical_annotation.annotation(dic_diplotype, dic_rs2gt, hla_subtypes, tables)
+    logger.info('Generating PAnno report ...')
+    race = "%s (%s)" % (pop_dic[population], population)
+    pgx_report.report(race, summary, prescribing_info, multi_var, single_var, phenotype_predict, clinical_anno, fp, sample_id, assets, compress)
+    if results:
+      json_fp = os.path.join(outdir, "%s.PAnno.json" % sample_id)
+      cohort_aggregate.write_record(cohort_aggregate.sample_record(sample_id, population, dic_diplotype, summary, prescribing_info, multi_var, single_var), json_fp)
   
   # Finish the task
+  if compress:
+    fp = fp + '.gz'
   print('\nYour PAnno report has been completed and is located at %s.' % fp)
   print('\n     ^ _ ^\n\n')
 
@@ -0,0 +1,57 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+
+from panno.pgx_batch import TABLE_COLUMNS
+import os, time, uuid
+import pandas as pd
+
+# Samples buffered before their rows are written, as one row group per table
+ROW_GROUP_SAMPLES = 1000
+
+
+class ParquetSink(object):
+  ## Appends the tables of a batch to one Parquet dataset per table, <outdir>/<table>/part-*.parquet.
+  ## Every ROW_GROUP_SAMPLES samples, the buffered rows of each table are written as a new file holding one row group,
+  ## so the completed samples can be scanned (e.g. read_parquet('<outdir>/diplotypes/*.parquet') in DuckDB) while the batch runs.
+  def __init__(self, outdir, row_group_samples=ROW_GROUP_SAMPLES):
+    try:
+      import pyarrow, pyarrow.parquet
+    except ImportError:
+      raise ImportError('The Parquet export requires pyarrow, please install it (pip install pyarrow).')
+    self.pa = pyarrow; self.pq = pyarrow.parquet
+    types = {'str': pyarrow.string(), 'int': pyarrow.int64(), 'float': pyarrow.float64()}
+    self.schemas = {table: pyarrow.schema([(column, types[type]) for column, type in columns]) for table, columns in TABLE_COLUMNS.items()}
+    self.outdir = outdir
+    self.row_group_samples = row_group_samples
+    # Files of separate runs never collide, so a dataset grows with every batch appended to it
+    self.run_id = '%s-%s' % (time.strftime('%Y%m%d%H%M%S'), uuid.uuid4().hex[:8])
+    self.part = 0
+    self.buffers = {table: [] for table in TABLE_COLUMNS}
+    self.n_samples = 0
+    for table in TABLE_COLUMNS:
+      os.makedirs(os.path.join(outdir, table), exist_ok=True)
+
+  def add(self, tables):
+    for table, df in tables.items():
+      self.buffers[table].append(df)
+    self.n_samples += 1
+    if self.n_samples >= self.row_group_samples:
+      self.flush()
+
+  def flush(self):
+    if self.n_samples == 0:
+      return
+    for table, frames in self.buffers.items():
+      data = self.pa.Table.from_pandas(pd.concat(frames, ignore_index=True), schema=self.schemas[table], preserve_index=False)
+      fp = os.path.join(self.outdir, table, 'part-%s-%05d.parquet' % (self.run_id, self.part))
+      # Written under a hidden name first, which dataset readers skip, so that no reader sees a partial file
+      tmp_fp = os.path.join(self.outdir, table, '.part-%s-%05d.parquet.tmp' % (self.run_id, self.part))
+      self.pq.write_table(data, tmp_fp, row_group_size=len(data) or None, compression='zstd')
+      os.replace(tmp_fp, fp)
+      frames.clear()
+    self.part += 1
+    self.n_samples = 0
+
+  def close(self):
+    self.flush()
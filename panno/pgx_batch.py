@@ -0,0 +1,124 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+
+from panno import api, pgx_report, cohort_aggregate, log
+from panno.log import logger
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import os
+import pandas as pd
+
+# Columns of the long tables a batch hands to its sinks, with their types ('str', 'int' or 'float'); every row starts with sample_id
+TABLE_COLUMNS = {
+  'samples': [('sample_id', 'str'), ('population', 'str'), ('germline_vcf', 'str'), ('avoid', 'int'), ('caution', 'int'), ('routine', 'int')],
+  'diplotypes': [('sample_id', 'str'), ('gene', 'str'), ('diplotype', 'str'), ('phenotype', 'str')],
+  'drugs': [('sample_id', 'str'), ('drug', 'str'), ('category', 'str')],
+  'guidelines': [('sample_id', 'str'), ('drug', 'str'), ('gene', 'str'), ('variant', 'str'), ('diplotype', 'str'), ('phenotype', 'str'),
+                 ('summary', 'str'), ('recommendation', 'str'), ('source', 'str'), ('paid', 'str'), ('avoid', 'int'), ('alternate', 'int'), ('dosing', 'int')],
+  'phenotypes': [('sample_id', 'str'), ('drug', 'str'), ('panno_score', 'float'), ('count', 'int'), ('phenotype_category', 'str'), ('prediction', 'str')],
+  'annotations': [('sample_id', 'str'), ('drug', 'str'), ('gene', 'str'), ('variant', 'str'), ('diplotype', 'str'), ('phenotype_category', 'str'),
+                  ('evidence_level', 'str'), ('phenotype', 'str'), ('caid', 'int')],
+  'variants': [('sample_id', 'str'), ('gene', 'str'), ('variant', 'str'), ('call', 'str')],
+}
+
+# Tables copied from the report tables of a sample: the field of api.Result and its columns, in the order of TABLE_COLUMNS
+RESULT_TABLES = {
+  'guidelines': ('prescribing_info', ['Drug', 'Gene', 'Variant', 'Diplotype', 'Phenotype', 'Summary', 'Recommendation', 'Source', 'PAID', 'Avoid', 'Alternate', 'Dosing']),
+  'phenotypes': ('phenotype_predict', ['Drug', 'PAnnoScore', 'Count', 'PhenotypeCategory', 'Prediction']),
+  'annotations': ('clinical_anno', ['Drug', 'Gene', 'Variant', 'Diplotype', 'PhenotypeCategory', 'EvidenceLevel', 'PAnnoPhenotype', 'CAID']),
+  'variants': ('single_var', ['Gene', 'Variant', 'Variant Call']),
+}
+
+
+def read_manifest(fp):
+  ## Samples of a batch, one per line: sample_id, germline_vcf and population, tab-separated.
+  ## Empty lines, comments and a header line starting with sample_id are skipped. Raises ValueError for an invalid line.
+  samples = []; seen = set()
+  with open(fp, encoding="utf-8") as f:
+    for n, line in enumerate(f, 1):
+      if not line.strip() or line.startswith('#') or line.startswith('sample_id\t'):
+        continue
+      fields = line.rstrip('\r\n').split('\t')
+      if len(fields) != 3:
+        raise ValueError('Line %d of %s does not have three tab-separated fields: sample_id, germline_vcf and population.' % (n, fp))
+      sample_id, germline_vcf, population = fields
+      if sample_id in seen:
+        raise ValueError('The sample %s is listed twice in %s.' % (sample_id, fp))
+      if population.upper() not in api.pop_dic.keys():
+        raise ValueError('The population %s of sample %s is not included in PAnno.' % (population, sample_id))
+      if not os.path.exists(germline_vcf):
+        raise ValueError('The germline VCF file %s of sample %s does not exist.' % (germline_vcf, sample_id))
+      seen.add(sample_id)
+      samples.append((sample_id, germline_vcf, population.upper()))
+  return(samples)
+
+
+def sample_tables(sample_id, population, germline_vcf, result):
+  ## Long tables of one sample (an api.Result), with the columns of TABLE_COLUMNS
+  phenotype = {}
+  for gene, phe in zip(result.prescribing_info.Gene, result.prescribing_info.Phenotype):
+    phenotype.setdefault(gene, phe)
+  tables = {}
+  tables['samples'] = pd.DataFrame([[sample_id, population, germline_vcf, len(result.summary['Avoid']), len(result.summary['Caution']), len(result.summary['Routine'])]])
+  tables['diplotypes'] = pd.DataFrame([[sample_id, gene, res['step2_res'], phenotype.get(gene)] for gene, res in result.diplotype.items()])
+  tables['drugs'] = pd.DataFrame([[sample_id, drug, cat] for cat in cohort_aggregate.CATEGORIES for drug in result.summary[cat]])
+  for name, (field, columns) in RESULT_TABLES.items():
+    df = getattr(result, field)[columns].copy()
+    df.insert(0, 'sample_id', sample_id)
+    tables[name] = df
+  for name, df in tables.items():
+    df.columns = [column for column, type in TABLE_COLUMNS[name]]
+  return(tables)
+
+
+## Knowledge base of a worker process, loaded once and reused for all of its samples
+kb = None
+
+def init_worker():
+  global kb
+  kb = api.load_kb()
+
+
+def run_sample(sample_id, germline_vcf, population, outdir, report=True, results=False):
+  ## One sample of a batch: its report (and JSON record) are written here and its tables returned to the sinks
+  if kb is None:
+    init_worker()
+  with log.sample_context(sample_id):
+    result = api.run(germline_vcf, population, kb, threads=1)
+    if report:
+      race = "%s (%s)" % (api.pop_dic[population], population)
+      pgx_report.report(race, *result[:6], os.path.join(outdir, "%s.PAnno.html" % sample_id), sample_id)
+    if results:
+      record = cohort_aggregate.sample_record(sample_id, population, result.diplotype, *result[:4])
+      cohort_aggregate.write_record(record, os.path.join(outdir, "%s.PAnno.json" % sample_id))
+    logger.info('Finished.')
+  return(sample_tables(sample_id, population, germline_vcf, result))
+
+
+def run_batch(samples, outdir, workers=1, sinks=(), report=True, results=False):
+  ## Run the samples of read_manifest on `workers` processes. The tables of each sample are handed to the sinks as it
+  ## completes, by this process only, so that every sink has a single writer. Returns the IDs of the samples that failed.
+  failed = []
+  def deliver(sample_id, run):
+    try:
+      tables = run()
+    except Exception:
+      logger.exception('Sample %s failed.', sample_id)
+      failed.append(sample_id)
+      return
+    for sink in sinks:
+      sink.add(tables)
+  try:
+    if workers == 1:
+      for sample in samples:
+        deliver(sample[0], lambda: run_sample(*sample, outdir, report, results))
+    else:
+      with ProcessPoolExecutor(workers, initializer=init_worker) as pool:
+        futures = {pool.submit(run_sample, *sample, outdir, report, results): sample[0] for sample in samples}
+        for future in as_completed(futures):
+          deliver(futures[future], future.result)
+  finally:
+    # The samples completed so far are kept even when the batch is interrupted
+    for sink in sinks:
+      sink.close()
+  return(failed)
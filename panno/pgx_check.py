@@ -0,0 +1,136 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+
+from panno import genotype_resolution, predict_diplotype, vcf_reader
+from contextlib import closing
+import re
+import pandas as pd
+
+# A gene is reported when less than this fraction of its defined positions is called (variant or reference)
+MIN_COVERAGE = 0.5
+
+# The build is judged on at least MIN_REF_CHECKED reference alleles, and rejected when less than MIN_REF_MATCH of them agree with GRCh38
+MIN_REF_CHECKED = 10
+MIN_REF_MATCH = 0.9
+
+
+def defined_positions(info):
+  ## Positions and rsID of every position defined for a gene; a range such as 42128936-42128944 holds all of its positions
+  for source_pos in info['haplotype_definition'][info['reference_haplotype']].keys():
+    pos_rs = source_pos.split(':')
+    tmp = pos_rs[0].split('-')
+    yield(list(range(int(tmp[0]), int(tmp[-1]) + 1)), pos_rs[1])
+
+
+def check(germline_vcf, threads=None, pgx_loci=None, definitions=None, assume_sorted=False):
+  ## Read the records of germline_vcf at PGx loci once, as resolution does, without predicting anything.
+  ## assume_sorted is passed to vcf_reader.open_vcf, as by genotype_resolution.parse_vcf.
+  ## Returns the coverage of every gene and of pgx_loci.bed, and the problems found as (level, check, message),
+  ## where level is 'ERROR' (resolution would fail or be wrong) or 'WARNING'.
+  if pgx_loci is None:
+    pgx_loci = genotype_resolution.load_pgx_loci()
+  if definitions is None:
+    definitions = predict_diplotype.load_definitions()
+  panno_bed, loci = pgx_loci
+  expected = genotype_resolution.reference_alleles(definitions)
+
+  samples = None
+  n_records = 0; no_gt = 0; bad_gt = 0; no_call = 0; ref_checked = 0; ref_match = 0
+  called = set(); called_ids = set(); variant_sites = {}
+  # The records read by resolution, in the columns of genotype_resolution.parse_vcf
+  chroms = []; starts = []; ends = []; ids = []; refs = []; alts = []; gt1 = []; gt2 = []
+  chrom_names = {}
+  with closing(vcf_reader.open_vcf(germline_vcf, threads, loci, assume_sorted)) as file:
+    for line in file:
+      if line[0] == '#':
+        if line.startswith('#CHROM'):
+          samples = line.rstrip('\r\n').split('\t')[9:]
+        continue
+      raw_chrom, pos, rest = line.split('\t', 2)
+      chrom = chrom_names.get(raw_chrom)
+      if chrom is None:
+        chrom = chrom_names[raw_chrom] = re.sub('chr|Chr|CHR', '', raw_chrom)
+      pos = int(pos)
+      selected = genotype_resolution.pgx_fields(loci, chrom, pos, line, rest)
+      if selected is None:
+        continue
+      info, end = selected
+      n_records += 1
+      # Build: the first base of REF is the reference base at POS, for variants and reference blocks alike
+      base = expected.get((chrom, pos))
+      if base is not None:
+        ref_checked += 1
+        ref_match += info[3][:1].upper() == base
+      # GT: parse_gt fails on a missing or malformed field, and an allele beyond ALT has no base
+      if len(info) < 10 or 'GT' not in info[8].split(':'):
+        no_gt += 1
+        continue
+      try:
+        gt = genotype_resolution.parse_gt(info[8], info[-1])
+      except (ValueError, IndexError):
+        bad_gt += 1
+        continue
+      if gt is None:
+        no_call += 1
+        continue
+      if max(gt) > len(info[4].split(',')):
+        bad_gt += 1
+        continue
+      called.add((chrom, pos)); called_ids.add(info[2])
+      chroms.append(chrom); starts.append(pos); ends.append(end)
+      ids.append(info[2]); refs.append(info[3]); alts.append(info[4]); gt1.append(gt[0]); gt2.append(gt[1])
+      if gt[0] != 0 or gt[1] > 0:
+        variant_sites[(chrom, pos)] = variant_sites.get((chrom, pos), 0) + 1
+
+  records = pd.DataFrame({'#CHROM': chroms, 'POS': starts, 'END': ends, 'ID': ids, 'REF': refs, 'ALT': alts, 'GT1': gt1, 'GT2': gt2})
+  ## Coverage of the genes, as parse_input_allele reads it: a position is called when a record starts at it (or has its rsID),
+  ## or when a reference call covers it; any other position is reported as Missing.
+  ref_index = genotype_resolution.reference_index(records)
+  def is_called(chrom, positions, rsid=None):
+    if rsid in called_ids or any((chrom, pos) in called for pos in positions):
+      return(True)
+    return(all(genotype_resolution.reference_call(ref_index, chrom, pos) is not None for pos in positions))
+
+  rows = []
+  for gene in genotype_resolution.GENE_LIST:
+    info = definitions[gene]
+    n_pos = 0; n_called = 0
+    for positions, rsid in defined_positions(info):
+      n_pos += 1
+      n_called += is_called(info['chrom'], positions, rsid)
+    rows.append([gene, n_pos, n_called])
+  ## Coverage of the rsIDs of pgx_loci.bed, with the genotypes resolution gives them and the single variants report
+  dic_rs2gt = genotype_resolution.rs_genotypes(records, panno_bed, expected)
+  rows.append(['pgx_loci.bed', panno_bed.rsid.dropna().nunique(), len(dic_rs2gt)])
+  coverage = pd.DataFrame(rows, columns=['Gene', 'Positions', 'Called'])
+  coverage['Missing'] = coverage.Positions - coverage.Called
+  coverage['Coverage'] = (coverage.Called / coverage.Positions).round(4)
+
+  ## Problems, from the most to the least severe
+  issues = []
+  if samples is None:
+    issues.append(('ERROR', 'header', 'There is no #CHROM header line.'))
+  elif not samples:
+    issues.append(('ERROR', 'sample', 'There is no sample column, PAnno reads the genotypes of the last one.'))
+  elif len(samples) > 1:
+    issues.append(('WARNING', 'sample', 'There are %d sample columns, PAnno only reads the last one (%s).' % (len(samples), samples[-1])))
+  if n_records == 0:
+    issues.append(('ERROR', 'coverage', 'No record is at a PGx locus, please check the genome build and the chromosome names.'))
+  if ref_checked >= MIN_REF_CHECKED and ref_match < MIN_REF_MATCH * ref_checked:
+    issues.append(('ERROR', 'build', 'Only %d of %d REF alleles at PGx SNV positions match GRCh38, the VCF is probably on another build.' % (ref_match, ref_checked)))
+  elif ref_checked < MIN_REF_CHECKED and n_records > 0:
+    issues.append(('WARNING', 'build', 'Only %d REF alleles could be compared with GRCh38, the genome build is not confirmed.' % ref_checked))
+  if no_gt:
+    issues.append(('ERROR', 'GT', '%d records at PGx loci have no GT field.' % no_gt))
+  if bad_gt:
+    issues.append(('ERROR', 'GT', '%d records at PGx loci have a malformed GT, or an allele index beyond their ALT alleles.' % bad_gt))
+  if no_call:
+    issues.append(('WARNING', 'GT', '%d records at PGx loci are no-calls and will be read as missing.' % no_call))
+  split_sites = sum(1 for n in variant_sites.values() if n > 1)
+  if split_sites:
+    issues.append(('WARNING', 'multi-allelic', '%d PGx positions have several variant records, please join them (bcftools norm -m+) so that each has one genotype.' % split_sites))
+  for gene, n_pos, n_missing, fraction in zip(coverage.Gene, coverage.Positions, coverage.Missing, coverage.Coverage):
+    if gene != 'pgx_loci.bed' and fraction < MIN_COVERAGE and n_records > 0:
+      issues.append(('WARNING', 'coverage', '%s: %d of %d defined positions are missing.' % (gene, n_missing, n_pos)))
+  return(coverage, issues)
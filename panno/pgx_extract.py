@@ -0,0 +1,66 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+
+from panno import genotype_resolution, vcf_reader
+from panno.vcf_writer import BgzfWriter, TabixIndex
+from panno.log import logger
+from contextlib import closing
+import re
+
+
+def extract(germline_vcf, out_fp, threads=None, compress=False, index=False):
+  ## Copy the header and the PGx records of a VCF/BCF file: the records resolution reads (at a PGx locus, or a gVCF
+  ## reference block covering one) and those whose ID is an rsID of pgx_loci.bed. VCF records are copied unchanged;
+  ## BCF records are written as the GT-only text lines of vcf_reader.bcf_line (QUAL, FILTER, other INFO and FORMAT dropped).
+  ## With compress the slice is bgzipped, and with index a tabix index is written next to it (out_fp + '.tbi').
+  panno_bed, loci = genotype_resolution.load_pgx_loci()
+  rsids = set(panno_bed.rsid.dropna())
+  out = BgzfWriter(out_fp) if compress else open(out_fp, 'wb')
+  tbi = TabixIndex() if compress and index else None
+  chrom_names = {}
+  n_read = 0; n_written = 0
+  last_chrom = None; last_pos = 0; is_sorted = True
+  with closing(vcf_reader.open_vcf(germline_vcf, threads)) as file:
+    for line in file:
+      if line[0] == '#':
+        if line.startswith('#CHROM'):
+          out.write(b'##panno_extract=PGx loci of PAnno v0.3.1\n')
+        out.write(line.encode('utf-8') if line.endswith('\n') else (line + '\n').encode('utf-8'))
+        continue
+      n_read += 1
+      raw_chrom, pos, id, rest = line.split('\t', 3)
+      chrom = chrom_names.get(raw_chrom)
+      if chrom is None:
+        chrom = chrom_names[raw_chrom] = re.sub('chr|Chr|CHR', '', raw_chrom)
+      pos = int(pos)
+      selected = genotype_resolution.pgx_fields(loci, chrom, pos, line, rest)
+      if selected is None:
+        if id not in rsids and (';' not in id or rsids.isdisjoint(id.split(';'))):
+          continue
+        info = line.rstrip('\r\n').split('\t')
+        end = genotype_resolution.record_end(pos, info[3], info[4], info[7])
+      else:
+        end = selected[1]
+      n_written += 1
+      if tbi is None:
+        out.write(line.encode('utf-8'))
+        continue
+      # The index is only valid when the contigs are contiguous and the positions ascending within each
+      if raw_chrom != last_chrom:
+        if raw_chrom in tbi.refs:
+          is_sorted = False
+        last_chrom = raw_chrom; last_pos = 0
+      elif pos < last_pos:
+        is_sorted = False
+      last_pos = pos
+      vbeg = out.tell()
+      out.write(line.encode('utf-8'))
+      tbi.add(raw_chrom, pos - 1, end, vbeg, out.tell())
+  out.close()
+  if tbi is not None:
+    if is_sorted:
+      tbi.write(out_fp + '.tbi')
+    else:
+      logger.warning('%s is not sorted by coordinate, no index has been written for %s.', germline_vcf, out_fp)
+  return(n_read, n_written)
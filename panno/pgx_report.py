@@ -2,21 +2,68 @@
 # -*- coding: UTF-8 -*-
 
 
-import time, os, base64
+from panno.genotype_resolution import REPORT_GENES
+from panno.log import logger
+import time, os, base64, gzip, shutil
 from itertools import *
 
+# Report assets: 'embed' inlines the full-size images, 'light' inlines downscaled images once,
+# 'bundle' links a versioned asset directory shared by all reports written to the same directory
+ASSET_MODES = ('embed', 'light', 'bundle')
+ASSET_BUNDLE = 'panno_assets_v0.3.1'
 
-def report (race, summary, prescribing_info, multi_var, single_var, phenotype_predict, clinical_anno, fp, sample_id):
-  with open(fp, 'w+', encoding="utf-8") as f:
+
+def write_bundle(outdir):
+  ## Copy the stylesheet and the downscaled images once per output directory; the name carries the version,
+  ## so reports of another PAnno release never pick up mismatched assets
+  bundle_dir = os.path.join(outdir, ASSET_BUNDLE)
+  if not os.path.exists(bundle_dir):
+    tmp_dir = '%s.%d.tmp' % (bundle_dir, os.getpid())
+    os.makedirs(tmp_dir, exist_ok=True)
+    for asset in ['custom.css', 'panno_logo_small.png', 'panno_icon_small.png']:
+      shutil.copyfile(os.path.join(os.path.dirname(__file__), 'assets', asset), os.path.join(tmp_dir, asset))
+    try:
+      os.rename(tmp_dir, bundle_dir)
+    except OSError:
+      # Another report process published the bundle first
+      shutil.rmtree(tmp_dir, ignore_errors=True)
+  return(bundle_dir)
+
+
+def report (race, summary, prescribing_info, multi_var, single_var, phenotype_predict, clinical_anno, fp, sample_id, assets='embed', compress=False):
+  ## With compress, the report is written gzip-compressed to fp + '.gz'
+  if compress:
+    handle = gzip.open(fp + '.gz', 'wt', encoding="utf-8")
+  else:
+    handle = open(fp, 'w+', encoding="utf-8")
+  with handle as f:
     ## Style
     css_fp = os.path.join(os.path.dirname(__file__), 'assets/custom.css')
-    logo_fp = os.path.join(os.path.dirname(__file__), 'assets/panno_logo.png')
-    icon_fp = os.path.join(os.path.dirname(__file__), 'assets/panno_icon.png')
+    if assets == 'embed':
+      logo_fp = os.path.join(os.path.dirname(__file__), 'assets/panno_logo.png')
+      icon_fp = os.path.join(os.path.dirname(__file__), 'assets/panno_icon.png')
+    else:
+      logo_fp = os.path.join(os.path.dirname(__file__), 'assets/panno_logo_small.png')
+      icon_fp = os.path.join(os.path.dirname(__file__), 'assets/panno_icon_small.png')
     # css_fp = os.path.join('./panno/assets/custom.css')
     # logo_fp = os.path.join('./panno/assets/panno_logo.png')
     # icon_fp = os.path.join('./panno/assets/panno_icon.png')
-    logo_base64 = base64.b64encode(open(logo_fp, "rb").read()).decode()
-    icon_base64 = base64.b64encode(open(icon_fp, "rb").read()).decode()
+    if assets == 'bundle':
+      write_bundle(os.path.dirname(os.path.abspath(fp)))
+      logo_src = '%s/panno_logo_small.png' % ASSET_BUNDLE
+      icon_src = '%s/panno_icon_small.png' % ASSET_BUNDLE
+      style = '<link rel="stylesheet" type="text/css" href="%s/custom.css">' % ASSET_BUNDLE
+    else:
+      logo_src = 'data:image/png;base64,' + base64.b64encode(open(logo_fp, "rb").read()).decode()
+      icon_src = 'data:image/png;base64,' + base64.b64encode(open(icon_fp, "rb").read()).decode()
+      style = '<style type="text/css">%s</style>' % open(css_fp).read()
+    # The side navigation shows the favicon; 'light' takes it from the <link> rather than inlining the image twice
+    if assets == 'light':
+      nav_icon = 'id="nav_icon"'
+      nav_script = '<script>document.getElementById("nav_icon").src = document.querySelector("link[rel~=icon]").href;</script>'
+    else:
+      nav_icon = 'src="%s"' % icon_src
+      nav_script = ''
     
     head_nav="""
     <!doctype html>
@@ -26,9 +73,9 @@ def report (race, summary, prescribing_info, multi_var, single_var, phenotype_pr
       <meta http-equiv="X-UA-Compatible" content="IE=edge">
       <meta name="viewport" content="width=device-width, initial-scale=1">
       <title>PAnno Report</title>
-      <link rel="shortcut icon" href="data:image/png;base64,%s">
+      <link rel="shortcut icon" href="%s">
       <script src="https://kit.fontawesome.com/e540049a97.js" crossorigin="anonymous"></script>
-      <style type="text/css">%s</style>
+      %s
     </head>
     
     <body>
@@ -37,7 +84,7 @@ def report (race, summary, prescribing_info, multi_var, single_var, phenotype_pr
         <ul class="mqc-nav collapse navbar-collapse">
         <h1>
           <a href="https://github.com/PreMedKB/PAnno" target="_blank">
-            <img src="data:image/png;base64,%s" alt="PAnno">
+            <img %s alt="PAnno">
             <br class="hidden-xs">
             <small class="hidden-xs">%s</small>
           </a>
@@ -53,17 +100,18 @@ def report (race, summary, prescribing_info, multi_var, single_var, phenotype_pr
         </ul>
       </div>
     </div>
+    %s
     
     <div class="main_page">
     """
-    print(head_nav%(icon_base64, open(css_fp).read(), icon_base64, 'v0.3.1'), file=f)
+    print(head_nav%(icon_src, style, nav_icon, 'v0.3.1', nav_script), file=f)
     
 
     ## Part 0: Basic information
     basic_info = """
     <h1 id="page_title">
       <a href="https://github.com/PreMedKB/PAnno" target="_blank">
-        <img src="data:image/png;base64,%s" title="PAnno">
+        <img src="%s" title="PAnno">
       </a>
     </h1>
     <p class="head_lead">
@@ -73,7 +121,7 @@ def report (race, summary, prescribing_info, multi_var, single_var, phenotype_pr
       <p style="font-size:0.95rem;">Sample ID: %s<br>Biogeographic Group: %s<br>Report Time: %s</p>
     </blockquote>
     """
-    print(basic_info%(logo_base64, sample_id, race, time.asctime(time.localtime(time.time()))), file=f)
+    print(basic_info%(logo_src, sample_id, race, time.asctime(time.localtime(time.time()))), file=f)
     
 
     ## Part 1: Sort disclaimer
@@ -242,14 +290,21 @@ def report (race, summary, prescribing_info, multi_var, single_var, phenotype_pr
     
     
     ## Part 4: Diplotype Detail
+    # Genes left out of the prediction, e.g. those not on a targeted panel, have no section
+    report_genes = [gene for gene in REPORT_GENES if gene in set(multi_var.Gene)]
+    if len(report_genes) > 1:
+      genes_text = '%s, and %s' % (', '.join(report_genes[:-1]), report_genes[-1])
+    else:
+      genes_text = ''.join(report_genes)
     print('<h2 id="diplotype detail"><b>Diplotype Detail</b></h2>', file=f)
     print('<h3 id="multi-variant"><b>Multi-variant allele</b></h3>', file=f)
-    print('<p class="main_lead">PAnno ranking model is applied to predict diplotypes consisting of multiple variants. The diplotypes are inferred by integrating allele definition consistency as well as the population allele frequency. PGx genes include CYP2B6, CYP2C19, CYP2C8, CYP2C9, CYP2D6, CYP3A4, CYP3A5, CYP4F2, DPYD, NUDT15, SLCO1B1, TPMT, and UGT1A1. Note that PAnno assumes that no variation occurs for the missing positions in the submitted VCF file.</p>', file=f)
-    for gene in ["CYP2B6", "CYP2C8", "CYP2C9", "CYP2C19", "CYP2D6", "CYP3A4", "CYP3A5", "CYP4F2", "DPYD", "NUDT15", "SLCO1B1", "TPMT", "UGT1A1"]:
+    if report_genes:
+      print('<p class="main_lead">PAnno ranking model is applied to predict diplotypes consisting of multiple variants. The diplotypes are inferred by integrating allele definition consistency as well as the population allele frequency. PGx genes include %s. Note that PAnno assumes that no variation occurs for the missing positions in the submitted VCF file.</p>' % genes_text, file=f)
+    for gene in report_genes:
       diplotype_by_gene = multi_var[multi_var.Gene == gene]
       dip = list(diplotype_by_gene.Diplotype.drop_duplicates())
       if len(dip) > 1:
-        print('Warning: There is more than one diplotype of %s inferred by PAnno.' % gene)
+        logger.warning('There is more than one diplotype of %s inferred by PAnno.', gene)
       print('<h3><b>%s: %s</b></h3>' % (gene, ''.join(dip)), file=f)
       if (gene == "CYP2B6"):
         print('<div class="alert alert-info-red">Please notice that CYP2B6*29, CYP2B6*30 are not considered in the current version, which could potentially have an impact on the results.</div>', file=f)
@@ -2,31 +2,99 @@
 # -*- coding: UTF-8 -*-
 
 
+from panno import vcf_reader
+from panno.log import logger
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import numpy as np
 import re, itertools, json, os
 
+# How the genes of a sample are dispatched by predict
+PREDICT_MODES = ('serial', 'thread', 'process')
+
+
+def rotations(seq):
+  return([seq[i:] + seq[:i] for i in range(len(seq))])
+
+
+def normalize_allele(ref, alt):
+  ## Trim the bases shared by REF and ALT (the VCF padding base first), leaving the indel as (kind, sequence)
+  i = 0
+  while i < min(len(ref), len(alt)) and ref[i] == alt[i]:
+    i += 1
+  ref = ref[i:]; alt = alt[i:]
+  j = 0
+  while j < min(len(ref), len(alt)) and ref[-1-j] == alt[-1-j]:
+    j += 1
+  ref = ref[:len(ref)-j]; alt = alt[:len(alt)-j]
+  if ref == '':
+    return('ins', alt)
+  elif alt == '':
+    return('del', ref)
+  else:
+    return('delins', alt)
+
+
+def allele_table(info):
+  ## For every defined position, map the (kind, sequence) forms a VCF indel can take to the defined base.
+  ## An indel in a repeat can be written at any phase of the repeat unit, so all rotations are keys.
+  ## At a repeat site (reference base 'refU'), del/ins bases count copies of U; the ins bases either count
+  ## the inserted copies (an 'insU' exists) or the inserted copies plus the reference one (e.g. refG/insGG).
+  hap_define = info['haplotype_definition']
+  ref_hap = info['reference_haplotype']
+  table = {}
+  for source_pos in hap_define[ref_hap].keys():
+    defined = []
+    for key in hap_define.keys():
+      defined.extend(hap_define[key][source_pos])
+    defined = sorted(set(defined))
+    units = [base[3:] for base in hap_define[ref_hap][source_pos] if base.startswith('ref')]
+    unit = units[0] if units else None
+    exact = {}; rotated = {}
+    for base in defined:
+      if base.startswith('delins'):
+        exact[('delins', base[6:])] = base
+        continue
+      kind, seq = base[:3], base[3:]
+      if kind not in ('del', 'ins') or seq == '':
+        continue
+      copies = len(seq) // len(unit) if unit else 0
+      if copies > 0 and seq == unit * copies:
+        if kind == 'ins' and 'ins' + unit not in defined:
+          copies = copies - 1
+        exact[(kind, unit * copies)] = base
+        for rotation in rotations(unit):
+          rotated.setdefault((kind, rotation * copies), base)
+      else:
+        exact[(kind, seq)] = base
+        for rotation in rotations(seq):
+          rotated.setdefault((kind, rotation), base)
+    for key, base in rotated.items():
+      exact.setdefault(key, base)
+    table[source_pos] = {'defined': defined, 'lookup': exact}
+  return(table)
+
 
 def parse_input_allele(filtered_vcf, info):
   hap_define = info['haplotype_definition']
   hap_define_display = info['haplotype_definition_display']
   ref_hap = info['reference_haplotype']
+  # Compiled by load_definitions; built here (and not stored, the definitions may be shared between threads) otherwise
+  table = info['allele_table'] if 'allele_table' in info else allele_table(info)
   
-  vcf_df_all = filtered_vcf.copy()
-  vcf_df = vcf_df_all[vcf_df_all['#CHROM'] == info['chrom']]
-  cols = vcf_df.columns.to_list()
+  vcf_df = filtered_vcf[filtered_vcf['#CHROM'] == info['chrom']]
+  ## Interval index of the positions confidently called as reference: 0/0 records, mostly gVCF reference blocks.
+  ## A position is covered when the furthest END among the records starting at or before it reaches it.
+  ref_calls = vcf_df[(vcf_df.GT1 == 0) & (vcf_df.GT2 <= 0)].sort_values('POS')
+  ref_starts = ref_calls.POS.to_numpy()
+  ref_ends = np.maximum.accumulate(ref_calls.END.to_numpy())
   
-  vcf_alleles = {}; vcf_alleles_display = {}
+  vcf_alleles = {}; vcf_alleles_display = {}; unmatched = []
   hap_pos = list(hap_define[ref_hap].keys())
   for source_pos in hap_pos:
     # ref_hap_base, Only two loci of CYP2D6 gene will have more than one ref_hap_base
     ref_hap_base = hap_define[ref_hap][source_pos]
     ref_hap_base_display = hap_define_display[ref_hap][source_pos].split(':')[-1]
-    
-    # Get all possible bases at this position
-    defined = []
-    for key in hap_define.keys():
-      defined.extend(hap_define[key][source_pos])
-    defined = list(set(defined))
+    lookup = table[source_pos]['lookup']
     
     # Transfer the positions into the format of list
     pos_rs = source_pos.split(':')
@@ -43,102 +111,45 @@ def parse_input_allele(filtered_vcf, info):
     mat = vcf_df[(vcf_df['POS'].isin(pos)) | (vcf_df['ID'] == pos_rs[1])]
     if mat.empty:
       vcf_alleles[source_pos] = (ref_hap_base, ref_hap_base)
-      vcf_alleles_display[source_pos] = 'Missing'
+      block = np.searchsorted(ref_starts, pos, side='right') - 1
+      if len(ref_starts) > 0 and (block >= 0).all() and (ref_ends[block] >= pos).all():
+        vcf_alleles_display[source_pos] = ref_hap_base_display + '/' + ref_hap_base_display
+      else:
+        vcf_alleles_display[source_pos] = 'Missing'
     else:
       is_wild_type = 1
-      for index, row in mat.iterrows():
-        cols = mat.columns.to_list()
-        format = row[cols.index("FORMAT")].split(":")
-        gt = row[-1].split(":")[format.index("GT")]
-        if re.findall('0', gt) == ['0', '0']:
+      for row in mat.itertuples():
+        if row.GT1 == 0 and row.GT2 == 0:
           continue
         else:
           ## Only process the first line which genotype is not wild type.
           ## !!! Therefore, the end of 'else' is break
           tuple_res = (); tuple_res_display = ()
           is_wild_type = 0
-          ref = row[cols.index("REF")]
-          alts = row[cols.index("ALT")].split(",")
+          ref = row.REF
+          alts = row.ALT.split(",")
           opts = [ref]; opts.extend(alts)
-          gts = re.split('/|\|', gt)
-          if len(gts) == 1: # chrX
-            gts.append(gts[0])
+          gts = [row.GT1, row.GT2]
+          if row.GT2 < 0: # chrX, haploid call
+            gts[1] = gts[0]
           for gt_index in gts:
-            base = None; base_raw = None
-            if gt_index == '0':
+            if gt_index == 0:
               base = ref_hap_base; base_raw = ref_hap_base_display
             else:
-              alt = opts[int(gt_index)]
+              alt = opts[gt_index]
               # SNP #
               if len(alt) == len(ref):
                 base = alt
                 base_raw = alt
-              ### ! If alt was not match the definition, try to combine with the following position base and test again
-              # Del #
-              elif len(alt) < len(ref):
-                base = 'del%s' % ref[len(alt):]
-                if base not in defined:
-                  pos_of_mat = mat.index.to_list()
-                  pos_order = pos_of_mat.index(index)
-                  if pos_order < len(pos_of_mat)-1 and mat.loc[pos_of_mat[pos_order+1], 'POS'] == row.POS+1:
-                    new_row = mat.loc[pos_of_mat[pos_order+1],]
-                    base = 'del%s' % ref[len(alt)+1:] + new_row.REF
-                  elif int(row.POS) == 42128173 and base == 'delCTT':
-                    base = 'delTCT'
-                ## A smooth judge part
-                if base not in defined:
-                  # small indel
-                  if ref_hap_base[0].startswith('ref') and base[-1] == ref_hap_base[0][-2]:
-                    base = 'del' + base[4:] + ref_hap_base[0][-1]
-                  # long del
-                  else:
-                    modd = ref_hap_base[0].replace('ref', '')
-                    if re.search(modd, base):
-                      matched_span = re.search(modd, base).span()
-                      if modd.startswith(base[matched_span[1]:]):
-                        base = 'del' + modd * int((matched_span[1] - matched_span[0])/len(modd) + 1)
-                      else:
-                        base = 'del' + modd * int((matched_span[1] - matched_span[0])/len(modd))
-                base_raw = base
-                if base not in defined:
-                  print('Warning in Del!'); print(row.T); print(pos); print(base)
-              # Ins #
-              elif len(alt) > len(ref):
-                base = 'ins%s' % alt[len(ref):]
-                if base not in defined:
-                  pos_of_mat = mat.index.to_list()
-                  pos_order = pos_of_mat.index(index)
-                  if pos_order < len(pos_of_mat)-1 and mat.loc[pos_of_mat[pos_order+1], 'POS'] == row.POS+1:
-                    new_row = mat.loc[pos_of_mat[pos_order+1],]
-                    base = 'ins%s' % alt[len(ref)+1:] + new_row.REF
-                ## A smooth judge part
-                if base not in defined:
-                  # small indel
-                  if ref_hap_base[0].startswith('ref') and base[-1] == ref_hap_base[0][-2]:
-                    base = 'ins' + base[4:] + ref_hap_base[0][-1]
-                  # long dup
-                  else:
-                    flag = 0; modd = 'modd'
-                    if ref_hap_base[0].startswith('ref') is False:
-                      for r in defined:
-                        if r.startswith('delins'):
-                          modd = 'C'; flag = 1; break
-                    else:
-                      modd = ref_hap_base[0].replace('ref', '')
-                    # print(mat, defined, ref_hap_base, base, ref, alt, ref_hap)
-                    if modd != 'modd':
-                      if re.search(modd, base):
-                        matched_span = re.search(modd, base).span()
-                        if modd.startswith(base[matched_span[1]:]):
-                          base = 'ins' + modd * int((matched_span[1] - matched_span[0])/len(modd) + 1)
-                        else:
-                          base = 'ins' + modd * int((matched_span[1] - matched_span[0])/len(modd))
-                    if flag == 1:
-                      base = 'del' + base + 'C'
-                base_raw = alt
-                if base not in defined:
-                  print('Warning in Ins or Dup on %s:%s! Input variant is %s, while the definition is %s.' % (info['chrom'], pos, base, '|'.join(defined)))
-                  print(row.to_dict())
+              # Del, Ins, Dup #
+              else:
+                kind, seq = normalize_allele(ref, alt)
+                base = lookup.get((kind, seq))
+                if base is None:
+                  base = kind + seq
+                  unmatched.append({'chrom': info['chrom'], 'pos': int(row.POS), 'ref': ref, 'alt': alt, 'position': source_pos,
+                                    'allele': base, 'defined': table[source_pos]['defined']})
+                base_raw = base if len(alt) < len(ref) else alt
             ## Add the result into tuple_res
             tuple_res = tuple_res + (base,)
             tuple_res_display = tuple_res_display + (base_raw,)
@@ -151,8 +162,6 @@ def parse_input_allele(filtered_vcf, info):
         vcf_alleles[source_pos] = tuple_res
         # vcf_alleles_display[source_pos] = ';'.join(['|'.join(res) for res in list(zip(tuple_res_display[0], tuple_res_display[1]))])
         vcf_alleles_display[source_pos] = tuple_res_display[0] + '/' + tuple_res_display[1]
-        if None in tuple_res:
-          print('Warning! None was reported.')
   
   # Check the format of output
   fine_vcf_alleles = {}
@@ -165,7 +174,7 @@ def parse_input_allele(filtered_vcf, info):
         tuple_res = tuple_res + (base,)
     fine_vcf_alleles[source_pos] = tuple_res
   
-  return(fine_vcf_alleles, vcf_alleles_display)
+  return(fine_vcf_alleles, vcf_alleles_display, unmatched)
 
 
 def predict_diplotype(vcf_alleles, info, race):
@@ -253,48 +262,88 @@ def predict_diplotype(vcf_alleles, info, race):
   return("; ".join(exact_match_res), "; ".join(rank_step1_res), "; ".join(final_rank_res))
 
 
-def predict(filtered_vcf, race, gene_list):
+def load_definitions():
   panno_dip_fp = os.path.join(os.path.dirname(__file__), 'assets/pgx_diplotypes.json')
   # panno_dip_fp = "./panno/assets/pgx_diplotypes.json"
   panno_dip_base = json.loads(open(panno_dip_fp).read())
-  dic_diplotype = {}
-  dic_diplotype_detail = {}
-  for gene in gene_list:
-    info = panno_dip_base[gene]
-    hap_define_display = info['haplotype_definition_display']
-    vcf_alleles, vcf_alleles_display = parse_input_allele(filtered_vcf, info)
-    exact_match_res, rank_step1_res, final_rank_res = predict_diplotype(vcf_alleles, info, race)
-    
-    if final_rank_res == '':
-      final_rank_res = '-'
-    
-    # Detail of diplotypes
-    if final_rank_res != '-':
-      tmp = re.split('; |/', final_rank_res)
-      haplotypes = sorted(set(tmp), key = tmp.index)
-    else:
-      haplotypes = [info['reference_haplotype']]
-    diplotype_details = []
-    for source_pos in vcf_alleles_display.keys():
-      detected_allele = vcf_alleles_display[source_pos]
-      base_all = []
-      for hap in haplotypes:
-        chrom, nc, ng, rs, pc, base = hap_define_display[hap][source_pos].split(':')
-        # position
-        matchobj = re.search(r'\w\.(\d+)\_(\d+)(del|ins)(\w*)', ng)
+  # Compile the allele lookup tables up front, so the definitions are read-only afterwards
+  for gene in panno_dip_base.keys():
+    panno_dip_base[gene]['allele_table'] = allele_table(panno_dip_base[gene])
+  return(panno_dip_base)
+
+
+def predict_gene(filtered_vcf, race, info):
+  hap_define_display = info['haplotype_definition_display']
+  vcf_alleles, vcf_alleles_display, unmatched = parse_input_allele(filtered_vcf, info)
+  exact_match_res, rank_step1_res, final_rank_res = predict_diplotype(vcf_alleles, info, race)
+  
+  if final_rank_res == '':
+    final_rank_res = '-'
+  
+  # Detail of diplotypes
+  if final_rank_res != '-':
+    tmp = re.split('; |/', final_rank_res)
+    haplotypes = sorted(set(tmp), key = tmp.index)
+  else:
+    haplotypes = [info['reference_haplotype']]
+  diplotype_details = []
+  for source_pos in vcf_alleles_display.keys():
+    detected_allele = vcf_alleles_display[source_pos]
+    base_all = []
+    for hap in haplotypes:
+      chrom, nc, ng, rs, pc, base = hap_define_display[hap][source_pos].split(':')
+      # position
+      matchobj = re.search(r'\w\.(\d+)\_(\d+)(del|ins)(\w*)', ng)
+      if matchobj:
+        pos = int(matchobj.group(1))
+      else:
+        matchobj = re.search(r'\w\.(\d+)(\w*)', ng)
         if matchobj:
-          pos = int(matchobj.group(1))
+          pos = matchobj.group(1)
         else:
-          matchobj = re.search(r'\w\.(\d+)(\w*)', ng)
-          if matchobj:
-            pos = matchobj.group(1)
-          else:
-            print(ng)
-        base_all.append(hap + ':' + base)
-      identified_allele = '; '.join(base_all)
-      diplotype_details.append((chrom, pos, nc, ng, rs, pc, identified_allele, detected_allele))
-    
-    # Collect the results
-    dic_diplotype[gene] = {'exact_res': exact_match_res, 'step1_res': rank_step1_res, 'step2_res': final_rank_res, 'detail': diplotype_details}
+          logger.warning('The genomic position of %s (%s) cannot be parsed.', source_pos, ng)
+      base_all.append(hap + ':' + base)
+    identified_allele = '; '.join(base_all)
+    diplotype_details.append((chrom, pos, nc, ng, rs, pc, identified_allele, detected_allele))
+  
+  # Collect the results
+  return({'exact_res': exact_match_res, 'step1_res': rank_step1_res, 'step2_res': final_rank_res, 'detail': diplotype_details, 'unmatched': unmatched})
+
+
+def gene_cost(info):
+  ## Diplotype candidates times defined positions, the work of predict_diplotype: G6PD and CYP2D6 dominate
+  n_hap = len(info['haplotype_definition'])
+  return(n_hap * (n_hap + 1) // 2 * len(info['haplotype_definition'][info['reference_haplotype']]))
+
+
+def predict(filtered_vcf, race, gene_list, panno_dip_base=None, mode='serial', workers=None):
+  ## mode is one of PREDICT_MODES; with 'thread' or 'process', the genes run on a pool of workers (default: number of cores)
+  if panno_dip_base is None:
+    panno_dip_base = load_definitions()
+  if mode not in PREDICT_MODES:
+    raise ValueError('The prediction mode must be one of %s.' % ', '.join(PREDICT_MODES))
+  dic_diplotype = {}
+  if mode == 'serial' or len(gene_list) < 2:
+    for gene in gene_list:
+      dic_diplotype[gene] = predict_gene(filtered_vcf, race, panno_dip_base[gene])
+  else:
+    if workers is None:
+      workers = vcf_reader.default_threads()
+    executor = ThreadPoolExecutor if mode == 'thread' else ProcessPoolExecutor
+    # The largest genes are submitted first so that they do not start last; the results are still collected in gene_list order
+    order = sorted(gene_list, key=lambda gene: -gene_cost(panno_dip_base[gene]))
+    with executor(min(workers, len(gene_list))) as pool:
+      futures = {}
+      for gene in order:
+        info = panno_dip_base[gene]
+        # parse_input_allele only reads the records on the chromosome of the gene, so only those are sent to the worker
+        futures[gene] = pool.submit(predict_gene, filtered_vcf[filtered_vcf['#CHROM'] == info['chrom']], race, info)
+      for gene in gene_list:
+        dic_diplotype[gene] = futures[gene].result()
+  
+  for gene in gene_list:
+    logger.debug('%s diplotype: %s', gene, dic_diplotype[gene]['step2_res'])
+    for allele in dic_diplotype[gene]['unmatched']:
+      logger.warning('%s %s:%s %s>%s is not a defined allele of %s, read as %s.', gene, allele['chrom'], allele['pos'], allele['ref'], allele['alt'], allele['position'], allele['allele'], extra={'data': dict(allele, gene=gene)})
     
   return(dic_diplotype)
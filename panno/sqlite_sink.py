@@ -0,0 +1,67 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+
+from panno.pgx_batch import TABLE_COLUMNS
+import sqlite3
+
+# Samples written per transaction
+COMMIT_SAMPLES = 200
+
+# Indexes for the usual questions: the samples with a phenotype of a gene, or with a recommendation or classification for a drug
+INDEXES = {
+  'diplotypes': [('gene', 'phenotype'), ('gene', 'diplotype')],
+  'drugs': [('drug', 'category')],
+  'guidelines': [('drug', 'gene', 'phenotype'), ('gene', 'phenotype')],
+  'phenotypes': [('drug', 'phenotype_category', 'prediction')],
+  'annotations': [('drug', 'gene'), ('gene', 'phenotype')],
+  'variants': [('variant', 'call')],
+}
+
+SQL_TYPES = {'str': 'TEXT', 'int': 'INTEGER', 'float': 'REAL'}
+
+
+class SqliteSink(object):
+  ## Writes the tables of a batch to a SQLite database in WAL mode, so that it can be queried while the batch runs.
+  ## Only the process running the batch writes; the samples are buffered and written COMMIT_SAMPLES per transaction.
+  ## A sample written again replaces its previous rows.
+  def __init__(self, db_fp, commit_samples=COMMIT_SAMPLES):
+    self.conn = sqlite3.connect(db_fp)
+    self.conn.execute('PRAGMA journal_mode=WAL;')
+    self.conn.execute('PRAGMA synchronous=NORMAL;')
+    with self.conn:
+      for table, columns in TABLE_COLUMNS.items():
+        fields = ['%s %s' % (column, SQL_TYPES[type]) for column, type in columns]
+        if table == 'samples':
+          fields[0] += ' PRIMARY KEY'
+        self.conn.execute('CREATE TABLE IF NOT EXISTS %s (%s);' % (table, ', '.join(fields)))
+        if table != 'samples':
+          self.conn.execute('CREATE INDEX IF NOT EXISTS idx_%s_sample_id ON %s (sample_id);' % (table, table))
+        for index in INDEXES.get(table, []):
+          self.conn.execute('CREATE INDEX IF NOT EXISTS idx_%s_%s ON %s (%s);' % (table, '_'.join(index), table, ', '.join(index)))
+    self.inserts = {table: 'INSERT INTO %s VALUES (%s);' % (table, ', '.join('?' * len(columns))) for table, columns in TABLE_COLUMNS.items()}
+    self.commit_samples = commit_samples
+    self.buffer = []
+
+  def add(self, tables):
+    self.buffer.append(tables)
+    if len(self.buffer) >= self.commit_samples:
+      self.flush()
+
+  def flush(self):
+    if not self.buffer:
+      return
+    sample_ids = [(tables['samples'].sample_id.iloc[0],) for tables in self.buffer]
+    with self.conn:
+      for table in TABLE_COLUMNS:
+        self.conn.executemany('DELETE FROM %s WHERE sample_id = ?;' % table, sample_ids)
+        rows = []
+        for tables in self.buffer:
+          # to_dict gives Python scalars, which sqlite3 binds (numpy scalars are not)
+          rows.extend(tables[table].to_dict('split')['data'])
+        self.conn.executemany(self.inserts[table], rows)
+    self.buffer = []
+
+  def close(self):
+    self.flush()
+    self.conn.close()
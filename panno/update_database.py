@@ -1,8 +1,9 @@
 import sqlite3
 import pandas as pd
-import shutil
 import os
 import time
+import math
+import hashlib
 
 # Configuracion de rutas (asumiendo ejecución desde el directorio 'panno')
 DB_PATH = "./assets/pgx_kb.sqlite3"
@@ -14,6 +15,25 @@ CSV_FILES = {
     "GuidelineRule": "GuidelineRule_Review.csv"
 }
 
+# Filas por llamada a executemany
+BATCH_SIZE = 5000
+
+# La actualización se construye en este archivo y solo reemplaza a DB_PATH si pasa la validación
+BUILD_PATH = f"{DB_PATH}.building"
+
+def copy_database(src_path, dst_path):
+    """
+    Copia la base de datos con la API de backup en línea de SQLite: la copia es consistente
+    aunque otro proceso esté leyendo la base y no bloquea a los lectores.
+    """
+    src = sqlite3.connect(f"file:{os.path.abspath(src_path)}?mode=ro", uri=True)
+    dst = sqlite3.connect(dst_path)
+    try:
+        src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
+
 def backup_database():
     if not os.path.exists(DB_PATH):
         print(f"No se encontró la base de datos en {DB_PATH}")
@@ -23,13 +43,75 @@ def backup_database():
     backup_path = f"{DB_PATH}.backup_{timestamp}"
     
     try:
-        shutil.copy(DB_PATH, backup_path)
+        copy_database(DB_PATH, backup_path)
         print(f"Respaldo creado exitosamente: {backup_path}")
         return True
     except Exception as e:
         print(f"Error creando respaldo: {e}")
         return False
 
+def read_review_csv(csv_path):
+    """
+    Lee un CSV de revisión. Solo las celdas vacías son NaN: textos como 'N/A', 'NA' o 'null' se guardan
+    tal cual en SQLite y deben leerse igual para que el diff no los tome por cambios.
+    """
+    return pd.read_csv(csv_path, keep_default_na=False, na_values=[""])
+
+def normalize_value(value):
+    """Normaliza un valor leído del CSV o de SQLite para comparar filas (NaN/None -> '', 1.0 -> '1')."""
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+def row_hashes(df, columns):
+    """
+    Hash de contenido de cada fila sobre las columnas dadas. Las filas repetidas se distinguen
+    por su número de aparición para que el diff las trate como multiconjunto.
+    """
+    if df.empty:
+        return pd.Series([], index=df.index, dtype=object)
+    normalized = df[columns].apply(lambda col: col.map(normalize_value))
+    digests = normalized.apply(lambda row: hashlib.sha1("\x1f".join(row).encode("utf-8")).hexdigest(), axis=1)
+    occurrence = digests.groupby(digests).cumcount().astype(str)
+    return digests + ":" + occurrence
+
+def diff_table(conn, table_name, df):
+    """
+    Compara el CSV con la tabla actual. Si el CSV trae la columna ID se usa como clave primaria;
+    si no (ClinAnn), las filas se emparejan por hash de contenido.
+    Devuelve (filas a insertar, filas a actualizar, rowids a borrar).
+    """
+    columns = list(df.columns)
+    db_df = pd.read_sql_query(f"SELECT rowid AS _rowid_, * FROM {table_name}", conn)
+    
+    if "ID" in columns:
+        csv_idx = df.set_index("ID", drop=False)
+        db_idx = db_df.set_index("ID", drop=False)
+        inserted = df[~df["ID"].isin(db_idx.index)]
+        deleted = db_df[~db_df["ID"].isin(csv_idx.index)]["_rowid_"]
+        common = df["ID"][df["ID"].isin(db_idx.index)]
+        if len(common) > 0:
+            csv_common = row_hashes(csv_idx.loc[common], columns)
+            db_common = row_hashes(db_idx.loc[common], columns)
+            changed = csv_common.values != db_common.values
+            updated = csv_idx.loc[common[changed]]
+        else:
+            updated = df.iloc[0:0]
+    else:
+        csv_hash = row_hashes(df, columns)
+        db_hash = row_hashes(db_df, columns)
+        inserted = df[~csv_hash.isin(set(db_hash))]
+        deleted = db_df[~db_hash.isin(set(csv_hash))]["_rowid_"]
+        updated = df.iloc[0:0]
+    
+    return inserted, updated, deleted
+
+def executemany_batched(cursor, sql, rows):
+    for start in range(0, len(rows), BATCH_SIZE):
+        cursor.executemany(sql, rows[start:start + BATCH_SIZE])
+
 def update_table(conn, table_name, csv_file):
     csv_path = os.path.join(DATA_DIR, csv_file)
     if not os.path.exists(csv_path):
@@ -40,7 +122,7 @@ def update_table(conn, table_name, csv_file):
     
     try:
         # Leer CSV
-        df = pd.read_csv(csv_path)
+        df = read_review_csv(csv_path)
         # Reemplazar NaN con string vacío para evitar errores NOT NULL en SQLite
         df.fillna("", inplace=True)
         print(f"   Leídas {len(df)} filas del CSV.")
@@ -52,13 +134,22 @@ def update_table(conn, table_name, csv_file):
         count_before = cursor.fetchone()[0]
         print(f"   Registros en DB antes: {count_before}")
         
-        # Borrar datos viejos
-        cursor.execute(f"DELETE FROM {table_name}")
-        print("    Datos antiguos borrados.")
+        # Solo se escriben las diferencias; la transacción la confirma main()
+        inserted, updated, deleted = diff_table(conn, table_name, df)
+        print(f"   Cambios: {len(inserted)} nuevos, {len(updated)} modificados, {len(deleted)} borrados.")
         
-        # Insertar nuevos datos
-        # Esto usa pandas to_sql, que es conveniente. 'append' porque acabamos de borrar.
-        df.to_sql(table_name, conn, if_exists='append', index=False)
+        columns = list(df.columns)
+        quoted = ", ".join(f'"{c}"' for c in columns)
+        executemany_batched(cursor, f"DELETE FROM {table_name} WHERE rowid = ?",
+                            [(int(rowid),) for rowid in deleted])
+        if not updated.empty:
+            assignments = ", ".join(f'"{c}" = ?' for c in columns if c != "ID")
+            rows = updated[[c for c in columns if c != "ID"] + ["ID"]].astype(object).values.tolist()
+            executemany_batched(cursor, f"UPDATE {table_name} SET {assignments} WHERE ID = ?", rows)
+        if not inserted.empty:
+            placeholders = ", ".join("?" * len(columns))
+            executemany_batched(cursor, f"INSERT INTO {table_name} ({quoted}) VALUES ({placeholders})",
+                                inserted[columns].astype(object).values.tolist())
         
         # Verificar nuevo conteo
         cursor.execute(f"SELECT COUNT(*) FROM {table_name}")
@@ -71,6 +162,36 @@ def update_table(conn, table_name, csv_file):
         print(f"❌ Error actualizando {table_name}: {e}")
         return False
 
+def rebuild_indexes(conn):
+    """Reconstruye índices y estadísticas del planificador después de aplicar los cambios."""
+    conn.execute("REINDEX")
+    conn.execute("ANALYZE")
+    conn.commit()
+
+def validate_database(conn):
+    """Comprueba la integridad de la base construida y que cada tabla tenga tantas filas como su CSV."""
+    integrity = conn.execute("PRAGMA integrity_check").fetchall()
+    if integrity != [("ok",)]:
+        print(f"❌ integrity_check falló: {integrity[:5]}")
+        return False
+    fk_errors = conn.execute("PRAGMA foreign_key_check").fetchall()
+    if fk_errors:
+        print(f"❌ foreign_key_check encontró {len(fk_errors)} referencias rotas.")
+        return False
+    for table_name, csv_file in CSV_FILES.items():
+        expected = len(read_review_csv(os.path.join(DATA_DIR, csv_file)))
+        count = conn.execute(f"SELECT COUNT(*) FROM {table_name}").fetchone()[0]
+        if count != expected:
+            print(f"❌ {table_name} tiene {count} filas, se esperaban {expected}.")
+            return False
+    return True
+
+def publish_database(build_path):
+    """Sincroniza el archivo construido a disco y lo publica con un rename atómico sobre DB_PATH."""
+    with open(build_path, "rb") as f:
+        os.fsync(f.fileno())
+    os.replace(build_path, DB_PATH)
+
 def main():
     print(" INICIANDO ACTUALIZACIÓN DE BASE DE DATOS")
     
@@ -79,11 +200,20 @@ def main():
         print(" Abortando actualización por fallo en respaldo.")
         return
 
-    # 2. Conexión
+    # 2. Copia de trabajo: la base publicada no se modifica nunca en su sitio, así los procesos
+    # que la estén leyendo siguen viendo la versión anterior completa hasta el rename
+    if os.path.exists(BUILD_PATH):
+        os.remove(BUILD_PATH)
+    conn = None
     try:
-        conn = sqlite3.connect(DB_PATH)
+        copy_database(DB_PATH, BUILD_PATH)
+        conn = sqlite3.connect(BUILD_PATH)
         # Habilitar claves foráneas por si acaso, aunque pandas lo maneja bastante crudo
         conn.execute("PRAGMA foreign_keys = ON") 
+        # Una sola transacción para las tres tablas; las claves foráneas se comprueban al confirmar,
+        # así el orden de los borrados entre GuidelineMerge y GuidelineRule no importa
+        conn.execute("BEGIN")
+        conn.execute("PRAGMA defer_foreign_keys = ON")
         
         success_clinann = update_table(conn, "ClinAnn", CSV_FILES["ClinAnn"])
         success_guide = update_table(conn, "GuidelineMerge", CSV_FILES["GuidelineMerge"])
@@ -91,15 +221,27 @@ def main():
         
         if success_clinann and success_guide and success_rule:
             conn.commit()
-            print("\n✨ TRANSACCIÓN COMPLETADA EXITOSAMENTE. Los cambios se han guardado.")
+            rebuild_indexes(conn)
+            print("\n   Índices y estadísticas (ANALYZE) reconstruidos.")
+            if validate_database(conn):
+                conn.close()
+                conn = None
+                publish_database(BUILD_PATH)
+                print(f"\n✨ ACTUALIZACIÓN PUBLICADA EXITOSAMENTE en {DB_PATH}.")
+                return
+            print("\n LA VALIDACIÓN FALLÓ. La base de datos publicada no se modificó.")
         else:
             conn.rollback()
             print("\n HUBO ERRORES. Se hizo ROLLBACK, la base de datos no se modificó.")
-            
-        conn.close()
         
     except Exception as e:
         print(f" Error de conexión o transacción: {e}")
+    
+    # Cualquier fallo descarta la copia de trabajo
+    if conn is not None:
+        conn.close()
+    if os.path.exists(BUILD_PATH):
+        os.remove(BUILD_PATH)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,436 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import os, re, gzip, mmap, bisect, struct, zlib
+
+# Number of BGZF blocks (at most 64 KB each once inflated) decompressed by one task
+BGZF_BATCH = 64
+
+## BCF typed values: type code -> (struct format, size, end-of-vector sentinel)
+BCF_TYPES = {1: ('b', 1, -127), 2: ('h', 2, -32767), 3: ('i', 4, -2147483647), 5: ('f', 4, None), 7: ('s', 1, None)}
+
+
+def default_threads():
+  return(min(32, os.cpu_count() or 1))
+
+
+def is_bgzf(path):
+  ## gzip magic with the FEXTRA flag set and a 'BC' subfield in the first member
+  with open(path, 'rb') as handle:
+    header = handle.read(18)
+  return(len(header) == 18 and header[:4] == b'\x1f\x8b\x08\x04' and header[12:14] == b'BC')
+
+
+def is_bcf(path):
+  ## BGZF compressed file whose first block starts with the BCF magic
+  with open(path, 'rb') as handle:
+    block = next(bgzf_blocks(handle), None)
+  return(block is not None and inflate_batch([block])[:4] == b'BCF\x02')
+
+
+def is_gzip(path):
+  with open(path, 'rb') as handle:
+    return(handle.read(2) == b'\x1f\x8b')
+
+
+def bgzf_blocks(handle):
+  ## Raw deflate payload and expected (CRC32, ISIZE) of every BGZF block, in file order
+  while True:
+    header = handle.read(12)
+    if len(header) < 12:
+      return
+    if header[:4] != b'\x1f\x8b\x08\x04':
+      raise ValueError('Not a BGZF block at offset %d.' % (handle.tell() - len(header)))
+    xlen = struct.unpack('<H', header[10:12])[0]
+    extra = handle.read(xlen)
+    bsize = None; i = 0
+    while i + 4 <= xlen:
+      slen = struct.unpack('<H', extra[i+2:i+4])[0]
+      if extra[i:i+2] == b'BC':
+        bsize = struct.unpack('<H', extra[i+4:i+6])[0]
+      i += 4 + slen
+    if bsize is None:
+      raise ValueError('BGZF block without a BC subfield.')
+    cdata = handle.read(bsize - xlen - 19)
+    crc, isize = struct.unpack('<II', handle.read(8))
+    yield(cdata, crc, isize)
+
+
+def inflate_batch(batch):
+  ## zlib releases the GIL, so batches are inflated in parallel by the worker threads
+  data = []
+  for cdata, crc, isize in batch:
+    block = zlib.decompress(cdata, -15)
+    if len(block) != isize or zlib.crc32(block) != crc:
+      raise ValueError('Corrupted BGZF block.')
+    data.append(block)
+  return(b''.join(data))
+
+
+def bgzf_batches(handle):
+  batch = []
+  for block in bgzf_blocks(handle):
+    batch.append(block)
+    if len(batch) == BGZF_BATCH:
+      yield(batch)
+      batch = []
+  if batch:
+    yield(batch)
+
+
+def bgzf_chunks(path, threads=None):
+  ## Inflated data of a BGZF file, in order, with up to threads * 2 batches in flight
+  if threads is None:
+    threads = default_threads()
+  with open(path, 'rb') as handle:
+    if threads <= 1:
+      yield from map(inflate_batch, bgzf_batches(handle))
+      return
+    with ThreadPoolExecutor(max_workers = threads) as pool:
+      pending = deque()
+      for batch in bgzf_batches(handle):
+        pending.append(pool.submit(inflate_batch, batch))
+        if len(pending) >= threads * 2:
+          yield(pending.popleft().result())
+      while pending:
+        yield(pending.popleft().result())
+
+
+def bgzf_lines(path, threads=None):
+  rest = b''
+  for chunk in bgzf_chunks(path, threads):
+    chunk = rest + chunk
+    end = chunk.rfind(b'\n') + 1
+    rest = chunk[end:]
+    yield from chunk[:end].decode('utf-8').splitlines(True)
+  if rest:
+    yield(rest.decode('utf-8'))
+
+
+def bgzf_range(handle, vbeg, vend, cache):
+  ## Inflated bytes between two virtual offsets (offset of the compressed block << 16 | offset within the block).
+  ## The last block read is kept in cache, since neighbouring ranges often share it.
+  handle.seek(vbeg >> 16)
+  blocks = bgzf_blocks(handle)
+  data = []; cut = 0
+  while True:
+    coffset = handle.tell()
+    if coffset > vend >> 16 or (coffset == vend >> 16 and vend & 0xffff == 0):
+      break
+    if coffset in cache:
+      block, size = cache[coffset]
+      handle.seek(coffset + size)
+      blocks = bgzf_blocks(handle)
+    else:
+      raw = next(blocks, None)
+      if raw is None:
+        break
+      block = inflate_batch([raw]); size = handle.tell() - coffset
+      cache.clear()
+      cache[coffset] = (block, size)
+    data.append(block)
+    cut += len(block) if coffset < vend >> 16 else vend & 0xffff
+  return(b''.join(data)[vbeg & 0xffff:cut])
+
+
+def line_start(mm, offset, lo):
+  ## Start of the first line at or after offset
+  if offset <= lo or mm[offset-1] == 10:
+    return(offset)
+  nl = mm.find(b'\n', offset)
+  return(len(mm) if nl < 0 else nl + 1)
+
+
+def record_key(mm, start):
+  ## (CHROM, POS) of the record starting at start; None for a blank or truncated line
+  first = mm.find(b'\t', start, start + 1024)
+  second = mm.find(b'\t', first + 1, first + 32)
+  if first < 0 or second < 0:
+    return(None)
+  return(mm[start:first], int(mm[first+1:second]))
+
+
+def bisect_lines(mm, lo, hi, before):
+  ## First line start in [lo, hi) whose record is not before(key); records must be ordered accordingly
+  first = lo
+  while lo < hi:
+    mid = (lo + hi) // 2
+    start = line_start(mm, mid, first)
+    if start < hi and before(record_key(mm, start)):
+      lo = mm.find(b'\n', start, hi) + 1 or hi
+    else:
+      hi = mid
+  return(line_start(mm, lo, first))
+
+
+def contig_ranges(mm, body):
+  ## Byte range of every contig in file order, found by bisection; None when a contig is found twice.
+  ## The records of each contig must be sorted by POS, which is not checked: a record out of order may be missed.
+  ranges = []; seen = set()
+  start = body
+  while start < len(mm):
+    key = record_key(mm, start)
+    if key is None:
+      break
+    chrom = key[0]
+    if chrom in seen:
+      return(None)
+    seen.add(chrom)
+    end = bisect_lines(mm, start, len(mm), lambda k: k is not None and k[0] == chrom)
+    ranges.append((chrom.decode('utf-8'), start, end))
+    start = end
+  return(ranges)
+
+
+def region_spans(mm, body, loci):
+  ## Byte spans of the records whose POS falls in the PGx loci (plus the record before each locus), or None when a contig is split
+  ranges = contig_ranges(mm, body)
+  if ranges is None:
+    return(None)
+  spans = []
+  for chrom, start, end in ranges:
+    intervals = loci.get(re.sub('chr|Chr|CHR', '', chrom))
+    if intervals is None:
+      continue
+    offset = start
+    for lo, hi in zip(intervals[0], intervals[1]):
+      first = bisect_lines(mm, offset, end, lambda k: k[1] < lo)
+      stop = bisect_lines(mm, first, end, lambda k: k[1] <= hi)
+      ## The record just before may be a gVCF reference block reaching into the locus (gVCF records do not overlap)
+      if first > offset:
+        first = max(offset, mm.rfind(b'\n', start, first - 1) + 1)
+      if stop > first:
+        spans.append((first, stop))
+      offset = stop
+  return(spans)
+
+
+def mmap_lines(path, loci):
+  ## Header plus the records at PGx loci of a sorted plain VCF, decoded without reading the rest of the file
+  with open(path, 'rb') as handle:
+    if os.fstat(handle.fileno()).st_size == 0:
+      return
+    with mmap.mmap(handle.fileno(), 0, access = mmap.ACCESS_READ) as mm:
+      body = 0
+      while body < len(mm) and mm[body] == 35: # '#'
+        body = mm.find(b'\n', body) + 1 or len(mm)
+      spans = region_spans(mm, body, loci)
+      if spans is None:
+        yield from scan_lines(path)
+        return
+      yield from mm[:body].decode('utf-8').splitlines(True)
+      for start, end in spans:
+        yield from mm[start:end].decode('utf-8').splitlines(True)
+
+
+def bcf_header(data):
+  ## Contig names and string dictionary (FILTER/INFO/FORMAT IDs, PASS first) of a BCF header, and where the records start
+  l_text = struct.unpack('<I', data[5:9])[0]
+  if len(data) < 9 + l_text:
+    return(None)
+  text = data[9:9+l_text].rstrip(b'\0').decode('utf-8')
+  contigs = []; strings = ['PASS']
+  for line in text.split('\n'):
+    matchobj = re.match(r'##(contig|FILTER|INFO|FORMAT)=<ID=([^,>]+)(.*)', line)
+    if not matchobj:
+      continue
+    table = contigs if matchobj.group(1) == 'contig' else strings
+    name = matchobj.group(2)
+    idx = re.search(r',IDX=(\d+)', matchobj.group(3))
+    if idx:
+      idx = int(idx.group(1))
+      table.extend([None] * (idx + 1 - len(table)))
+      table[idx] = name
+    elif table is contigs or name not in strings:
+      table.append(name)
+  names = [re.sub('chr|Chr|CHR', '', contig or '') for contig in contigs]
+  return({'contigs': contigs, 'names': names, 'strings': strings, 'text': text, 'length': 9 + l_text})
+
+
+def typed_descriptor(buf, off):
+  kind = buf[off] & 0x0f; count = buf[off] >> 4
+  off += 1
+  if count == 15:
+    count, off = typed_int(buf, off)
+  return(kind, count, off)
+
+
+def typed_int(buf, off):
+  kind, count, off = typed_descriptor(buf, off)
+  fmt, size, end = BCF_TYPES[kind]
+  return(struct.unpack_from('<' + fmt, buf, off)[0], off + size * count)
+
+
+def typed_string(buf, off):
+  kind, count, off = typed_descriptor(buf, off)
+  return(bytes(buf[off:off+count]).rstrip(b'\0').decode('utf-8'), off + count)
+
+
+def decode_gt(values, end):
+  ## Each allele is (index + 1) << 1 | phased; 0 is a missing allele
+  gt = ''
+  for i, value in enumerate(values):
+    if value == end:
+      break
+    if i > 0:
+      gt += '|' if value & 1 else '/'
+    gt += '.' if value >> 1 == 0 else str((value >> 1) - 1)
+  return(gt or '.')
+
+
+def bcf_line(buf, off, header):
+  ## Text line with CHROM, POS, ID, REF, ALT, END (when not implied by REF) and the GT of every sample.
+  ## QUAL, FILTER, the rest of INFO and the other FORMAT fields are skipped.
+  l_shared = struct.unpack_from('<I', buf, off)[0]
+  shared = off + 8; indiv = shared + l_shared
+  chrom, pos, rlen = struct.unpack_from('<iii', buf, shared)
+  n_allele_info, n_fmt_sample = struct.unpack_from('<II', buf, shared + 16)
+  n_allele = n_allele_info >> 16; n_fmt = n_fmt_sample >> 24; n_sample = n_fmt_sample & 0xffffff
+  id, field = typed_string(buf, shared + 24)
+  alleles = []
+  for i in range(n_allele):
+    allele, field = typed_string(buf, field)
+    alleles.append(allele)
+  gts = ['.'] * n_sample
+  field = indiv
+  for i in range(n_fmt):
+    key, field = typed_int(buf, field)
+    kind, count, field = typed_descriptor(buf, field)
+    fmt, size, end = BCF_TYPES[kind]
+    if header['strings'][key] == 'GT':
+      values = struct.unpack_from('<%d%s' % (n_sample * count, fmt), buf, field)
+      gts = [decode_gt(values[i*count:(i+1)*count], end) for i in range(n_sample)]
+      break
+    field += n_sample * count * size
+  info = 'END=%d' % (pos + rlen) if rlen != len(alleles[0]) else '.'
+  return('\t'.join([header['contigs'][chrom], str(pos + 1), id or '.', alleles[0], ','.join(alleles[1:]) or '.', '.', '.', info, 'GT'] + gts) + '\n')
+
+
+def bcf_records(buf, off, stop, header, loci):
+  ## Lines of the complete records in buf[off:stop] that overlap the PGx loci (all records when loci is None).
+  ## CHROM and POS are read first, so the other records are skipped undecoded. Returns where the next record starts.
+  while off + 8 <= stop:
+    l_shared, l_indiv = struct.unpack_from('<II', buf, off)
+    if off + 8 + l_shared + l_indiv > stop:
+      break
+    if loci is None:
+      yield(bcf_line(buf, off, header))
+    else:
+      chrom, pos, rlen = struct.unpack_from('<iii', buf, off + 8)
+      intervals = loci.get(header['names'][chrom])
+      if intervals is not None:
+        i = bisect.bisect_right(intervals[0], pos + rlen) - 1
+        if i >= 0 and pos + 1 <= intervals[1][i]:
+          yield(bcf_line(buf, off, header))
+    off += 8 + l_shared + l_indiv
+  return(off)
+
+
+def csi_index(path):
+  ## Bins of every contig of a CSI index: {tid: {bin: (loffset, position of its chunks, number of chunks)}}.
+  ## The chunks themselves are only unpacked for the bins a query touches.
+  data = b''.join(bgzf_chunks(path, 1))
+  if data[:4] != b'CSI\x01':
+    raise ValueError('%s is not a CSI index.' % path)
+  min_shift, depth, l_aux = struct.unpack_from('<iii', data, 4)
+  off = 16 + l_aux
+  n_ref = struct.unpack_from('<i', data, off)[0]; off += 4
+  refs = {}
+  for tid in range(n_ref):
+    n_bin = struct.unpack_from('<i', data, off)[0]; off += 4
+    bins = {}
+    for i in range(n_bin):
+      bin, loffset, n_chunk = struct.unpack_from('<IQi', data, off); off += 16
+      bins[bin] = (loffset, off, n_chunk)
+      off += 16 * n_chunk
+    refs[tid] = bins
+  return(min_shift, depth, refs, data)
+
+
+def csi_chunks(index, tid, beg, end):
+  ## Virtual offset ranges that may hold records overlapping [beg, end), 0-based, as in hts_itr_query
+  min_shift, depth, refs, data = index
+  bins = refs.get(tid, {})
+  chunks = []
+  shift = min_shift + depth * 3; first = 0
+  for level in range(depth + 1):
+    for bin in range(first + (beg >> shift), first + ((end - 1) >> shift) + 1):
+      if bin in bins:
+        loffset, off, n_chunk = bins[bin]
+        chunks.extend(struct.iter_unpack('<QQ', data[off:off + 16 * n_chunk]))
+    shift -= 3; first += 1 << (level * 3)
+  ## Records ending before beg are skipped with the lowest offset of the deepest bin holding beg
+  bin = first - (1 << (depth * 3)) + (beg >> min_shift)
+  while bin not in bins and bin > 0:
+    bin = (bin - 1) >> 3
+  min_off = bins[bin][0] if bin in bins else 0
+  return([(max(vbeg, min_off), vend) for vbeg, vend in chunks if vend > min_off])
+
+
+def bcf_lines(path, loci, threads=None):
+  ## Header plus the records at PGx loci of a BCF file; with a .csi index only the indexed regions are inflated
+  data = b''; header = None
+  chunks = bgzf_chunks(path, threads)
+  for chunk in chunks:
+    data += chunk
+    if len(data) >= 9:
+      header = bcf_header(data)
+    if header is not None:
+      break
+  if header is None:
+    raise ValueError('%s has a truncated BCF header.' % path)
+  yield from header['text'].splitlines(True)
+
+  if loci is not None and os.path.exists(path + '.csi'):
+    chunks.close()
+    index = csi_index(path + '.csi')
+    cache = {}
+    with open(path, 'rb') as handle:
+      for tid, name in enumerate(header['names']):
+        intervals = loci.get(name)
+        if intervals is None:
+          continue
+        regions = []
+        for start, end in zip(intervals[0], intervals[1]):
+          regions.extend(csi_chunks(index, tid, start - 1, end))
+        ## Merge overlapping offset ranges so that each record is decoded once, in file order
+        merged = []
+        for vbeg, vend in sorted(regions):
+          if merged and vbeg <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], vend)
+          else:
+            merged.append([vbeg, vend])
+        for vbeg, vend in merged:
+          buf = bgzf_range(handle, vbeg, vend, cache)
+          yield from bcf_records(buf, 0, len(buf), header, loci)
+  else:
+    buf = data; off = header['length']
+    for chunk in chunks:
+      off = yield from bcf_records(buf, off, len(buf), header, loci)
+      buf = buf[off:] + chunk; off = 0
+    yield from bcf_records(buf, off, len(buf), header, loci)
+
+
+def scan_lines(path):
+  opener = gzip.open if is_gzip(path) else open
+  with opener(path, 'rt', encoding = 'utf-8') as file:
+    yield from file
+
+
+def open_vcf(path, threads=None, loci=None, assume_sorted=False):
+  ## Lines of a plain, gzip or BGZF compressed VCF. BGZF is inflated block by block in parallel threads.
+  ## When the PGx loci are given and the caller vouches that a plain VCF is coordinate-sorted (assume_sorted), it is
+  ## memory-mapped and only the records in the loci are read; otherwise it is read in full, since sortedness cannot be
+  ## checked without reading every record and a record out of order would be silently missed.
+  ## BCF records are decoded from their binary fields (CHROM, POS, ID, REF, ALT and GT only), through the .csi index if any.
+  if is_bgzf(path) and is_bcf(path):
+    yield from bcf_lines(path, loci, threads)
+  elif is_bgzf(path):
+    yield from bgzf_lines(path, threads)
+  elif loci is not None and assume_sorted and not is_gzip(path):
+    yield from mmap_lines(path, loci)
+  else:
+    yield from scan_lines(path)
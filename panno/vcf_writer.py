@@ -0,0 +1,110 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+
+import struct, zlib
+
+# Uncompressed bytes per BGZF block, as written by htslib
+BGZF_BLOCK = 0xff00
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+# Binning scheme of the tabix index: 16 kb windows, 6 levels of bins
+TBI_MIN_SHIFT = 14
+TBI_DEPTH = 5
+
+
+class BgzfWriter(object):
+  ## Writes bytes as BGZF blocks; tell() gives the virtual offset (block start << 16 | offset within the block) of the next byte
+  def __init__(self, path, level=6):
+    self.handle = open(path, 'wb')
+    self.level = level
+    self.buffer = bytearray()
+    self.block_start = 0
+
+  def write(self, data):
+    self.buffer += data
+    while len(self.buffer) >= BGZF_BLOCK:
+      self.flush_block(BGZF_BLOCK)
+
+  def flush_block(self, size):
+    data = bytes(self.buffer[:size])
+    del self.buffer[:size]
+    compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    block = b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00' + struct.pack('<H', len(cdata) + 25) + cdata + struct.pack('<II', zlib.crc32(data), len(data))
+    self.handle.write(block)
+    self.block_start += len(block)
+
+  def tell(self):
+    return((self.block_start << 16) | len(self.buffer))
+
+  def close(self):
+    if self.buffer:
+      self.flush_block(len(self.buffer))
+    self.handle.write(BGZF_EOF)
+    self.handle.close()
+
+
+def reg2bin(beg, end):
+  ## Smallest bin containing the 0-based interval [beg, end)
+  end -= 1
+  level = TBI_DEPTH; shift = TBI_MIN_SHIFT; offset = ((1 << (TBI_DEPTH * 3)) - 1) // 7
+  while level > 0:
+    if beg >> shift == end >> shift:
+      return(offset + (beg >> shift))
+    level -= 1; shift += 3; offset -= 1 << (level * 3)
+  return(0)
+
+
+class TabixIndex(object):
+  ## Tabix (.tbi) index of a coordinate-sorted, bgzipped VCF, built while its records are written
+  def __init__(self):
+    self.names = []
+    self.refs = {}
+
+  def add(self, chrom, beg, end, vbeg, vend):
+    ## One record covering the 0-based [beg, end) of chrom, stored at the virtual offsets [vbeg, vend)
+    ref = self.refs.get(chrom)
+    if ref is None:
+      self.names.append(chrom)
+      ref = self.refs[chrom] = {'bins': {}, 'linear': [], 'vbeg': vbeg, 'vend': vend, 'count': 0}
+    end = max(end, beg + 1)
+    chunks = ref['bins'].setdefault(reg2bin(beg, end), [])
+    if chunks and chunks[-1][1] == vbeg:
+      chunks[-1][1] = vend
+    else:
+      chunks.append([vbeg, vend])
+    # Linear index: virtual offset of the first record overlapping each 16 kb window
+    linear = ref['linear']
+    last = (end - 1) >> TBI_MIN_SHIFT
+    if len(linear) <= last:
+      linear.extend([None] * (last + 1 - len(linear)))
+    for window in range(beg >> TBI_MIN_SHIFT, last + 1):
+      if linear[window] is None:
+        linear[window] = vbeg
+    ref['vend'] = vend; ref['count'] += 1
+
+  def write(self, path):
+    names = b''.join(name.encode('utf-8') + b'\0' for name in self.names)
+    # Format 2 (VCF): sequence in column 1, begin in column 2, end computed from REF; '#' starts the header lines
+    data = bytearray(b'TBI\x01' + struct.pack('<8i', len(self.names), 2, 1, 2, 0, ord('#'), 0, len(names)) + names)
+    for name in self.names:
+      ref = self.refs[name]
+      bins = sorted(ref['bins'].items())
+      data += struct.pack('<i', len(bins) + 1)
+      for bin, chunks in bins:
+        data += struct.pack('<Ii', bin, len(chunks))
+        for chunk in chunks:
+          data += struct.pack('<QQ', *chunk)
+      # Pseudo-bin with the span and the number of records of the sequence
+      data += struct.pack('<IiQQQQ', 37450, 2, ref['vbeg'], ref['vend'], ref['count'], 0)
+      # Windows before the first record or without a record start where the previous one does
+      linear = ref['linear']; previous = ref['vbeg']
+      for i in range(len(linear)):
+        if linear[i] is None:
+          linear[i] = previous
+        previous = linear[i]
+      data += struct.pack('<i%dQ' % len(linear), len(linear), *linear)
+    writer = BgzfWriter(path)
+    writer.write(bytes(data))
+    writer.close()
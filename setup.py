@@ -8,8 +8,8 @@ from setuptools import setup, find_packages
 readme = open('README.md').read()
 history = open('HISTORY.md').read()
 
-requirements = ['pandas', 'numpy', 'pyranges']
-test_requirements = ['pandas', 'numpy', 'pyranges']
+requirements = ['pandas', 'numpy']
+test_requirements = ['pandas', 'numpy']
 
 setup(
     author="Yaqing Liu",
@@ -38,6 +38,7 @@ setup(
         ],
     },
     install_requires=requirements,
+    extras_require={'parquet': ['pyarrow']},
     long_description=readme + '\n\n' + history,
     long_description_content_type='text/markdown',
     include_package_data=True,
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+"""Guideline rules and clinical annotations matched by a full run."""
+
+
+import os
+import unittest
+
+from panno import genotype_resolution, clinical_annotation, predict_diplotype
+from panno.api import pop_dic
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ASSETS = os.path.join(ROOT, 'panno', 'assets')
+# SLCO1B1 rs4149056 T/C
+SAMPLE = ('NA10859', 'EUR')
+
+
+@unittest.skipUnless(os.path.exists(os.path.join(ASSETS, 'pgx_kb.sqlite3')) and os.path.exists(os.path.join(ASSETS, 'pgx_diplotypes.json')),
+                     'knowledge base assets are not installed')
+class TestAnnotation(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        vcf = os.path.join(ROOT, 'demo', '%s.pgx.vcf' % SAMPLE[0])
+        cls.tables = clinical_annotation.load_tables()
+        cls.dic_diplotype, cls.dic_rs2gt, cls.hla_subtypes = genotype_resolution.resolution(
+            pop_dic[SAMPLE[1]], vcf, 1, genotype_resolution.load_pgx_loci(), predict_diplotype.load_definitions())
+
+    def test_rsid_guideline(self):
+        # The rules of an rsID are matched on the rsID, whatever gene the diplotype rules ended with
+        self.assertEqual(self.dic_rs2gt['rs4149056'], ('T', 'C'))
+        rule_df = self.tables['rule']
+        expected = set(rule_df[(rule_df.Variant == 'rs4149056') & (((rule_df.Allele1 == 'T') & (rule_df.Allele2 == 'C')) | ((rule_df.Allele1 == 'C') & (rule_df.Allele2 == 'T')))].GuidelineID)
+        self.assertTrue(expected)
+        summary, prescribing_info = clinical_annotation.annotation(self.dic_diplotype, self.dic_rs2gt, self.hla_subtypes, self.tables)[:2]
+        rsid_info = prescribing_info[(prescribing_info.Gene == 'SLCO1B1') & (prescribing_info.Variant == 'rs4149056')]
+        self.assertEqual(set(rsid_info.Diplotype), {'TC'})
+        guide_df = self.tables['guide']
+        drugs = set(guide_df[guide_df.ID.isin(expected)].Drug)
+        self.assertTrue(drugs <= set(rsid_info.Drug))
+        self.assertTrue(drugs <= set(summary['Avoid'] + summary['Caution'] + summary['Routine']))
+
+    def test_zero_copy_hla(self):
+        # An HLA allele with zero copies adds the clinical annotations of a missing one: none
+        gene, var = 'HLA-B', '*57:01:01'
+        zero_copy = {hla_gene: {} for hla_gene in self.hla_subtypes}
+        zero_copy[gene][var] = 0
+        missing = {hla_gene: {} for hla_gene in self.hla_subtypes}
+        with_zero_copy = clinical_annotation.annotation(self.dic_diplotype, self.dic_rs2gt, zero_copy, self.tables)
+        with_missing = clinical_annotation.annotation(self.dic_diplotype, self.dic_rs2gt, missing, self.tables)
+        single_var = with_zero_copy[3]
+        self.assertEqual(single_var[(single_var.Gene == gene) & (single_var.Variant == var)]['Variant Call'].to_list(), ['Zero copy'])
+        for table, expected_table in zip(with_zero_copy[4:], with_missing[4:]):
+            self.assertTrue(table.reset_index(drop=True).equals(expected_table.reset_index(drop=True)))
+
+    def test_zero_copy_hla_only(self):
+        # With nothing matched before it, a zero-copy HLA allele leaves the clinical annotations empty
+        tables = clinical_annotation.restrict_tables(self.tables, ['abacavir'])
+        hla_subtypes = {hla_gene: {} for hla_gene in self.hla_subtypes}
+        hla_subtypes['HLA-B']['*57:01:01'] = 0
+        clinical_anno = clinical_annotation.annotation({}, {}, hla_subtypes, tables)[5]
+        self.assertTrue(clinical_anno.empty)
+
+
+if __name__ == '__main__':
+    unittest.main()
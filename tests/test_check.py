@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+
+"""Coverage reported by panno check against the genotypes reported by a run."""
+
+
+import os
+import unittest
+
+from panno import genotype_resolution, clinical_annotation, predict_diplotype, pgx_check
+from panno.api import pop_dic
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ASSETS = os.path.join(ROOT, 'panno', 'assets')
+# A gVCF: most PGx positions are covered by reference blocks
+SAMPLE = ('NA10859', 'EUR')
+
+
+@unittest.skipUnless(os.path.exists(os.path.join(ASSETS, 'pgx_kb.sqlite3')) and os.path.exists(os.path.join(ASSETS, 'pgx_diplotypes.json')),
+                     'knowledge base assets are not installed')
+class TestCheckCoverage(unittest.TestCase):
+    """The rsIDs of pgx_loci.bed counted as called by check are the ones a run reports a genotype for."""
+
+    def test_pgx_loci(self):
+        vcf = os.path.join(ROOT, 'demo', '%s.pgx.vcf' % SAMPLE[0])
+        pgx_loci = genotype_resolution.load_pgx_loci()
+        definitions = predict_diplotype.load_definitions()
+        coverage, issues = pgx_check.check(vcf, 1, pgx_loci, definitions)
+        # The genotypes of the rsIDs do not depend on the diplotypes, which are not predicted here
+        dic_diplotype, dic_rs2gt, hla_subtypes = genotype_resolution.resolution(pop_dic[SAMPLE[1]], vcf, 1, pgx_loci, definitions, gene_list=[])
+        bed = coverage[coverage.Gene == 'pgx_loci.bed'].iloc[0]
+        self.assertEqual(bed.Called, len(dic_rs2gt))
+        self.assertEqual(bed.Missing, len(set(pgx_loci[0].rsid.dropna()) - set(dic_rs2gt)))
+
+        single_var = clinical_annotation.annotation(dic_diplotype, dic_rs2gt, hla_subtypes)[3]
+        rs_var = single_var[single_var.Variant.str.startswith('rs')]
+        called = rs_var[rs_var['Variant Call'] != 'Missing'].Variant
+        self.assertTrue(called.isin(list(dic_rs2gt)).all())
+        self.assertFalse(rs_var[rs_var['Variant Call'] == 'Missing'].Variant.isin(list(dic_rs2gt)).any())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+"""Concurrent annotation of distinct samples in one process."""
+
+
+import os
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from panno import genotype_resolution, clinical_annotation, predict_diplotype
+from panno.api import pop_dic
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ASSETS = os.path.join(ROOT, 'panno', 'assets')
+SAMPLES = {'HG00436': 'EAS', 'NA10859': 'EUR', 'NA19147': 'SSA', 'NA19785': 'LAT'}
+
+
+@unittest.skipUnless(os.path.exists(os.path.join(ASSETS, 'pgx_kb.sqlite3')) and os.path.exists(os.path.join(ASSETS, 'pgx_diplotypes.json')),
+                     'knowledge base assets are not installed')
+class TestConcurrency(unittest.TestCase):
+    """N threads resolve and annotate distinct samples with the results of a serial run."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.pgx_loci = genotype_resolution.load_pgx_loci()
+        cls.definitions = predict_diplotype.load_definitions()
+        cls.resolved = {}
+        cls.expected = {}
+        for sample, population in SAMPLES.items():
+            cls.resolved[sample] = cls.resolve(sample)
+            cls.expected[sample] = clinical_annotation.annotation(*cls.resolved[sample])
+
+    @classmethod
+    def resolve(cls, sample):
+        vcf = os.path.join(ROOT, 'demo', '%s.pgx.vcf' % sample)
+        return(genotype_resolution.resolution(pop_dic[SAMPLES[sample]], vcf, 1, cls.pgx_loci, cls.definitions))
+
+    def assertSameAnnotation(self, result, expected):
+        self.assertEqual(result[0], expected[0])
+        for table, expected_table in zip(result[1:], expected[1:]):
+            self.assertTrue(table.reset_index(drop=True).equals(expected_table.reset_index(drop=True)))
+
+    def test_resolution(self):
+        # The definitions, with their compiled allele tables, are shared by all threads
+        with ThreadPoolExecutor(len(SAMPLES)) as pool:
+            results = dict(zip(SAMPLES, pool.map(self.resolve, SAMPLES)))
+        for sample in SAMPLES:
+            diplotype, rs2gt, hla_subtypes = results[sample]
+            expected = self.resolved[sample]
+            self.assertEqual({gene: res['step2_res'] for gene, res in diplotype.items()},
+                             {gene: res['step2_res'] for gene, res in expected[0].items()})
+            self.assertEqual(rs2gt, expected[1])
+            self.assertEqual(hla_subtypes, expected[2])
+
+    def test_annotation(self):
+        # More tasks than pooled connections, so that threads also wait for a connection to be released
+        samples = list(SAMPLES) * 2
+        with ThreadPoolExecutor(len(samples)) as pool:
+            results = list(pool.map(lambda sample: clinical_annotation.annotation(*self.resolved[sample]), samples))
+        for sample, result in zip(samples, results):
+            self.assertSameAnnotation(result, self.expected[sample])
+
+    def test_read_only(self):
+        with clinical_annotation.get_pool().connection() as conn:
+            with self.assertRaises(Exception):
+                conn.execute("CREATE TABLE Scratch (ID INTEGER);")
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+"""PGx slices written by panno extract and their tabix index."""
+
+
+import gzip
+import os
+import random
+import tempfile
+import unittest
+
+try:
+    import pysam
+except ImportError:
+    pysam = None
+
+from panno import genotype_resolution, pgx_extract
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# A gVCF, with reference blocks spanning several PGx positions
+SAMPLE = 'NA10859'
+
+
+class TestExtract(unittest.TestCase):
+    """The bgzipped slice gives the records of the whole file, and its index the records of any region."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.loci = genotype_resolution.load_pgx_loci()[1]
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        cls.vcf = os.path.join(ROOT, 'demo', '%s.pgx.vcf' % SAMPLE)
+        cls.slice = os.path.join(cls.tmpdir.name, '%s.slice.vcf.gz' % SAMPLE)
+        cls.counts = pgx_extract.extract(cls.vcf, cls.slice, 1, compress=True, index=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmpdir.cleanup()
+
+    def test_slice(self):
+        n_read, n_written = self.counts
+        self.assertGreater(n_written, 0)
+        self.assertLessEqual(n_written, n_read)
+        self.assertTrue(genotype_resolution.parse_vcf(self.slice, self.loci).equals(genotype_resolution.parse_vcf(self.vcf, self.loci)))
+
+    @unittest.skipIf(pysam is None, 'pysam is not installed')
+    def test_index(self):
+        self.assertTrue(os.path.exists(self.slice + '.tbi'))
+        records = []
+        with gzip.open(self.slice, 'rt') as handle:
+            for line in handle:
+                if line[0] != '#':
+                    info = line.rstrip('\n').split('\t')
+                    pos = int(info[1])
+                    records.append((info[0], pos, genotype_resolution.record_end(pos, info[3], info[4], info[7]), line.rstrip('\n')))
+        rng = random.Random(0)
+        with pysam.TabixFile(self.slice) as tbx:
+            for i in range(500):
+                chrom, pos, end, line = rng.choice(records)
+                # Regions of 1 bp to 100 kb around a record, so that queries hit blocks, gaps and neighbours
+                beg = max(0, pos - 1 - rng.randint(0, 50000)); stop = beg + rng.randint(1, 100000)
+                expected = [record[3] for record in records if record[0] == chrom and record[1] - 1 < stop and record[2] > beg]
+                self.assertEqual(list(tbx.fetch(chrom, beg, stop)), expected)
+
+    @unittest.skipIf(pysam is None, 'pysam is not installed')
+    def test_bcf(self):
+        # BCF records are written as GT-only lines, with the same records and genotypes
+        bcf = os.path.join(self.tmpdir.name, '%s.bcf' % SAMPLE)
+        with pysam.VariantFile(self.vcf) as vcf, pysam.VariantFile(bcf, 'wb', header=vcf.header) as out:
+            for record in vcf:
+                out.write(record)
+        bcf_slice = os.path.join(self.tmpdir.name, '%s.bcf.slice.vcf' % SAMPLE)
+        self.assertEqual(pgx_extract.extract(bcf, bcf_slice, 1), self.counts)
+        with open(bcf_slice) as handle:
+            lines = [line.rstrip('\n').split('\t') for line in handle if line[0] != '#']
+        self.assertEqual(len(lines), self.counts[1])
+        self.assertTrue(all(line[5:7] == ['.', '.'] and line[8] == 'GT' for line in lines))
+        self.assertTrue(genotype_resolution.parse_vcf(bcf_slice, self.loci).equals(genotype_resolution.parse_vcf(self.vcf, self.loci)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+
+"""Peak memory of each stage of the pipeline, against the baselines of memory_baselines.json.
+
+Every input is profiled in a fresh interpreter (``python tests/test_memory.py profile ...``), which
+reports for each stage its peak RSS above the RSS it started from. A stage fails when it grows beyond
+TOLERANCE of its baseline (plus SLACK_MB, the noise of small stages); the input is then profiled again
+under tracemalloc, which is too slow for every run, to show the largest allocations of the stage.
+
+The suite writes two WGS-sized inputs and takes several minutes, so it only runs when
+PANNO_MEMORY_TESTS=1 is set. The baselines hold absolute sizes, which differ between builds of
+Python, pandas and numpy: the suite is skipped unless the versions recorded with them are installed.
+
+After an intended change in memory use, store the new baselines (peak RSS, tracemalloc peak and
+largest allocations of every stage) with::
+
+    python tests/test_memory.py update
+"""
+
+
+import gc
+import heapq
+import json
+import os
+import subprocess
+import sys
+import sysconfig
+import tempfile
+import tracemalloc
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ASSETS = os.path.join(ROOT, 'panno', 'assets')
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'memory_baselines.json')
+
+TOLERANCE = 0.2
+SLACK_MB = 8
+
+ENABLED = os.environ.get('PANNO_MEMORY_TESTS') == '1'
+
+STAGES = ['parse_vcf', 'resolution', 'annotation', 'report']
+SAMPLES = {'HG00436': 'EAS', 'NA10859': 'EUR', 'NA19147': 'SSA', 'NA19785': 'LAT'}
+
+# Synthetic WGS-sized input: the records of a demo sample among filler reference calls, plain and bgzipped
+SYNTHETIC_SAMPLE = 'NA10859'
+SYNTHETIC_RECORDS = 2500000
+
+
+def rss_mb(field='VmRSS'):
+    """VmRSS, or VmHWM for the peak, of this process in MB."""
+    with open('/proc/self/status') as handle:
+        for line in handle:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) / 1024
+
+
+def reset_peak():
+    """Bring VmHWM down to the current RSS."""
+    with open('/proc/self/clear_refs', 'w') as handle:
+        handle.write('5')
+
+
+def location(frame):
+    """File and line of an allocation, relative to the repository, site-packages or the standard library."""
+    filename = frame.filename
+    if filename.startswith(ROOT + os.sep):
+        filename = os.path.relpath(filename, ROOT)
+    elif 'site-packages' + os.sep in filename:
+        filename = filename.split('site-packages' + os.sep, 1)[1]
+    elif filename.startswith(sysconfig.get_paths()['stdlib'] + os.sep):
+        filename = os.path.relpath(filename, sysconfig.get_paths()['stdlib'])
+    return '%s:%d' % (filename, frame.lineno)
+
+
+def profile(vcf, population, stages, trace=False, top=10):
+    """Run the stages in order on one input and measure each of them, under tracemalloc if trace."""
+    from panno import genotype_resolution, predict_diplotype, clinical_annotation, pgx_report
+    from panno.api import pop_dic
+
+    pgx_loci = genotype_resolution.load_pgx_loci()
+    definitions = predict_diplotype.load_definitions()
+    tables = clinical_annotation.load_tables()
+    race = pop_dic[population]
+    outdir = tempfile.mkdtemp()
+    results = {}
+    run = {
+        # The profiled inputs are sorted, so plain VCFs are read through the seeking reader
+        'parse_vcf': lambda: genotype_resolution.parse_vcf(vcf, pgx_loci[1], 1, assume_sorted=True),
+        'resolution': lambda: genotype_resolution.resolution(race, results['parse_vcf'], 1, pgx_loci, definitions),
+        'annotation': lambda: clinical_annotation.annotation(*results['resolution'], tables),
+        'report': lambda: pgx_report.report('%s (%s)' % (race, population), *results['annotation'],
+                                            os.path.join(outdir, 'memory.PAnno.html'), 'memory'),
+    }
+    measurements = {}
+    for stage in stages:
+        gc.collect()
+        reset_peak()
+        before = rss_mb()
+        if trace:
+            tracemalloc.start()
+        results[stage] = run[stage]()
+        measurements[stage] = {'peak_rss_mb': round(rss_mb('VmHWM') - before, 1)}
+        if trace:
+            # The largest allocations still held when the stage returns, mostly its results
+            measurements[stage]['traced_peak_mb'] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 1)
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            measurements[stage]['top'] = ['%s: %.2f MB' % (location(stat.traceback[0]), stat.size / 2 ** 20) for stat in snapshot.statistics('lineno')[:top]]
+            del snapshot
+    return measurements
+
+
+def synthetic_wgs(sample, fp, n_records, compress=False):
+    """Write the records of a demo sample among filler reference calls at positions outside the PGx loci."""
+    from panno import genotype_resolution
+    from panno.vcf_writer import BgzfWriter
+
+    loci = genotype_resolution.load_pgx_loci()[1]
+    header = []
+    chroms = {}
+    with open(os.path.join(ROOT, 'demo', '%s.pgx.vcf' % sample)) as handle:
+        for line in handle:
+            if line[0] == '#':
+                header.append(line)
+            else:
+                chroms.setdefault(line.split('\t', 1)[0], []).append(line)
+    filled = [chrom for chrom in chroms if chrom[3:].isdigit() or chrom == 'chrX']
+    step = 100
+    per_chrom = (n_records - sum(len(lines) for lines in chroms.values())) // len(filled)
+    out = BgzfWriter(fp) if compress else open(fp, 'wb')
+    out.write(''.join(header).encode('utf-8'))
+    for chrom, lines in chroms.items():
+        if chrom in filled:
+            filler = ('%s\t%d\t.\tA\t<NON_REF>\t.\t.\tEND=%d\tGT:DP:GQ\t0/0:30:60\n' % (chrom, pos, pos)
+                      for pos in range(1, per_chrom * step, step)
+                      if not genotype_resolution.in_pgx_loci(loci, chrom[3:], pos))
+            lines = heapq.merge(lines, filler, key=lambda line: int(line.split('\t', 2)[1]))
+        for line in lines:
+            out.write(line.encode('utf-8'))
+    out.close()
+
+
+def versions():
+    """Versions the baselines depend on, as recorded in memory_baselines.json."""
+    import numpy
+    import pandas
+    return {'python': sys.version.split()[0], 'pandas': pandas.__version__, 'numpy': numpy.__version__}
+
+
+def baseline_versions():
+    """Versions recorded with the baselines, None without baselines."""
+    if not os.path.exists(BASELINES):
+        return None
+    with open(BASELINES) as handle:
+        baselines = json.load(handle)
+    return {name: baselines.get(name) for name in ('python', 'pandas', 'numpy')}
+
+
+def inputs(tmpdir):
+    """Name, path, population and stages of every profiled input."""
+    cases = [(sample, os.path.join(ROOT, 'demo', '%s.pgx.vcf' % sample), population, STAGES) for sample, population in SAMPLES.items()]
+    # The PGx records of the synthetic inputs are those of the demo sample, only reading them depends on the file size
+    cases.append(('wgs.vcf', os.path.join(tmpdir, 'wgs.vcf'), SAMPLES[SYNTHETIC_SAMPLE], ['parse_vcf']))
+    cases.append(('wgs.vcf.gz', os.path.join(tmpdir, 'wgs.vcf.gz'), SAMPLES[SYNTHETIC_SAMPLE], ['parse_vcf']))
+    return cases
+
+
+def run_profile(vcf, population, stages, trace=False):
+    proc = subprocess.run([sys.executable, os.path.abspath(__file__), 'profile', vcf, population] + stages + ['--trace'] * trace,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, cwd=ROOT)
+    if proc.returncode != 0:
+        raise RuntimeError('Profiling %s failed:\n%s' % (vcf, proc.stderr))
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def make_synthetic(tmpdir):
+    synthetic_wgs(SYNTHETIC_SAMPLE, os.path.join(tmpdir, 'wgs.vcf'), SYNTHETIC_RECORDS)
+    synthetic_wgs(SYNTHETIC_SAMPLE, os.path.join(tmpdir, 'wgs.vcf.gz'), SYNTHETIC_RECORDS, compress=True)
+
+
+@unittest.skipUnless(os.path.exists(os.path.join(ASSETS, 'pgx_kb.sqlite3')) and os.path.exists(os.path.join(ASSETS, 'pgx_diplotypes.json')),
+                     'knowledge base assets are not installed')
+@unittest.skipUnless(os.path.exists('/proc/self/clear_refs'), 'peak RSS can only be reset on Linux')
+@unittest.skipUnless(ENABLED, 'memory regression suite is opt-in, set PANNO_MEMORY_TESTS=1')
+@unittest.skipUnless(os.path.exists(BASELINES), 'no memory baselines, run python tests/test_memory.py update')
+@unittest.skipUnless(baseline_versions() in (None, versions()),
+                     'memory baselines were recorded with other versions of python, pandas or numpy: %s' % baseline_versions())
+class TestMemory(unittest.TestCase):
+    """The peak memory of every stage stays within TOLERANCE of its baseline."""
+
+    @classmethod
+    def setUpClass(cls):
+        with open(BASELINES) as handle:
+            cls.baselines = json.load(handle)['inputs']
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        make_synthetic(cls.tmpdir.name)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmpdir.cleanup()
+
+    def test_stages(self):
+        for name, vcf, population, stages in inputs(self.tmpdir.name):
+            measured = run_profile(vcf, population, stages)
+            for stage in stages:
+                with self.subTest(input=name, stage=stage):
+                    baseline = self.baselines[name][stage]
+                    limit = baseline['peak_rss_mb'] * (1 + TOLERANCE) + SLACK_MB
+                    if measured[stage]['peak_rss_mb'] > limit:
+                        traced = run_profile(vcf, population, stages, trace=True)[stage]
+                        self.fail('Peak RSS of %s on %s: %.1f MB, over the limit of %.1f MB (baseline %.1f MB).\n'
+                                  'tracemalloc peak: %.1f MB (baseline %.1f MB), largest allocations held after the stage:\n  %s'
+                                  % (stage, name, measured[stage]['peak_rss_mb'], limit, baseline['peak_rss_mb'],
+                                     traced['traced_peak_mb'], baseline['traced_peak_mb'], '\n  '.join(traced['top'])))
+
+
+def update():
+    baselines = dict(versions(), inputs={})
+    with tempfile.TemporaryDirectory() as tmpdir:
+        make_synthetic(tmpdir)
+        for name, vcf, population, stages in inputs(tmpdir):
+            # Peak RSS is measured without tracemalloc, whose own bookkeeping it would include
+            measured = run_profile(vcf, population, stages)
+            traced = run_profile(vcf, population, stages, trace=True)
+            for stage in stages:
+                traced[stage]['peak_rss_mb'] = measured[stage]['peak_rss_mb']
+            baselines['inputs'][name] = traced
+            print(name, {stage: (res['peak_rss_mb'], res['traced_peak_mb']) for stage, res in traced.items()})
+    with open(BASELINES, 'w') as handle:
+        json.dump(baselines, handle, indent=2)
+        handle.write('\n')
+
+
+if __name__ == '__main__':
+    sys.path.insert(0, ROOT)
+    if sys.argv[1:2] == ['profile']:
+        args = [arg for arg in sys.argv[2:] if arg != '--trace']
+        print(json.dumps(profile(args[0], args[1], args[2:], trace='--trace' in sys.argv)))
+    elif sys.argv[1:2] == ['update']:
+        update()
+    else:
+        unittest.main()
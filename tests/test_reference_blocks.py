@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+"""PGx positions covered by the reference blocks of a gVCF."""
+
+
+import os
+import tempfile
+import unittest
+
+from panno import genotype_resolution, predict_diplotype
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ASSETS = os.path.join(ROOT, 'panno', 'assets')
+HEADER = '##fileformat=VCFv4.2\n##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tSAMPLE\n'
+RECORDS = [
+    # VKORC1 rs9923231 (chr16:31096368, C) is covered by the first block only, whose END reaches past the second
+    'chr16\t31090000\t.\tA\t<NON_REF>\t.\tPASS\tEND=31100000\tGT\t0/0\n',
+    'chr16\t31091000\t.\tG\t<NON_REF>\t.\tPASS\tEND=31092000\tGT\t0/0\n',
+    # Haploid blocks of G6PD, with rs137852324 (chrX:154532389) in the gap between them
+    'chrX\t154532200\t.\tT\t<NON_REF>\t.\tPASS\tEND=154532300\tGT\t0\n',
+    'chrX\t154532400\t.\tA\t<NON_REF>\t.\tPASS\tEND=154532500\tGT\t0\n',
+]
+
+
+@unittest.skipUnless(os.path.exists(os.path.join(ASSETS, 'pgx_diplotypes.json')), 'allele definitions are not installed')
+class TestReferenceBlocks(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.panno_bed, loci = genotype_resolution.load_pgx_loci()
+        cls.definitions = predict_diplotype.load_definitions()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            vcf = os.path.join(tmpdir, 'sample.g.vcf')
+            with open(vcf, 'w') as handle:
+                handle.write(HEADER + ''.join(RECORDS))
+            cls.filtered_vcf = genotype_resolution.parse_vcf(vcf, loci)
+        cls.index = genotype_resolution.reference_index(cls.filtered_vcf)
+
+    def display(self, gene, pos):
+        info = self.definitions[gene]
+        vcf_alleles_display = predict_diplotype.parse_input_allele(self.filtered_vcf, info)[1]
+        return([display for source_pos, display in vcf_alleles_display.items() if source_pos.split(':')[0] == str(pos)][0])
+
+    def test_reference_call(self):
+        self.assertIs(genotype_resolution.reference_call(self.index, '16', 31096368), False)
+        self.assertIs(genotype_resolution.reference_call(self.index, 'X', 154532203), True)
+        self.assertIs(genotype_resolution.reference_call(self.index, 'X', 154532411), True)
+        self.assertIsNone(genotype_resolution.reference_call(self.index, 'X', 154532389))
+        self.assertIsNone(genotype_resolution.reference_call(self.index, '16', 31100001))
+        self.assertIsNone(genotype_resolution.reference_call(self.index, '10', 94761900))
+
+    def test_rs_genotypes(self):
+        dic_rs2gt = genotype_resolution.rs_genotypes(self.filtered_vcf, self.panno_bed, genotype_resolution.reference_alleles(self.definitions))
+        # Inside a <NON_REF> block: the reference base of the definitions
+        self.assertEqual(dic_rs2gt['rs9923231'], ('C', 'C'))
+        # A haploid chrX block gives a haploid genotype
+        self.assertEqual(dic_rs2gt['rs137852348'], ('G', ''))
+        self.assertEqual(dic_rs2gt['rs137852317'], ('C', ''))
+        # In the gap between two blocks
+        self.assertNotIn('rs137852324', dic_rs2gt)
+
+    def test_parse_input_allele(self):
+        self.assertEqual(self.display('VKORC1', 31096368), 'C/C')
+        self.assertEqual(self.display('G6PD', 154532203), 'G/G')
+        self.assertEqual(self.display('G6PD', 154532389), 'Missing')
+
+
+if __name__ == '__main__':
+    unittest.main()
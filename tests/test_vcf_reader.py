@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+"""Reading the PGx records of plain VCF and BCF files."""
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    import pysam
+except ImportError:
+    pysam = None
+
+from panno import genotype_resolution
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEADER = '##fileformat=VCFv4.2\n##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tSAMPLE\n'
+# A PGx position of CYP2C8
+PGX_RECORD = 'chr10\t5099115\t.\tC\tT\t.\tPASS\t.\tGT\t0/1\n'
+
+
+class TestPlainVcf(unittest.TestCase):
+    """A record out of order in a plain VCF is read unless the file is declared sorted."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.loci = genotype_resolution.load_pgx_loci()[1]
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        filler = ['chr10\t%d\t.\tA\tG\t.\tPASS\t.\tGT\t0/0\n' % pos for pos in range(1, 2600001, 100)
+                  if not genotype_resolution.in_pgx_loci(cls.loci, '10', pos)]
+        cls.sorted_vcf = os.path.join(cls.tmpdir.name, 'sorted.vcf')
+        cls.displaced_vcf = os.path.join(cls.tmpdir.name, 'displaced.vcf')
+        with open(cls.sorted_vcf, 'w') as handle:
+            handle.write(HEADER + ''.join(filler) + PGX_RECORD)
+        # One record moved to about 90% of the file, far from where it belongs
+        cut = len(filler) * 9 // 10
+        with open(cls.displaced_vcf, 'w') as handle:
+            handle.write(HEADER + ''.join(filler[:cut]) + PGX_RECORD + ''.join(filler[cut:]))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmpdir.cleanup()
+
+    def test_displaced_record(self):
+        records = genotype_resolution.parse_vcf(self.displaced_vcf, self.loci)
+        self.assertEqual(records.POS.to_list(), [5099115])
+        self.assertEqual((records.GT1.iloc[0], records.GT2.iloc[0]), (0, 1))
+
+    def test_assume_sorted(self):
+        # Declared sorted, only the records at the loci are read, with the result of a full scan
+        scanned = genotype_resolution.parse_vcf(self.sorted_vcf, self.loci)
+        seeked = genotype_resolution.parse_vcf(self.sorted_vcf, self.loci, assume_sorted=True)
+        self.assertEqual(seeked.POS.to_list(), [5099115])
+        self.assertTrue(seeked.equals(scanned))
+
+
+@unittest.skipIf(pysam is None, 'pysam is not installed')
+class TestBcf(unittest.TestCase):
+    """A BCF written by htslib gives the records of the VCF it was converted from, with or without its .csi index."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.loci = genotype_resolution.load_pgx_loci()[1]
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        cls.vcf = os.path.join(ROOT, 'demo', 'NA19785.pgx.vcf')
+        cls.bcf = os.path.join(cls.tmpdir.name, 'streamed.bcf')
+        cls.indexed_bcf = os.path.join(cls.tmpdir.name, 'indexed.bcf')
+        with pysam.VariantFile(cls.vcf) as vcf, pysam.VariantFile(cls.bcf, 'wb', header=vcf.header) as bcf:
+            for record in vcf:
+                bcf.write(record)
+        shutil.copy(cls.bcf, cls.indexed_bcf)
+        pysam.tabix_index(cls.indexed_bcf, preset='vcf', csi=True)
+        cls.expected = genotype_resolution.parse_vcf(cls.vcf, cls.loci)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmpdir.cleanup()
+
+    def test_streamed(self):
+        records = genotype_resolution.parse_vcf(self.bcf, self.loci)
+        self.assertGreater(len(records), 0)
+        self.assertTrue(records.equals(self.expected))
+
+    def test_indexed(self):
+        self.assertTrue(os.path.exists(self.indexed_bcf + '.csi'))
+        records = genotype_resolution.parse_vcf(self.indexed_bcf, self.loci)
+        # Through the index, the records come in the contig order of the header
+        sort = lambda df: df.sort_values(['#CHROM', 'POS', 'REF', 'ALT']).reset_index(drop=True)
+        self.assertTrue(sort(records).equals(sort(self.expected)))
+
+
+if __name__ == '__main__':
+    unittest.main()